@@ -0,0 +1,354 @@
+from schema import create_schema
+from bisect import bisect_left
+import unicodedata
+import itertools
+import argparse
+import sqlite3
+import random
+import json
+import time
+import re
+
+# Autocomplete for players' guesses. Every wp_article in pop.db is normalized (accents
+# folded, case folded, punctuation dropped) into a key, along with a key starting at
+# each later word, so "linc" finds Abraham Lincoln. The keys are kept in one sorted
+# list, so the keys starting with what has been typed are a single range of it, found
+# by bisection.
+#
+# People are numbered from the highest score down, so the best matches in a range are
+# simply its smallest numbers. Ranges too big to scan have their best matches worked
+# out when the index is built.
+#
+# When too few titles start with what was typed, typos are corrected a word at a time:
+# each word may be a word from the titles with one edit (a character added, missing,
+# changed or swapped with the next), or for the last word, the start of one, and the
+# corrected query is looked up like any other. Words are found by their first few
+# characters, indexed by what is left after deleting any one of them, so the words
+# starting within an edit of a typed word are found by looking up the same deletions
+# of it, and only those are checked.
+#
+# An index is built from pop.db and saved as JSON, so it loads at startup without
+# touching pop.db.
+
+# Where the index is saved.
+INDEX_PATH = 'autocomplete.json'
+
+# Version of the saved index, bumped whenever its layout changes.
+INDEX_VERSION = 1
+
+# Most matches a lookup returns.
+MAX_MATCHES = 20
+
+# Largest range of keys scanned at lookup time. The best matches for every prefix with
+# more keys than this are stored in the index.
+SCAN_LIMIT = 256
+
+# Shortest word we look for a typo in, and the number of words with a typo allowed by
+# the length of the query.
+FUZZY_MIN_LEN = 4
+FUZZY_LONG_LEN = 8
+
+# Number of characters at the start of words indexed by their deletions. Words of at
+# least FUZZY_MIN_LEN characters are indexed at every length up to this.
+FUZZY_WINDOW = 5
+
+# Sorts after any character in a key, so prefix + KEY_END is past every key starting
+# with prefix.
+KEY_END = '\U0010ffff'
+
+# Return text normalized for matching: accents and case folded, apostrophes dropped and
+# everything else that isn't a letter or a digit made a single space.
+def normalize(text):
+    folded = ''.join(c for c in unicodedata.normalize('NFKD', text)
+                     if not unicodedata.combining(c)).casefold()
+    folded = re.sub(r"['’]", '', folded)
+
+    return ' '.join(re.split(r'[\W_]+', folded)).strip()
+
+class AutocompleteIndex:
+
+    # Input: wd_ids and titles are the wd_id and wp_article of every person, from the
+    #        highest score down.
+    #
+    #        keys is the sorted list of normalized keys, and entries the person each is
+    #        for, as an index into wd_ids.
+    #
+    #        top is a dictionary of prefix to its best entries, for every prefix with
+    #        more than SCAN_LIMIT keys.
+    #
+    #        words is the sorted list of every word in the keys.
+    #
+    #        deletions is a dictionary of each deletion (see window_deletions) of the
+    #        start of every word, to the starts of words it is a deletion of.
+    def __init__(self, wd_ids, titles, keys, entries, top, words, deletions):
+        self.wd_ids = wd_ids
+        self.titles = titles
+        self.keys = keys
+        self.entries = entries
+        self.top = top
+        self.words = words
+        self.deletions = deletions
+
+    # Return the range of keys starting with a prefix.
+    def prefix_range(self, prefix):
+        return (bisect_left(self.keys, prefix),
+                bisect_left(self.keys, prefix + KEY_END))
+
+    # Return the best limit entries in a range of keys starting with prefix.
+    def best_entries(self, prefix, lo, hi, limit):
+        if hi - lo > SCAN_LIMIT:
+            return self.top[prefix][:limit]
+
+        return sorted(set(self.entries[lo:hi]))[:limit]
+
+    # Return up to limit entries with a key starting with query, best first.
+    def prefix_matches(self, query, limit):
+        lo, hi = self.prefix_range(query)
+
+        return self.best_entries(query, lo, hi, limit)
+
+    # Return the words, or for the last word of a query the starts of words, one edit
+    # away from a typed word.
+    #
+    # Input: typed is the word typed.
+    #
+    #        last is whether it is the last word of the query, which may be unfinished.
+    def corrections(self, typed, last):
+        if len(typed) < FUZZY_MIN_LEN:
+            return set()
+
+        starts = set()
+        for deletion in window_deletions(typed):
+            starts.update(self.deletions.get(deletion, ()))
+
+        corrected = set()
+        for start in starts:
+            lo, hi = (bisect_left(self.words, start),
+                      bisect_left(self.words, start + KEY_END))
+
+            for word in self.words[lo:hi]:
+                length = one_edit(typed, word, last)
+                if length is not None:
+                    corrected.add(word[:length])
+
+        return corrected
+
+    # Return up to limit entries with a key starting with query after correcting at most
+    # max_edits of its words, the fewest corrections first, then the best.
+    def fuzzy_matches(self, query, max_edits, limit):
+        words = query.split(' ')
+        corrections = [self.corrections(word, i == len(words) - 1) for i, word in enumerate(words)]
+
+        found = {}
+
+        for edits in range(1, max_edits + 1):
+            for positions in itertools.combinations(range(len(words)), edits):
+                for replacements in itertools.product(*[corrections[i] for i in positions]):
+                    corrected = list(words)
+                    for i, replacement in zip(positions, replacements):
+                        corrected[i] = replacement
+
+                    for entry in self.prefix_matches(' '.join(corrected), limit):
+                        found.setdefault(entry, edits)
+
+        return sorted(found, key=lambda entry: (found[entry], entry))[:limit]
+
+    # Return up to limit (wd_id, wp_article) matches for what a player has typed: titles
+    # with a word starting with it, from the highest score down, then titles with a
+    # word starting with something a typo or two away.
+    def complete(self, text, limit=10):
+        query = normalize(text)
+        limit = min(limit, MAX_MATCHES)
+
+        matches = self.prefix_matches(query, limit)
+
+        if len(matches) < limit and len(query) >= FUZZY_MIN_LEN:
+            max_edits = 2 if len(query) >= FUZZY_LONG_LEN else 1
+            seen = set(matches)
+            matches += [entry for entry in self.fuzzy_matches(query, max_edits, limit)
+                        if entry not in seen][:limit - len(matches)]
+
+        return [(self.wd_ids[entry], self.titles[entry]) for entry in matches]
+
+    # Save the index as JSON.
+    def save(self, path=INDEX_PATH):
+        with open(path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'wd_ids': self.wd_ids, 'titles': self.titles,
+                       'keys': self.keys, 'entries': self.entries, 'top': self.top,
+                       'words': self.words, 'deletions': self.deletions}, f)
+
+# Return the start of a word as it is indexed for typos, and that start with each of
+# its characters deleted. If two words are within an edit of each other, these share a
+# string at some length up to FUZZY_WINDOW.
+def window_deletions(word, length=FUZZY_WINDOW):
+    start = word[:length]
+
+    return {start} | {start[:i] + start[i + 1:] for i in range(len(start))}
+
+# Return how much of word a typed word matches with exactly one edit: a character
+# added, missing, changed or swapped with the next. Returns None if it takes no edits or
+# more than one.
+#
+# Input: typed is the word typed.
+#
+#        word is a word from the titles.
+#
+#        prefix allows typed to match just the start of word.
+def one_edit(typed, word, prefix):
+
+    # Find the first difference.
+    i = 0
+    shortest = min(len(typed), len(word))
+    while i < shortest and typed[i] == word[i]:
+        i += 1
+
+    if i == len(typed) and (prefix or i == len(word)):
+        return None
+
+    # The rest of typed and word after each kind of edit at i, and how much of word
+    # came before the rest.
+    edits = [(typed[i + 1:], word[i + 1:], i + 1),
+             (typed[i + 1:], word[i:], i),
+             (typed[i:], word[i + 1:], i + 1)]
+    if len(typed) > i + 1 and typed[i:i + 2] == word[i:i + 2][::-1]:
+        edits.append((typed[i + 2:], word[i + 2:], i + 2))
+
+    for typed_rest, word_rest, before in edits:
+        if word_rest == typed_rest or (prefix and word_rest.startswith(typed_rest)):
+            return before + len(typed_rest)
+
+    return None
+
+# Build an AutocompleteIndex from everyone in pop.db.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+def build_index(con):
+    rows = con.execute('''
+                       SELECT wd_id, wp_article FROM popularity
+                       WHERE wp_article IS NOT NULL
+                       ORDER BY score IS NULL, score DESC, rowid
+                       ''').fetchall()
+
+    wd_ids = [row[0] for row in rows]
+    titles = [row[1] for row in rows]
+
+    # A key for the whole title and one starting at each later word.
+    pairs = set()
+    for entry, title in enumerate(titles):
+        words = normalize(title).split(' ')
+        for w in range(len(words)):
+            pairs.add((' '.join(words[w:]), entry))
+
+    pairs = sorted(pairs)
+    keys = [key for key, entry in pairs]
+    entries = [entry for key, entry in pairs]
+
+    # Store the best entries of every prefix with too many keys to scan. Each range is
+    # split by the character after its prefix until the ranges are small enough.
+    top = {}
+
+    ranges = [('', 0, len(keys))]
+    while ranges:
+        prefix, lo, hi = ranges.pop()
+        if hi - lo <= SCAN_LIMIT:
+            continue
+
+        top[prefix] = sorted(set(entries[lo:hi]))[:MAX_MATCHES]
+
+        # Keys that are just the prefix sort first.
+        i = lo
+        while i < hi and len(keys[i]) == len(prefix):
+            i += 1
+
+        while i < hi:
+            longer = keys[i][:len(prefix) + 1]
+            j = bisect_left(keys, longer + KEY_END, i, hi)
+            ranges.append((longer, i, j))
+            i = j
+
+    # Index the deletions of the start of every word, at every length a typed word
+    # might be.
+    words = sorted({word for key in keys for word in key.split(' ')})
+
+    deletions = {}
+    for word in words:
+        for length in range(FUZZY_MIN_LEN - 1, min(len(word), FUZZY_WINDOW) + 1):
+            for deletion in window_deletions(word, length):
+                deletions.setdefault(deletion, set()).add(word[:length])
+
+    deletions = {deletion: sorted(starts) for deletion, starts in deletions.items()}
+
+    return AutocompleteIndex(wd_ids, titles, keys, entries, top, words, deletions)
+
+# Load an AutocompleteIndex saved by AutocompleteIndex.save.
+def load_index(path=INDEX_PATH):
+    with open(path) as f:
+        saved = json.load(f)
+
+    if saved['version'] != INDEX_VERSION:
+        raise RuntimeError('Autocomplete index is version', saved['version'],
+                           'but this code reads version', INDEX_VERSION)
+
+    return AutocompleteIndex(saved['wd_ids'], saved['titles'], saved['keys'],
+                             saved['entries'], saved['top'], saved['words'], saved['deletions'])
+
+# Time lookups of what players might type: the start of a title, or of a later word in
+# it, sometimes with a typo. Prints the latency percentiles.
+#
+# Input: index is the AutocompleteIndex to look up in.
+#
+#        num_queries is the number of lookups to time.
+def benchmark(index, num_queries):
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+
+    queries = []
+    for i in range(num_queries):
+        words = rng.choice(index.titles).split(' ')
+        text = ' '.join(words[rng.randrange(len(words)):])
+        text = text[:rng.randint(1, max(1, len(text)))]
+
+        # A typo in a quarter of the queries.
+        if rng.random() < 0.25 and len(text) >= FUZZY_MIN_LEN:
+            at = rng.randrange(len(text))
+            text = text[:at] + rng.choice(letters) + text[at + 1:]
+
+        queries.append(text)
+
+    latencies = []
+    for text in queries:
+        start = time.perf_counter()
+        index.complete(text)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    for percentile in (50, 90, 99, 99.9):
+        print('p{}: {:.3f}ms'.format(percentile, latencies[int(len(latencies) * percentile / 100)] * 1000))
+    print('max: {:.3f}ms'.format(latencies[-1] * 1000))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query the autocomplete index of pop.db.')
+    parser.add_argument('--build', action='store_true',
+                        help='build the index from pop.db and save it')
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help='time N lookups of the saved index')
+    parser.add_argument('text', nargs='?', help='text to complete with the saved index')
+    args = parser.parse_args()
+
+    if args.build:
+        con = sqlite3.connect("pop.db")
+        create_schema(con)
+        build_index(con).save()
+        con.close()
+
+    if args.benchmark or args.text is not None:
+        start = time.perf_counter()
+        index = load_index()
+        print('Loaded the index in {:.3f}s'.format(time.perf_counter() - start))
+
+        if args.text is not None:
+            for wd_id, title in index.complete(args.text):
+                print(wd_id, title)
+
+        if args.benchmark:
+            benchmark(index, args.benchmark)
@@ -0,0 +1,357 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from collections import Counter
+from urllib.parse import urlsplit
+from datetime import datetime
+from http import HTTPStatus
+from aiohttp import web
+from requester import Requester, HOST_LIMITS
+from schema import create_schema
+import popularity
+import init_db
+import functools
+import argparse
+import resource
+import tempfile
+import asyncio
+import sqlite3
+import random
+import socket
+import json
+import time
+import os
+import re
+
+# Benchmark init_db and the popularity refresh against a local mock of the APIs they
+# fetch from, so their throughput can be measured without touching the real services.
+#
+# The mock server answers, for a synthetic population of people:
+#    query.wikidata.org:      SPARQL harvest queries (as CSV) and sitelinks queries.
+#    linkcount.toolforge.org: backlinks.
+#    wikimedia.org:           monthly pageviews.
+#    en.wikipedia.org:        title resolution, every title being its own page.
+# each after a random delay averaging the configured latency, and failing or throttling
+# a configured fraction of requests. Every request is sent to it by a Requester that
+# rewrites URLs to the mock server but keeps the real host's limiter.
+#
+# Each run is in a fresh process, working on a pop.db in a temporary directory, so its
+# peak RSS is its own. The mock server runs in the same process and event loop, so the
+# RSS and time reported include it.
+
+# Population sizes benchmarked by default.
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# Limits for every host while benchmarking, so the mock's latency is what limits
+# throughput instead of the politeness limits of the real APIs.
+BENCHMARK_LIMITS = (10000, 100)
+
+# Pipelines that can be benchmarked.
+PIPELINES = ['init_db', 'driver']
+
+# Return the (wd_id, wp_article, wd_sitelinks, birth_year) of synthetic person i.
+# Everything is derived from i, so the mock server and the pop.db seeded for a refresh
+# agree without sharing anything.
+def synthetic_person(i):
+    return ('Q{}'.format(i + 1), 'Person {}'.format(i + 1), 1 + i * 7919 % 300,
+            -500 + i * 104729 % 2525)
+
+# Return the index of the synthetic person with a wd_id or title, or None.
+def person_index(name, num_people):
+    res = re.fullmatch(r'(?:Q|Person[ _])(\d+)', name)
+    if not res or not 0 < int(res.group(1)) <= num_people:
+        return None
+
+    return int(res.group(1)) - 1
+
+# Mock of the APIs, serving requests to http://host:port/<real host>/<real path>.
+class MockServer:
+
+    # Input: num_people is the size of the synthetic population.
+    #
+    #        latency is the average seconds before answering a request.
+    #
+    #        error_rate is the fraction of requests failing with a 500.
+    #
+    #        throttle_rate is the fraction of requests throttled with a 429.
+    #
+    #        retry_after is the Retry-After of a 429 in seconds, or None to send none.
+    def __init__(self, num_people, latency=0, error_rate=0, throttle_rate=0, retry_after=None):
+        self.num_people = num_people
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(0)
+
+        # Number of responses, by (endpoint, status).
+        self.requests = Counter()
+
+        # People in the order harvest queries return them, most sitelinks first.
+        self.by_sitelinks = sorted(range(num_people), key=lambda i: -synthetic_person(i)[2])
+
+        self.app = web.Application()
+        self.app.router.add_get('/{host}/{path:.*}', self.handle)
+
+    # Answer a request, counting it under its endpoint.
+    async def handle(self, request):
+        host = request.match_info['host']
+        endpoints = {
+            'query.wikidata.org': ('sparql', self.sparql),
+            'linkcount.toolforge.org': ('linkcount', self.linkcount),
+            'wikimedia.org': ('pageviews', self.pageviews),
+            'en.wikipedia.org': ('wikipedia', self.wikipedia)
+        }
+        endpoint, handler = endpoints.get(host, (host, None))
+
+        if self.latency:
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.latency))
+
+        draw = self.rng.random()
+        if handler is None:
+            resp = web.Response(status=HTTPStatus.NOT_FOUND)
+        elif draw < self.throttle_rate:
+            headers = {} if self.retry_after is None else {'Retry-After': str(self.retry_after)}
+            resp = web.Response(status=HTTPStatus.TOO_MANY_REQUESTS, headers=headers)
+        elif draw < self.throttle_rate + self.error_rate:
+            resp = web.Response(status=HTTPStatus.INTERNAL_SERVER_ERROR)
+        else:
+            resp = handler(request)
+
+        self.requests[(endpoint, resp.status)] += 1
+        return resp
+
+    # Answer a SPARQL query: a harvest query for a range of birth years, as CSV, or a
+    # sitelinks query for the people it names, as JSON.
+    def sparql(self, request):
+        query = request.query.get('query', '')
+
+        if '?birthYear' in query:
+            start = re.search(r'\?birth >= "(-?\d+)-01-01"', query)
+            end = re.search(r'\?birth < "(-?\d+)-01-01"', query)
+            limit = int(re.search(r'LIMIT (\d+)', query).group(1))
+
+            lines = ['person,articleName,sitelinks,birthYear\r\n']
+            for i in self.by_sitelinks:
+                wd_id, wp_article, wd_sitelinks, birth_year = synthetic_person(i)
+
+                if ((start and birth_year < int(start.group(1)))
+                        or (end and birth_year >= int(end.group(1)))):
+                    continue
+
+                lines.append('http://www.wikidata.org/entity/{},{},{},{}\r\n'.format(
+                    wd_id, wp_article, wd_sitelinks, birth_year))
+                if len(lines) > limit:
+                    break
+
+            return web.Response(text=''.join(lines), content_type='text/csv')
+
+        bindings = []
+        for wd_id in re.findall(r'wd:(Q\d+)', query):
+            i = person_index(wd_id, self.num_people)
+            if i is not None:
+                bindings.append({
+                    'person': {'value': 'http://www.wikidata.org/entity/' + wd_id},
+                    'sitelinks': {'datatype': 'http://www.w3.org/2001/XMLSchema#integer',
+                                  'value': str(synthetic_person(i)[2])}
+                })
+
+        return web.json_response({'results': {'bindings': bindings}})
+
+    # Answer a linkcount request for a page's backlinks.
+    def linkcount(self, request):
+        i = person_index(request.query.get('page', ''), self.num_people)
+        if i is None:
+            return web.Response(status=HTTPStatus.NOT_FOUND)
+
+        return web.json_response({'wikilinks': {'all': i * 31 % 5000}})
+
+    # Answer a per-article request for monthly pageviews, with a month for every month
+    # between its start and end dates.
+    def pageviews(self, request):
+        res = re.search(r'/user/(.+)/monthly/(\d{8})/(\d{8})$', request.path)
+        i = person_index(res.group(1), self.num_people) if res else None
+        if i is None:
+            return web.Response(status=HTTPStatus.NOT_FOUND)
+
+        items = []
+        month = res.group(2)[:6] + '01'
+        while month <= res.group(3):
+            items.append({'timestamp': month + '00', 'views': i * 17 % 100000 + len(items)})
+            month = popularity.next_month(month)
+
+        if not items:
+            return web.Response(status=HTTPStatus.NOT_FOUND)
+
+        return web.json_response({'items': items})
+
+    # Answer a MediaWiki API query for pages by title.
+    def wikipedia(self, request):
+        pages = []
+        for title in request.query.get('titles', '').split('|'):
+            if person_index(title, self.num_people) is None:
+                pages.append({'title': title, 'missing': True})
+            else:
+                pages.append({'title': title, 'ns': 0})
+
+        return web.json_response({'query': {'pages': pages}})
+
+# Requester sending every request to the mock server instead, still limited per real
+# host.
+class MockRequester(Requester):
+
+    # Input: base_url is the mock server's URL.
+    #
+    #        host_limits, cache and metrics are as for Requester.
+    def __init__(self, base_url, host_limits=HOST_LIMITS, cache=None, metrics=None):
+        super().__init__(host_limits, cache, metrics)
+        self.base_url = base_url
+
+    # Return the URL on the mock server for a real URL.
+    def mock_url(self, url):
+        parts = urlsplit(url)
+        mock = '{}/{}{}'.format(self.base_url, parts.hostname, parts.path)
+
+        return mock + '?' + parts.query if parts.query else mock
+
+    # Return the real URL for a URL on the mock server.
+    def real_url(self, url):
+        return 'https://' + url[len(self.base_url) + 1:]
+
+    def host(self, url):
+        return super().host(self.real_url(url))
+
+    async def open(self, url, *args):
+        return await super().open(self.mock_url(url), *args)
+
+# Run a pipeline against a fresh MockServer and return its measurements. Runs in its own
+# process, from a temporary directory with its own pop.db.
+#
+# Input: pipeline is one of PIPELINES.
+#
+#        num_people is the size of the synthetic population.
+#
+#        options is a dictionary of the MockServer's keyword arguments, plus real_limits
+#        to keep the real APIs' HOST_LIMITS and shards, the number of processes a
+#        refresh fetches in, or None.
+async def run_pipeline(pipeline, num_people, options):
+    options = dict(options)
+    real_limits = options.pop('real_limits')
+    shards = options.pop('shards')
+
+    server = MockServer(num_people, **options)
+
+    runner = web.AppRunner(server.app, access_log=None)
+    await runner.setup()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    site = web.SockSite(runner, sock)
+    await site.start()
+
+    base_url = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+    host_limits = HOST_LIMITS if real_limits else {host: BENCHMARK_LIMITS for host in HOST_LIMITS}
+
+    # Sharded refreshes share out popularity's HOST_LIMITS, and hand the Requester
+    # class to their processes, so it has to be picklable.
+    init_db.Requester = functools.partial(MockRequester, base_url, host_limits=host_limits)
+    popularity.Requester = init_db.Requester
+    popularity.HOST_LIMITS = host_limits
+
+    con = sqlite3.connect('pop.db')
+
+    if pipeline == 'init_db':
+        # Take everyone, so the rows harvested grow with the population.
+        init_db.ERAS = [(start, end, num_people) for start, end, limit in init_db.ERAS]
+
+        start = time.perf_counter()
+        await init_db.init_db()
+        elapsed = time.perf_counter() - start
+
+        rows = con.execute('SELECT COUNT(*) FROM popularity').fetchone()[0]
+    else:
+        create_schema(con)
+        with con:
+            con.executemany('''
+                            INSERT INTO popularity (wd_id, wp_article, wd_sitelinks, birth_year)
+                            VALUES (?, ?, ?, ?)
+                            ''', map(synthetic_person, range(num_people)))
+
+        start = time.perf_counter()
+        await popularity.driver(shards=shards)
+        elapsed = time.perf_counter() - start
+
+        rows = con.execute('SELECT COUNT(*) FROM popularity WHERE wp_avgviews IS NOT NULL').fetchone()[0]
+
+    con.close()
+    await runner.cleanup()
+
+    return {
+        'pipeline': pipeline,
+        'people': num_people,
+        'rows': rows,
+        'secs': elapsed,
+        'rows_per_sec': rows / elapsed,
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'requests': [[endpoint, status, count]
+                     for (endpoint, status), count in sorted(server.requests.items())]
+    }
+
+# Run a pipeline as in run_pipeline, with its output thrown away. Runs in a worker
+# process.
+def benchmark(pipeline, num_people, options):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            return asyncio.run(run_pipeline(pipeline, num_people, options))
+
+# Print one run's measurements.
+def print_result(result):
+    print('{:8} {:>7} people: {:>7} rows in {:8.2f}s, {:8.1f} rows/s, peak RSS {:6.1f} MB'.format(
+        result['pipeline'], result['people'], result['rows'], result['secs'],
+        result['rows_per_sec'], result['peak_rss_mb']))
+
+    for endpoint, status, count in result['requests']:
+        print('    {:10} {} x {}'.format(endpoint, status, count))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark init_db and the popularity refresh against mock APIs.')
+    parser.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=PIPELINES,
+                        help='pipelines to benchmark (default: all)')
+    parser.add_argument('--people', nargs='+', type=int, default=DEFAULT_SIZES,
+                        help='population sizes to benchmark (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='average seconds the mock takes to answer (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests failing with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='fraction of requests throttled with a 429')
+    parser.add_argument('--retry-after', type=float,
+                        help='Retry-After seconds sent with a 429 (default: none)')
+    parser.add_argument('--shards', type=int,
+                        help='run the refresh sharded across this many processes')
+    parser.add_argument('--real-limits', action='store_true',
+                        help='keep the real APIs\' rate and concurrency limits')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the measurements to a JSON file')
+    args = parser.parse_args()
+
+    options = {'latency': args.latency, 'error_rate': args.error_rate,
+               'throttle_rate': args.throttle_rate, 'retry_after': args.retry_after,
+               'real_limits': args.real_limits, 'shards': args.shards}
+
+    results = []
+    for pipeline in args.pipelines:
+        for num_people in args.people:
+            # A fresh process for every run, so peak RSS isn't carried over.
+            with ProcessPoolExecutor(1) as pool:
+                result = pool.submit(benchmark, pipeline, num_people, options).result()
+
+            print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'run_at': datetime.now().isoformat(), 'options': options,
+                       'results': results}, f, indent=2)
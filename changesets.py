@@ -0,0 +1,102 @@
+from datetime import datetime
+
+# Sync the people harvested by init_db into pop.db, changing only what changed. The
+# harvested people are staged in a temporary table, synced, and compared with the
+# popularity table in SQL: new people are inserted, people whose article, sitelinks or
+# year of birth changed are updated, and people no longer harvested are deleted, along
+# with their pageviews, refresh journal and metric history. Everyone else, and every
+# metric already fetched, is left alone.
+#
+# Every change is recorded in the changesets table under the sync's run number, so a
+# refresh can fetch metrics only for the people that need them, and scores can be
+# recomputed only for the people that changed.
+
+# Columns of popularity that come from the harvest, compared to find updates.
+SYNCED_COLUMNS = ('wp_article', 'wd_sitelinks', 'birth_year')
+
+# Create the temporary table people are staged in for a sync.
+def create_synced(con):
+    con.execute('CREATE TEMP TABLE synced (wd_id PRIMARY KEY, wp_article, wd_sitelinks, birth_year)')
+
+# Apply the people staged in the synced table to popularity in one transaction,
+# recording every change as a new changeset. Returns the changeset's run number and a
+# dictionary of each kind of change to the number of people changed.
+#
+# Input: con is the sqlite3 Connection to pop.db, with the synced table filled.
+def sync_popularity(con):
+    synced_at = datetime.now().isoformat(timespec='seconds')
+
+    # Which columns of a person differ from their staged row, separated by commas.
+    changed_columns = ' || '.join("CASE WHEN synced.{0} IS NOT popularity.{0} THEN '{0},' ELSE '' END".format(column)
+                                  for column in SYNCED_COLUMNS)
+    any_changed = ' OR '.join('synced.{0} IS NOT popularity.{0}'.format(column)
+                              for column in SYNCED_COLUMNS)
+
+    # Subquery for the people of the changeset with a kind of change.
+    changed = 'SELECT wd_id FROM changesets WHERE run = ? AND change = ?'
+
+    with con:
+        run = con.execute('SELECT COALESCE(MAX(run), 0) + 1 FROM changesets').fetchone()[0]
+
+        # Work out the changeset first, then apply it.
+        con.execute('''
+                    INSERT INTO changesets (run, wd_id, change, synced_at)
+                    SELECT ?, wd_id, 'insert', ? FROM synced
+                    WHERE wd_id NOT IN (SELECT wd_id FROM popularity)
+                    ''', (run, synced_at))
+        con.execute('''
+                    INSERT INTO changesets (run, wd_id, change, columns, synced_at)
+                    SELECT ?, wd_id, 'update', rtrim({}, ','), ?
+                    FROM synced JOIN popularity USING (wd_id)
+                    WHERE {}
+                    '''.format(changed_columns, any_changed), (run, synced_at))
+        con.execute('''
+                    INSERT INTO changesets (run, wd_id, change, synced_at)
+                    SELECT ?, wd_id, 'delete', ? FROM popularity
+                    WHERE wd_id NOT IN (SELECT wd_id FROM synced)
+                    ''', (run, synced_at))
+
+        for table in ('popularity', 'pageviews', 'refresh_journal', 'metric_history'):
+            con.execute('DELETE FROM {} WHERE wd_id IN ({})'.format(table, changed), (run, 'delete'))
+
+        # A person whose article changed has their title resolved again.
+        con.execute('''
+                    UPDATE popularity SET
+                    wp_title = CASE WHEN popularity.wp_article IS synced.wp_article THEN wp_title END,
+                    wp_title_resolved_at = CASE WHEN popularity.wp_article IS synced.wp_article
+                                           THEN wp_title_resolved_at END,
+                    {}
+                    FROM synced WHERE synced.wd_id = popularity.wd_id
+                    AND popularity.wd_id IN ({})
+                    '''.format(', '.join('{0} = synced.{0}'.format(column) for column in SYNCED_COLUMNS),
+                               changed), (run, 'update'))
+
+        con.execute('''
+                    INSERT INTO popularity (wd_id, {0})
+                    SELECT wd_id, {0} FROM synced WHERE wd_id IN ({1})
+                    '''.format(', '.join(SYNCED_COLUMNS), changed), (run, 'insert'))
+
+        counts = dict(con.execute('SELECT change, COUNT(*) FROM changesets WHERE run = ? GROUP BY change',
+                                  (run,)).fetchall())
+
+    return run, counts
+
+# Return the run number of the latest changeset, or None if there has been no sync.
+def latest_changeset(con):
+    return con.execute('SELECT MAX(run) FROM changesets').fetchone()[0]
+
+# Return the subquery, and its parameters, for the wd_ids of a changeset that are
+# still in popularity.
+#
+# Input: run is the changeset's run number.
+#
+#        refetch only includes the people whose metrics need fetching again: the ones
+#        inserted, or whose article changed.
+def changed_query(run, refetch=False):
+    if refetch:
+        return ('''
+                SELECT wd_id FROM changesets WHERE run = ?
+                AND (change = 'insert' OR (change = 'update' AND ',' || columns || ',' LIKE '%,wp_article,%'))
+                ''', (run,))
+
+    return "SELECT wd_id FROM changesets WHERE run = ? AND change != 'delete'", (run,)
@@ -0,0 +1,238 @@
+from writer import METRIC_COLUMNS, MONTHLY_VIEWS
+from schema import create_schema
+from datetime import datetime, timedelta
+import numpy as np
+import argparse
+import sqlite3
+
+# Append-only history of every person's metrics, so trends can be found without
+# fetching anything again. Every refresh overwrites the metrics in popularity in place;
+# after a complete refresh of everyone, record_history appends the metrics it fetched
+# as a new run, noting which metrics the run has. Only the values that changed
+# since a person's last recorded value are stored, so a run of 12k people whose
+# backlinks mostly didn't move costs a few hundred rows, not 12k. Values are rounded
+# to whole numbers, which SQLite stores in as few bytes as they need, like a varint.
+#
+# A person's value at a run is the last one recorded at or before it. The readers load
+# every change for a metric in one query and find these for everyone at once with
+# NumPy, so growth rates are computed across all of pop.db in one pass. Runs come
+# whenever a refresh is run, so growth is scaled by the time between the runs read.
+
+# Metrics whose history is recorded.
+HISTORY_METRICS = METRIC_COLUMNS
+
+# Default number of days growth is measured over.
+GROWTH_DAYS = 30
+
+# Default number of people shown as trending.
+TRENDING_TOP = 20
+
+# Return the metrics with history a refresh fetching a list of metrics wrote, as
+# written by fetchers. Monthly pageviews write wp_avgviews.
+def written_metrics(fetched):
+    written = {'wp_avgviews' if metric == MONTHLY_VIEWS else metric for metric in fetched}
+
+    return [metric for metric in HISTORY_METRICS if metric in written]
+
+# Append the current value of each metric for everyone whose value changed since it
+# was last recorded, as a new run. People whose metric is NULL are left out. Returns
+# the run number and the number of values stored.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        metrics is the list of popularity columns to record.
+def record_history(con, metrics=HISTORY_METRICS):
+    recorded_at = datetime.now().isoformat(timespec='seconds')
+
+    # Query for the values of a metric that differ from the person's last recorded one.
+    # metric names are popularity columns, so they are safe to put in the query.
+    record_query = '''
+                   INSERT INTO metric_history (metric, wd_id, run, value)
+                   SELECT ?, wd_id, ?, ROUND({0}) FROM popularity
+                   WHERE {0} IS NOT NULL AND ROUND({0}) IS NOT
+                   (SELECT value FROM metric_history
+                    WHERE metric_history.metric = ? AND metric_history.wd_id = popularity.wd_id
+                    ORDER BY run DESC LIMIT 1)
+                   '''
+
+    for metric in metrics:
+        if metric not in HISTORY_METRICS:
+            raise RuntimeError(metric, 'is not a metric with history')
+
+    num_values = 0
+
+    with con:
+        run = con.execute('SELECT COALESCE(MAX(run), 0) + 1 FROM history_runs').fetchone()[0]
+        con.execute('INSERT INTO history_runs (run, recorded_at, metrics) VALUES (?, ?, ?)',
+                    (run, recorded_at, ','.join(metrics)))
+
+        for metric in metrics:
+            num_values += con.execute(record_query.format(metric), (metric, run, metric)).rowcount
+
+    return run, num_values
+
+# Return every change recorded for a metric up to a run, as NumPy arrays of the wd_ids,
+# their runs and values, sorted by wd_id then run, and an array of which person each
+# change is of, counting from 0 in wd_id order.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        metric is the metric to read.
+#
+#        until is the last run to read, or None for every run.
+def load_changes(con, metric, until=None):
+    rows = con.execute('''
+                       SELECT wd_id, run, value FROM metric_history
+                       WHERE metric = ? AND run <= ? ORDER BY wd_id, run
+                       ''', (metric, until if until is not None else 2**62)).fetchall()
+
+    wd_ids = np.array([row[0] for row in rows], dtype=object)
+    runs = np.array([row[1] for row in rows], dtype=np.int64)
+    values = np.array([row[2] for row in rows], dtype=float)
+
+    new_person = np.ones(len(rows), dtype=bool)
+    new_person[1:] = wd_ids[1:] != wd_ids[:-1]
+    person = np.cumsum(new_person) - 1
+
+    return wd_ids, runs, values, person
+
+# Return the wd_ids of everyone with history for a metric, and a matrix of each one's
+# value as of each of a list of runs, with a row per person and NaN before a person's
+# first recorded value.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        metric is the metric to read.
+#
+#        runs is a list of run numbers.
+def values_at(con, metric, runs):
+    wd_ids, change_runs, values, person = load_changes(con, metric, max(runs))
+
+    num_people = person[-1] + 1 if len(person) else 0
+    people = np.arange(num_people)
+
+    # Changes are sorted by (person, run), so the change in effect for a person at a run
+    # is the last one at or before it, found by binary search on one combined key.
+    stride = max(runs) + 1
+    keys = person * stride + change_runs
+
+    matrix = np.full((num_people, len(runs)), np.nan)
+    for column, run in enumerate(runs):
+        positions = np.searchsorted(keys, people * stride + run, side='right') - 1
+        found = positions >= 0
+        found[found] = person[positions[found]] == people[found]
+        matrix[found, column] = values[positions[found]]
+
+    # The first change of each person, for their wd_id.
+    return wd_ids[np.searchsorted(person, people)], matrix
+
+# Return the latest run that recorded a metric, the latest one recorded at least days
+# before it, and the number of days between the two, or None for all three if there
+# are no such runs.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        metric is the metric the runs must have recorded.
+#
+#        days is the least number of days between the runs.
+def runs_apart(con, metric, days):
+
+    # Query for the latest run that recorded the metric, up to a time.
+    runs_query = '''
+                 SELECT run, recorded_at FROM history_runs
+                 WHERE ',' || metrics || ',' LIKE ? AND recorded_at <= ?
+                 ORDER BY run DESC LIMIT 1
+                 '''
+    pattern = '%,{},%'.format(metric)
+
+    latest = con.execute(runs_query, (pattern, datetime.max.isoformat())).fetchone()
+    if latest is None:
+        return None, None, None
+
+    latest_at = datetime.fromisoformat(latest[1])
+    cutoff = (latest_at - timedelta(days=days)).isoformat(timespec='seconds')
+
+    earlier = con.execute(runs_query, (pattern, cutoff)).fetchone()
+    if earlier is None:
+        return None, None, None
+
+    elapsed = (latest_at - datetime.fromisoformat(earlier[1])) / timedelta(days=1)
+
+    return latest[0], earlier[0], elapsed
+
+# Return the wd_ids of everyone with history for a metric, their values at the start
+# and end of the last days days, and their growth over days days, as a fraction: 0.5
+# is 50% more. The runs read can be further apart than days, so the growth between
+# them is scaled to days at the same rate. Growth is NaN for people without a value,
+# or with none above 0, at the start.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        metric is the metric to read.
+#
+#        days is the number of days to measure growth over.
+def growth_rates(con, metric, days=GROWTH_DAYS):
+    latest, earlier, elapsed = runs_apart(con, metric, days)
+    if earlier is None:
+        raise RuntimeError('No history of', metric, 'from', days, 'days before the latest run')
+
+    wd_ids, matrix = values_at(con, metric, [earlier, latest])
+    start = matrix[:, 0]
+    end = matrix[:, 1]
+
+    growth = np.full(len(wd_ids), np.nan)
+    positive = start > 0
+    growth[positive] = (end[positive] / start[positive]) ** (days / elapsed) - 1
+
+    return wd_ids, start, end, growth
+
+# Print how many values the history stores, against storing every value of every run.
+def print_stats(con):
+    num_people = con.execute('SELECT COUNT(*) FROM popularity').fetchone()[0]
+
+    # Not every run records every metric.
+    for metric, num_values in con.execute('SELECT metric, COUNT(*) FROM metric_history GROUP BY metric').fetchall():
+        num_runs = con.execute("SELECT COUNT(*) FROM history_runs WHERE ',' || metrics || ',' LIKE ?",
+                               ('%,{},%'.format(metric),)).fetchone()[0]
+        print('{}: {} values over {} runs, {:.1%} of one per person per run'.format(
+            metric, num_values, num_runs, num_values / (num_runs * num_people) if num_people else 0))
+
+# Return a string argument as a number of days, which must be more than 0.
+def positive_days(value):
+    days = float(value)
+    if not days > 0:
+        raise argparse.ArgumentTypeError('must be more than 0 days')
+
+    return days
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and read the history of metrics in pop.db.')
+    parser.add_argument('--record', action='store_true',
+                        help='append the current metrics as a new run')
+    parser.add_argument('--trending', choices=HISTORY_METRICS,
+                        help='show the people this metric grew the most for')
+    parser.add_argument('--days', type=positive_days, default=GROWTH_DAYS,
+                        help='days to measure growth over (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=TRENDING_TOP,
+                        help='number of trending people to show (default: %(default)s)')
+    args = parser.parse_args()
+
+    con = sqlite3.connect("pop.db")
+    create_schema(con)
+
+    if args.record:
+        run, num_values = record_history(con)
+        print('Recorded run', run, 'with', num_values, 'changed values')
+
+    if args.trending:
+        wd_ids, start, end, growth = growth_rates(con, args.trending, args.days)
+
+        # NaN sorts last, so the people that grew the most come first.
+        for i in np.argsort(-growth, kind='stable')[:args.top]:
+            if np.isnan(growth[i]):
+                break
+            print('{} {:+.1%} ({:.0f} to {:.0f})'.format(wd_ids[i], growth[i], start[i], end[i]))
+    else:
+        print_stats(con)
+
+    con.close()
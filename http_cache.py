@@ -0,0 +1,199 @@
+from collections import namedtuple
+from urllib.parse import urlsplit, urlencode
+from requester import Response
+import hashlib
+import sqlite3
+import json
+import time
+
+# On-disk cache of API responses, kept in its own SQLite database next to pop.db.
+# Responses are stored under a hash of the request method, URL, parameters and the
+# Accept header, since the same URL can be asked for as JSON or as CSV. Each
+# endpoint has its own time to live, after which a response is revalidated with
+# If-None-Match/If-Modified-Since if the API gave us an ETag or Last-Modified, and
+# refetched otherwise. The least recently used responses are evicted once the cache
+# grows past its size limit.
+#
+# In offline mode nothing is ever requested: cached responses are served however old
+# they are, and anything not cached comes back as a 504, like an HTTP cache asked for
+# only-if-cached.
+
+# Where the cache is kept.
+CACHE_PATH = 'http_cache.db'
+
+# Number of seconds in a day.
+DAY = 24 * 60 * 60
+
+# Time to live for responses, by the start of the host and path they came from. The
+# longest matching prefix wins. Pageview URLs end on the first of the current month,
+# so they stay the same, and cached, for the whole month.
+CACHE_TTLS = {
+    'query.wikidata.org/sparql': DAY,
+    'wikimedia.org/api/rest_v1/metrics/pageviews': 30 * DAY,
+    'linkcount.toolforge.org': 7 * DAY,
+    'en.wikipedia.org/w/api.php': 7 * DAY
+}
+
+# Time to live for anything else.
+DEFAULT_TTL = DAY
+
+# Largest the cached bodies may grow to, in bytes, before evicting.
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Once over CACHE_MAX_BYTES, evict down to this fraction of it, so we don't evict on
+# every new response.
+EVICT_TO = 0.9
+
+# A cached response:
+#    response:      the Response, as first received.
+#    fresh:         whether it is still within its time to live.
+#    etag:          the ETag header it came with, or None.
+#    last_modified: the Last-Modified header it came with, or None.
+CachedResponse = namedtuple('CachedResponse', ['response', 'fresh', 'etag', 'last_modified'])
+
+class ResponseCache:
+
+    # Input: path is the SQLite database to keep the cache in.
+    #
+    #        ttls is a dictionary of host and path prefix to time to live, in seconds.
+    #
+    #        max_bytes is the most body bytes to keep before evicting.
+    #
+    #        offline serves only cached responses, never making a request.
+    def __init__(self, path=CACHE_PATH, ttls=CACHE_TTLS, max_bytes=CACHE_MAX_BYTES, offline=False):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        # It's only a cache, so trade durability for speed.
+        self.con = sqlite3.connect(path)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+
+        # Create the table of responses if it does not already exist, which contains:
+        #    key:         hash of the request method, URL, parameters and Accept.
+        #    url:         URL requested, for debugging.
+        #    status:      HTTP status code.
+        #    headers:     response headers, as a JSON object.
+        #    body:        response body.
+        #    size:        length of the body in bytes.
+        #    fetched_at:  when the response was last fetched or revalidated.
+        #    accessed_at: when the response was last served, for eviction.
+        self.con.execute('''
+                         CREATE TABLE IF NOT EXISTS responses
+                         (key PRIMARY KEY, url, status, headers, body, size,
+                         fetched_at, accessed_at)
+                         ''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.con.commit()
+
+        self.total_bytes = self.con.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    # Return the cache key for a request.
+    #
+    # Input: method, url, params and headers are the request's. Of the headers, only
+    #        Accept changes the key.
+    def key(self, method, url, params=None, headers=None):
+        canonical = method + ' ' + url
+        if params:
+            canonical += '?' + urlencode(sorted(params.items()))
+
+        accept = {name.lower(): value for name, value in (headers or {}).items()}.get('accept')
+        if accept:
+            canonical += ' Accept: ' + accept
+
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    # Return the time to live for responses from a URL.
+    def ttl(self, url):
+        parts = urlsplit(url)
+        where = parts.hostname + parts.path
+
+        best = None
+        for prefix in self.ttls:
+            if where.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+
+        return DEFAULT_TTL if best is None else self.ttls[best]
+
+    # Return the CachedResponse for a key, or None if it isn't cached.
+    #
+    # Input: key is from ResponseCache.key.
+    #
+    #        url is the URL requested, for its time to live.
+    def get(self, key, url):
+        row = self.con.execute('SELECT status, headers, body, fetched_at FROM responses WHERE key = ?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+
+        status, headers, body, fetched_at = row
+        headers = json.loads(headers)
+
+        # Header names may come back in any case.
+        validators = {name.lower(): value for name, value in headers.items()}
+
+        now = time.time()
+        with self.con:
+            self.con.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+
+        return CachedResponse(Response(status, headers, body),
+                              now - fetched_at < self.ttl(url),
+                              validators.get('etag'),
+                              validators.get('last-modified'))
+
+    # Return the conditional request headers to revalidate a CachedResponse with.
+    def conditional_headers(self, cached):
+        headers = {}
+
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+
+        return headers
+
+    # Mark a cached response as just fetched, after the API said it hasn't changed.
+    def revalidated(self, key):
+        with self.con:
+            self.con.execute('UPDATE responses SET fetched_at = ? WHERE key = ?', (time.time(), key))
+
+    # Store a Response under a key, evicting old responses if the cache is now too big.
+    def put(self, key, url, response):
+        size = len(response.text.encode())
+        now = time.time()
+
+        old = self.con.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, url, response.status, json.dumps(dict(response.headers)),
+                              response.text, size, now, now))
+
+        self.total_bytes += size - (old[0] if old else 0)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    # Delete the least recently served responses until the cache is down to EVICT_TO of
+    # its size limit.
+    def evict(self):
+        target = self.max_bytes * EVICT_TO
+
+        cur = self.con.execute('SELECT key, size FROM responses ORDER BY accessed_at')
+
+        keys = []
+        for key, size in cur:
+            if self.total_bytes <= target:
+                break
+
+            keys.append((key,))
+            self.total_bytes -= size
+
+        cur.close()
+
+        with self.con:
+            self.con.executemany('DELETE FROM responses WHERE key = ?', keys)
+
+    def close(self):
+        self.con.close()
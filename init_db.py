@@ -1,226 +1,416 @@
 import sqlite3
 import re
-import aiohttp
 import asyncio
-import functools
+import csv
+import argparse
+from http import HTTPStatus
+from requester import Requester, SPARQL_RETRY_STATUSES
+from http_cache import ResponseCache
+from schema import create_schema, ERAS
+from wikidata_dump import read_dump
+from metrics import Metrics
+from changesets import create_synced, sync_popularity
+from datetime import datetime
+import aiohttp
 
-async def init_db():
-    # Create our popularity database and populate it with People from Wikidata.
+# How far back from its upper bound an open-ended range is split.
+OPEN_SPLIT_YEARS = 500
 
-    con = sqlite3.connect("pop.db")
-    cur = con.cursor()
+# Most times an era is split in half before giving up on it.
+MAX_SPLIT_DEPTH = 10
 
-    # Create the table if it does not already exist, which contains:
-    #    wd_id (primary key): name on Wikidata, such as Q747.
-    #    wp_article:          artice name on English Wikipedia.
-    #    wd_sitelinks         number of sitelinks for a person's Wikidata page.
-    #    wp_backlinks:        the number of backlinks on English Wikipedia for this person.
-    #                         A backlink is a link to this Wikipedia page on another page.
-    #    wp_avgviews:         Average monthly views starting July 2015 for this
-    #                         English Wikipedia article.
-    #    google_search_num:   Number of Google Search results for this English Wikipedia
-    #                         article name.
-    cur.execute('''
-                CREATE TABLE IF NOT EXISTS popularity
-                (wd_id PRIMARY KEY, wp_article, wd_sitelinks, wp_backlinks,
-                wp_avgviews, google_search_num)
-                ''')
-
-    # Create a list of queries to perform that give us people with the most sitelinks
-    # on Wikidata. Because of the sheer number of people on Wikidata (10,039,180), some
-    # filtering needs to be done, because a vast, vast majority of them should not show
-    # up in Perdle. This would not make the game fun. The weighting I've come up with here
-    # (i.e., how many people from each time period) is subjective.
-
-    # This query gets the 1000 people on Wikidata with the most sitelinks born before
-    # 1500 and has a page on English Wikipedia. In my view, there are far fewer than 1000
-    # people on this list considered "common knowledge," but I will get 1000 just in case.
-    before_1500_query = '''
-    SELECT DISTINCT ?person ?articleName ?sitelinks
-    WHERE {
-        ?person wdt:P31 wd:Q5;
-                wdt:P569 ?birth;
-        FILTER (?birth < "1500-01-01"^^xsd:dateTime) .
-        ?person wikibase:sitelinks ?sitelinks .
-        ?article schema:about ?person .
-        ?article schema:isPartOf <https://en.wikipedia.org/>;
-        schema:name ?articleName .
-        SERVICE wikibase:label {
-            bd:serviceParam wikibase:language "en"
-        }
-    }
-    ORDER BY DESC(?sitelinks)
-    LIMIT 1000
-    '''
+# The endpoint kills queries after 60 seconds, so give up on a query a little after.
+SPARQL_TIMEOUT_SECS = 65
 
-    # The queries going forward (from 1500 - present) need to be split up to avoid timeouts
-    # and HTTP status code 500. This is especially true for the 20th century, where many many
-    # people reside on Wikidata.
+# Number of people parsed from a streaming SPARQL response before they are inserted.
+INSERT_CHUNK = 1000
 
-    # This formatted query is used to split up the people from c. 1500 - 1900.
-    formatted_1500_1900_query = '''
-    SELECT DISTINCT ?person ?articleName ?sitelinks
-    WHERE {{
-        ?person wdt:P31 wd:Q5;
-                wdt:P569 ?birth;
-        FILTER (?birth >= "{}-01-01"^^xsd:dateTime && ?birth < "{}-01-01"^^xsd:dateTime) .
-        ?person wikibase:sitelinks ?sitelinks .
-        ?article schema:about ?person .
-        ?article schema:isPartOf <https://en.wikipedia.org/>;
-        schema:name ?articleName .
-        SERVICE wikibase:label {{
-            bd:serviceParam wikibase:language "en"
-        }}
-    }}
-    ORDER BY DESC(?sitelinks)
-    LIMIT 375
-    '''
+# Create our popularity database and populate it with People from Wikidata.
+#
+# Input: cache is a ResponseCache for the Requester, or None to always query.
+#
+#        metrics is a Metrics to record the harvest in, showing its progress, or None.
+#
+#        sync updates pop.db to match the harvest, as in changesets.sync_popularity,
+#        once every era is harvested, instead of only inserting people not already in it.
+async def init_db(cache=None, metrics=None, sync=False):
 
-    # Generate a list of queries for each part of the century, as outlined above.
-    query_1500_1900_list = get_formatted_query_list(formatted_1500_1900_query, 1500, 1900, 25)
+    con = sqlite3.connect("pop.db")
+    cur = con.cursor()
 
-    # This query is used to split up people born between c. 1900 - 2000, because this query
-    # altogether (for all 5000 people) consistently timed out.
-    formatted_1900s_query = '''
-    SELECT DISTINCT ?person ?articleName ?sitelinks
-    WHERE {{
-        ?person wdt:P31 wd:Q5;
-                wdt:P569 ?birth;
-        FILTER (?birth >= "{}-01-01"^^xsd:dateTime && ?birth < "{}-01-01"^^xsd:dateTime) .
-        ?person wikibase:sitelinks ?sitelinks .
-        ?article schema:about ?person .
-        ?article schema:isPartOf <https://en.wikipedia.org/>;
-        schema:name ?articleName .
-        SERVICE wikibase:label {{
-            bd:serviceParam wikibase:language "en"
-        }}
-    }}
-    ORDER BY DESC(?sitelinks)
-    LIMIT 250
-    '''
+    # Create the popularity table, and the rest of the schema, if it does not already
+    # exist.
+    create_schema(con)
+
+    # People are staged in a temporary table as they stream in from each query, and an
+    # era's top LIMIT people are moved into popularity once the era is harvested, so
+    # results are never held in memory.
+    cur.execute('CREATE TEMP TABLE harvest (era, wd_id, wp_article, wd_sitelinks, birth_year)')
+
+    # When syncing, each era's top people are moved into the synced table instead.
+    if sync:
+        create_synced(con)
+    table = 'synced' if sync else 'popularity'
+
+    # Harvest the people with the most sitelinks on Wikidata from each era. Because of
+    # the sheer number of people on Wikidata (10,039,180), some filtering needs to be
+    # done, because a vast, vast majority of them should not show up in Perdle. This
+    # would not make the game fun. The weighting I've come up with in ERAS (i.e., how
+    # many people from each time period) is subjective.
+    #
+    # Asynchronously harvest each era and INSERT the results into our SQLite database.
+    # How many queries run at once is up to the Requester.
+    if metrics is not None:
+        metrics.start_progress()
 
-    # Generate a list of queries for each part of the century, as outlined above.
-    query_1900s_list = get_formatted_query_list(formatted_1900s_query, 1900, 2000, 5)
+    async with Requester(cache=cache, metrics=metrics) as requester:
+        # Create a task for every era.
+        tasks = []
 
-    # This query is the same as between_1800_1900_query, but it goes from c. 2000 - present and
-    # only gets 250 people. In my opinion, this category is too new to have a lot of entries.
-    after_2000_query = '''
-    SELECT DISTINCT ?person ?articleName ?sitelinks
-    WHERE {
-        ?person wdt:P31 wd:Q5;
-                wdt:P569 ?birth;
-        FILTER (?birth >= "2000-01-01"^^xsd:dateTime) .
-        ?person wikibase:sitelinks ?sitelinks .
-        ?article schema:about ?person .
-        ?article schema:isPartOf <https://en.wikipedia.org/>;
-        schema:name ?articleName .
-        SERVICE wikibase:label {
-            bd:serviceParam wikibase:language "en"
-        }
-    }
-    ORDER BY DESC(?sitelinks)
-    LIMIT 250
-    '''
+        for era, (start, end, limit) in enumerate(ERAS):
+            tasks.append(asyncio.ensure_future(harvest_era(requester, con, era, start, end, limit,
+                                                           metrics, table)))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if metrics is not None:
+                metrics.stop_progress()
 
-    query_list = [before_1500_query, after_2000_query] + query_1900s_list + query_1500_1900_list
+    # Only sync once every era has been harvested, or the people of an era that failed
+    # would be deleted.
+    if sync:
+        print_sync(*sync_popularity(con))
+
+    con.close()
+    return
 
-    # Create a query to insert a row for each person in the SPARQL query.
+# Harvest an era's top LIMIT people into popularity, committing as soon as the era is
+# done.
+#
+# Input: requester is the Requester to query through.
+#
+#        con is the sqlite3 Connection to pop.db, with the temporary harvest table.
+#
+#        era is the index of the era in ERAS.
+#
+#        start, end and limit are the era's from ERAS.
+#
+#        metrics is a Metrics to count the people harvested and inserted in, or None.
+#
+#        table is the table to move the era's top people into.
+async def harvest_era(requester, con, era, start, end, limit, metrics=None, table='popularity'):
+
+    # Query to stage people from a SPARQL query.
+    staging_query = 'INSERT INTO harvest VALUES (?, ?, ?, ?, ?)'
+
+    def store(people):
+        con.executemany(staging_query, [(era,) + person for person in people])
+
+        if metrics is not None:
+            metrics.advance(len(people))
+
+    await harvest_range(requester, store, start, end, limit)
+
+    inserted = select_era(con, era, limit, table)
+
+    if metrics is not None:
+        metrics.written(table, inserted)
+
+# Move an era's top limit staged people into popularity (or the synced table) and
+# clear them from the harvest table, in one transaction. Returns the number of people
+# inserted.
+#
+# Input: con is the sqlite3 Connection to pop.db, with the temporary harvest table.
+#
+#        era is the index of the era in ERAS.
+#
+#        limit is the number of people to keep.
+#
+#        table is the table to insert them into, popularity or synced.
+def select_era(con, era, limit, table='popularity'):
+
+    # Query to insert the era's top people, each only once, into popularity.
     #
     # NOTE: Some historical figures don't have exact birth dates. If these
-    #       birth dates span across queries (for example Meera,
+    #       birth dates span across eras (for example Meera,
     #       https://www.wikidata.org/wiki/Q466330, has a birth date of
     #       1498 and 1504), then a sqlite3.IntegrityError is raised.
     #       Just ignore on conflict.
     insert_query = '''
-                   INSERT OR IGNORE INTO popularity (wd_id, wp_article, wd_sitelinks)
-                   VALUES(?, ?, ?)
-                   '''
-
-    # Asynchronously perform each SPARQL query and INSERT the results into our
-    # SQLite database.
-    my_conn = aiohttp.TCPConnector(limit=20)
-    async with aiohttp.ClientSession(connector=my_conn) as session:
-        # Create a task for every query.
-        tasks = []
-
-        for query in query_list:
-            tasks.append(asyncio.ensure_future(wd_sparql_query(session, query)))
-
-        query_results = await asyncio.gather(*tasks)
-
-        # Combine these results into one list.
-        flattened_results = functools.reduce(lambda a,b:a+b, query_results)
-
-        # Add these items to our database.
-        cur.executemany(insert_query, flattened_results)
-
-    con.commit()
-    con.close()
-    return
-
-# Routine to perform the GET request on the SPARQL endpoint asynchronously.
-async def wd_sparql_query(session, query):
-
-    # Define the header and parameters for upcoming GET request.
-    url = 'https://query.wikidata.org/sparql'
-    wiki_params = {'format': 'json', 'query': query}
-
-    # Perform the GET request for our query and loop through the results, returning
-    # a tuple of all Wikidata entity names, Wikipedia article names, and number of
-    # Wiki sitelinks.
-    tuple_list = []
+                   INSERT OR IGNORE INTO {} (wd_id, wp_article, wd_sitelinks, birth_year)
+                   SELECT wd_id, wp_article, MAX(wd_sitelinks) AS most_sitelinks, birth_year
+                   FROM harvest WHERE era = ?
+                   GROUP BY wd_id ORDER BY most_sitelinks DESC LIMIT ?
+                   '''.format(table)
+
+    with con:
+        inserted = con.execute(insert_query, (era, limit)).rowcount
+        con.execute('DELETE FROM harvest WHERE era = ?', (era,))
+
+    return inserted
+
+# Create our popularity database and populate it with people from a Wikidata entity
+# dump instead of SPARQL queries. Every human in the dump with an English Wikipedia
+# article and a date of birth is staged, and each era's top LIMIT people by sitelinks
+# are picked from all of them, so no era is cut short by a query timing out.
+#
+# Input: path is the dump file, read as in wikidata_dump.
+#
+#        processes is the number of worker processes parsing it.
+#
+#        sync updates pop.db to match the dump, as in init_db.
+def init_db_from_dump(path, processes=None, sync=False):
 
-    async with session.get(url, params=wiki_params) as resp:
-        try:
-            query_results = await resp.json()
-        except Exception as e:
-            print(query)
-            raise e
-        for result in query_results['results']['bindings']:
-            # Extract the Wikidata entity ID from the link.
-            res = re.match(r'http://www\.wikidata\.org/entity/(Q.*)', result['person']['value'])
-            if not res or not res.group(1):
-                # Move on
-                continue
-
-            wd_id = res.group(1)
+    con = sqlite3.connect("pop.db")
 
-            # Get the article name from the JSON response.
-            wp_article = result['articleName']['value']
+    create_schema(con)
 
-            # Get the number of sitelinks from the JSON response. If the response we got was not
-            # an integer, something is wrong and this script must be changed.
-            if result['sitelinks']['datatype'] != 'http://www.w3.org/2001/XMLSchema#integer':
-                raise RuntimeError('Sitelinks data type is not an integer:',
-                                    result['sitelinks']['datatype'])
+    con.execute('CREATE TEMP TABLE harvest (era, wd_id, wp_article, wd_sitelinks, birth_year)')
 
-            wd_sitelinks = int(result['sitelinks']['value'])
+    if sync:
+        create_synced(con)
+    table = 'synced' if sync else 'popularity'
 
-            tuple_list.append((wd_id, wp_article, wd_sitelinks))
+    staged = 0
 
-    # Return the list of all (wd_id, wp_article, wd_sitelinks) tuples from this query.
-    return tuple_list
+    for people in read_dump(path, processes):
+        with con:
+            con.executemany('INSERT INTO harvest VALUES (?, ?, ?, ?, ?)',
+                            [(birth_era(person[3]),) + person for person in people])
 
-# Return a list of queries from a formatted query, giving ranges of time, such
-# as c. 1900 - 1905, ... c. 1995 - 2000. This only works, however, if the step
-# is divisible by the amount of time being covered. Otherwise you won't get
-# enough queries.
-def get_formatted_query_list(formatted_query, start, end, step):
+        staged += len(people)
+        print('Staged', staged, 'people')
 
-    # Make sure we got the correct input.
-    if ((end - start) % step) != 0:
-        raise RuntimeError('Invalid year range provided!')
+    for era, (start, end, limit) in enumerate(ERAS):
+        select_era(con, era, limit, table)
 
-    # Generate a list of queries for each part of the range provided.
-    query_list = []
+    if sync:
+        print_sync(*sync_popularity(con))
 
-    # Year in the most recent query.
-    last_year_in_query = start
+    con.close()
 
-    for i in range(start+step, end+1, step):
-        query_list.append(formatted_query.format(last_year_in_query, i))
-        last_year_in_query = i
+# Print the changes a sync made.
+def print_sync(run, counts):
+    print('Synced changeset', run, '-', counts.get('insert', 0), 'inserted,',
+          counts.get('update', 0), 'updated,', counts.get('delete', 0), 'deleted')
+
+# Return the index in ERAS of the era a year of birth is in.
+def birth_era(year):
+    for era, (start, end, limit) in enumerate(ERAS):
+        if (start is None or year >= start) and (end is None or year < end):
+            return era
+
+# Return the query for the people born in a range of years with the most sitelinks
+# who have a page on English Wikipedia, with their (earliest) year of birth.
+#
+# Input: start is the first year of the range, or None for no lower bound.
+#
+#        end is the year after the range, or None for no upper bound.
+#
+#        limit is the number of people to return.
+def harvest_query(start, end, limit):
+
+    query = '''
+    SELECT ?person ?articleName ?sitelinks (MIN(YEAR(?birth)) AS ?birthYear)
+    WHERE {{
+        ?person wdt:P31 wd:Q5;
+                wdt:P569 ?birth;
+        FILTER ({}) .
+        ?person wikibase:sitelinks ?sitelinks .
+        ?article schema:about ?person .
+        ?article schema:isPartOf <https://en.wikipedia.org/>;
+        schema:name ?articleName .
+        SERVICE wikibase:label {{
+            bd:serviceParam wikibase:language "en"
+        }}
+    }}
+    GROUP BY ?person ?articleName ?sitelinks
+    ORDER BY DESC(?sitelinks)
+    LIMIT {}
+    '''
 
-    return query_list
+    birth_filters = []
+    if start is not None:
+        birth_filters.append('?birth >= "{}-01-01"^^xsd:dateTime'.format(xsd_year(start)))
+    if end is not None:
+        birth_filters.append('?birth < "{}-01-01"^^xsd:dateTime'.format(xsd_year(end)))
+
+    return query.format(' && '.join(birth_filters), limit)
+
+# Return a year the way xsd:dateTime writes it: at least four digits, with a minus
+# sign for years BCE.
+def xsd_year(year):
+    return '{}{:04d}'.format('-' if year < 0 else '', abs(year))
+
+# Return the year to split a range of years in half at. Open-ended ranges are split
+# OPEN_SPLIT_YEARS from their bound before the far end, or before this year.
+def split_year(start, end):
+    if start is None:
+        return end - OPEN_SPLIT_YEARS
+    if end is None:
+        end = datetime.today().year + 1
+
+    return (start + end) // 2
+
+# Harvest the limit people born in a range of years with the most sitelinks, handing
+# them to store as they arrive. The whole range is tried in one query first. If that
+# times out or fails, the range is split in half and both halves are harvested
+# concurrently the same way, so ranges only get as small as the endpoint needs them to
+# be. Between them, the stored people always include the range's true top limit
+# people: each query returns people in order of sitelinks, so even the people from a
+# query that was cut off are the top people of its range.
+#
+# Input: requester is the Requester to query through.
+#
+#        store is a function taking a list of (wd_id, wp_article, wd_sitelinks,
+#        birth_year) tuples.
+#
+#        start is the first year of the range, or None for no lower bound.
+#
+#        end is the year after the range, or None for no upper bound.
+#
+#        limit is the number of people to return.
+#
+#        depth is the number of times the era has been split to get this range.
+async def harvest_range(requester, store, start, end, limit, depth=0):
+
+    if await wd_sparql_query(requester, harvest_query(start, end, limit), store):
+        return
+
+    # Don't split below a year, or forever, something else is wrong.
+    mid = split_year(start, end)
+    if ((start is not None and mid <= start) or (end is not None and mid >= end)
+            or depth >= MAX_SPLIT_DEPTH):
+        raise RuntimeError('SPARQL query failed for birth years:', start, end)
+
+    print('Splitting', start, '-', end, 'at', mid)
+
+    await asyncio.gather(harvest_range(requester, store, start, mid, limit, depth + 1),
+                         harvest_range(requester, store, mid, end, limit, depth + 1))
+
+# Routine to perform the GET request on the SPARQL endpoint asynchronously, through
+# a Requester. The results are asked for as CSV and parsed a line at a time as they
+# arrive, handing every INSERT_CHUNK people to store, so memory doesn't grow with the
+# size of the results. Returns whether the query succeeded: if it times out, fails or
+# is cut off, it returns False so the caller can ask for less.
+#
+# Input: requester is the Requester to query through.
+#
+#        query is the SPARQL query, selecting ?person ?articleName ?sitelinks
+#        ?birthYear.
+#
+#        store is a function taking a list of (wd_id, wp_article, wd_sitelinks,
+#        birth_year) tuples.
+async def wd_sparql_query(requester, query, store):
 
-asyncio.run(init_db())
\ No newline at end of file
+    # Define the header and parameters for upcoming GET request.
+    url = 'https://query.wikidata.org/sparql'
+    wiki_params = {'query': query}
+    req_headers = {'Accept': 'text/csv'}
+
+    timeout = aiohttp.ClientTimeout(total=SPARQL_TIMEOUT_SECS)
+
+    people = []
+
+    try:
+        async with requester.stream(url, params=wiki_params, headers=req_headers,
+                                    timeout=timeout, retry_statuses=SPARQL_RETRY_STATUSES,
+                                    retry_timeouts=False) as resp:
+
+            # Timed out queries come back as a 5xx with a Java stack trace instead of
+            # results, as do queries still throttled after retrying.
+            if resp.status != HTTPStatus.OK:
+                return False
+
+            header = True
+
+            async for line in resp.lines:
+                # A line without a newline means the response was cut off.
+                if not line.endswith('\n'):
+                    return False
+
+                # Skip the line of column names.
+                if header:
+                    header = False
+                    continue
+
+                person = parse_person(line)
+                if person is None:
+                    continue
+
+                people.append(person)
+
+                if len(people) >= INSERT_CHUNK:
+                    store(people)
+                    people = []
+    except (asyncio.TimeoutError, aiohttp.ClientPayloadError):
+        return False
+    finally:
+        # Whatever arrived is still the top people of the range.
+        if people:
+            store(people)
+
+    return True
+
+# Return a (wd_id, wp_article, wd_sitelinks, birth_year) tuple from a line of SPARQL
+# CSV results, or None if the line isn't a person.
+def parse_person(line):
+    person, wp_article, sitelinks, birth_year = next(csv.reader([line]))
+
+    # Extract the Wikidata entity ID from the link.
+    res = re.match(r'http://www\.wikidata\.org/entity/(Q.*)', person)
+    if not res or not res.group(1):
+        # Move on
+        return None
+
+    wd_id = res.group(1)
+
+    # Get the number of sitelinks. If it is not an integer, something is wrong and
+    # this script must be changed.
+    try:
+        wd_sitelinks = int(sitelinks)
+    except ValueError:
+        raise RuntimeError('Sitelinks is not an integer:', sitelinks)
+
+    # Some birth dates are too imprecise to have a year.
+    try:
+        birth_year = int(birth_year)
+    except ValueError:
+        birth_year = None
+
+    return (wd_id, wp_article, wd_sitelinks, birth_year)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create pop.db and populate it with people from Wikidata.')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve and store SPARQL responses in the on-disk response cache')
+    parser.add_argument('--offline', action='store_true',
+                        help='serve only cached SPARQL responses, never making a request')
+    parser.add_argument('--dump', metavar='FILE',
+                        help='read people from a Wikidata entity dump instead of SPARQL')
+    parser.add_argument('--processes', type=int,
+                        help='number of processes parsing the dump (default: one per CPU)')
+    parser.add_argument('--sync', action='store_true',
+                        help='update pop.db to match the harvest, inserting, updating and '
+                             'deleting people, and record the changes as a changeset')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write request metrics to FILE once done, in the Prometheus '
+                             'text format if it ends in .prom, otherwise JSON')
+    args = parser.parse_args()
+
+    if args.dump:
+        init_db_from_dump(args.dump, args.processes, args.sync)
+    else:
+        cache = None
+        if args.cache or args.offline:
+            cache = ResponseCache(offline=args.offline)
+
+        metrics = Metrics()
+        asyncio.run(init_db(cache, metrics, args.sync))
+
+        if cache is not None:
+            cache.close()
+
+        if args.metrics:
+            metrics.dump(args.metrics)
@@ -0,0 +1,212 @@
+from collections import Counter
+from urllib.parse import urlsplit
+from datetime import date, timedelta
+import subprocess
+import argparse
+import asyncio
+import sqlite3
+import random
+import time
+import sys
+import os
+
+# Load test for server.py. A number of connections each send GET requests one after
+# another over HTTP/1.1 keep-alive for a fixed time, and the requests per second, the
+# latency percentiles and the count of each status are printed.
+#
+# Requests are a mix of person lookups, daily picks and comparisons, for people and
+# days drawn with a bias towards a few of them, the way players ask about the same day
+# and the same famous guesses. With --etag, a connection sends back the ETag it got for
+# a path, as a browser would, and is answered 304 Not Modified.
+#
+# The client writes requests and reads responses with asyncio streams rather than an
+# HTTP client library, so that it takes as little of the CPU as it can: with --start,
+# the server runs on the same machine, and on one core the two share it.
+
+# Default number of concurrent connections.
+CONNECTIONS = 50
+
+# Default seconds to send requests for.
+DURATION_SECS = 10
+
+# Share of requests for each endpoint.
+MIX = [('person', 0.6), ('daily', 0.2), ('compare', 0.2)]
+
+# Number of people, the most popular first, and of days back from today, requests are
+# drawn from.
+NUM_PEOPLE = 2000
+NUM_DAYS = 30
+
+# Seconds to wait for a server started with --start to accept connections.
+START_SECS = 10
+
+# Return a list of paths to request, in random order, drawn from the people in pop.db.
+#
+# Input: num_paths is the number of paths.
+#
+#        rng is a random.Random.
+def request_paths(num_paths, rng):
+    con = sqlite3.connect('file:pop.db?mode=ro', uri=True)
+    wd_ids = [row[0] for row in con.execute('SELECT wd_id FROM popularity ORDER BY score DESC LIMIT ?',
+                                            (NUM_PEOPLE,))]
+    con.close()
+
+    if not wd_ids:
+        raise RuntimeError('pop.db has nobody to request')
+
+    # Zipf-like: the ith person or day is drawn with weight 1 / (i + 1).
+    person_weights = [1 / (i + 1) for i in range(len(wd_ids))]
+    days = [(date.today() - timedelta(days=i)).isoformat() for i in range(NUM_DAYS)]
+    day_weights = [1 / (i + 1) for i in range(NUM_DAYS)]
+
+    endpoints = rng.choices([endpoint for endpoint, share in MIX], [share for endpoint, share in MIX],
+                            k=num_paths)
+    people = rng.choices(wd_ids, person_weights, k=num_paths)
+    dates = rng.choices(days, day_weights, k=num_paths)
+
+    paths = []
+    for endpoint, wd_id, day in zip(endpoints, people, dates):
+        if endpoint == 'person':
+            paths.append('/person/' + wd_id)
+        elif endpoint == 'daily':
+            paths.append('/daily?date=' + day)
+        else:
+            paths.append('/compare?guess={}&date={}'.format(wd_id, day))
+
+    return paths
+
+# Send requests over one connection until deadline, recording each one's latency and
+# status.
+#
+# Input: host and port are the server's.
+#
+#        paths is the list of paths to request, taken in turn from a random start.
+#
+#        deadline is the time.monotonic() to stop at.
+#
+#        etag sends the ETag last received for a path in If-None-Match.
+#
+#        latencies is a list to append each request's seconds to.
+#
+#        statuses is a Counter of the responses' statuses.
+async def connection(host, port, paths, deadline, etag, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    etags = {}
+    i = random.randrange(len(paths))
+
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+
+        request = 'GET {} HTTP/1.1\r\nHost: {}\r\n'.format(path, host)
+        if etag and path in etags:
+            request += 'If-None-Match: {}\r\n'.format(etags[path])
+
+        start = time.perf_counter()
+
+        writer.write(request.encode() + b'\r\n')
+
+        # Every response has a Content-Length, even if it is 0.
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'etag':
+                etags[path] = value.strip()
+
+        await reader.readexactly(length)
+
+        latencies.append(time.perf_counter() - start)
+        statuses[int(lines[0].split(' ')[1])] += 1
+
+    writer.close()
+    await writer.wait_closed()
+
+# Load test a server for duration_secs, printing what it managed.
+#
+# Input: url is the server's base URL.
+#
+#        connections is the number of concurrent connections.
+#
+#        duration_secs is the number of seconds to send requests for.
+#
+#        etag sends back each path's ETag, as in connection.
+async def load_test(url, connections=CONNECTIONS, duration_secs=DURATION_SECS, etag=False):
+    parts = urlsplit(url)
+    paths = request_paths(100000, random.Random(0))
+
+    latencies = []
+    statuses = Counter()
+
+    start = time.monotonic()
+    await asyncio.gather(*[connection(parts.hostname, parts.port or 80, paths, start + duration_secs,
+                                      etag, latencies, statuses)
+                           for i in range(connections)])
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+    print('{} requests in {:.1f}s, {:.0f} requests/s'.format(len(latencies), elapsed,
+                                                              len(latencies) / elapsed))
+    if latencies:
+        print('latency ms: p50 {:.2f}, p90 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+            percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1] * 1000))
+    print('statuses:', ', '.join('{} x {}'.format(status, count) for status, count in sorted(statuses.items())))
+
+# Start server.py on a port and wait until it accepts connections. Returns its Popen.
+async def start_server(port):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    server = subprocess.Popen([sys.executable, server_path, '--port', str(port)],
+                              stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + START_SECS
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.terminate()
+                raise RuntimeError('server.py did not start on port', port)
+            await asyncio.sleep(0.1)
+            continue
+
+        writer.close()
+        await writer.wait_closed()
+        return server
+
+async def main(args):
+    server = None
+    if args.start:
+        server = await start_server(urlsplit(args.url).port)
+
+    try:
+        await load_test(args.url, args.connections, args.secs, args.etag)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test server.py.')
+    parser.add_argument('--url', default='http://127.0.0.1:8080',
+                        help='base URL of the server (default: %(default)s)')
+    parser.add_argument('--start', action='store_true',
+                        help='start server.py on the URL\'s port for the test, and stop it after')
+    parser.add_argument('--connections', type=int, default=CONNECTIONS,
+                        help='concurrent connections (default: %(default)s)')
+    parser.add_argument('--secs', type=float, default=DURATION_SECS,
+                        help='seconds to send requests for (default: %(default)s)')
+    parser.add_argument('--etag', action='store_true',
+                        help='send back the ETag of each path, getting 304 Not Modified')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
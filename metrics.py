@@ -0,0 +1,255 @@
+from collections import Counter
+import asyncio
+import bisect
+import json
+import time
+
+# Instrumentation for fetch runs. A Metrics is handed to the Requester, which records
+# every request to each host: how long until its response came back, its status (or the
+# exception it raised), retries, bytes received and how many requests are in flight. The
+# MetricWriter records the rows it writes, and the pipelines how many people they have
+# got through, which drives a progress line with an ETA. Once a run ends, everything is
+# dumped as JSON, or in the Prometheus text format for files ending in PROMETHEUS_SUFFIX.
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# How often the progress line is redrawn, in seconds.
+PROGRESS_SECS = 1
+
+# Metrics files ending in this are written in the Prometheus text format.
+PROMETHEUS_SUFFIX = '.prom'
+
+# Prefix of every metric name in the Prometheus text format.
+PROMETHEUS_PREFIX = 'perdle_'
+
+# Return a duration in seconds as H:MM:SS.
+def format_secs(secs):
+    secs = int(secs)
+    return '{}:{:02d}:{:02d}'.format(secs // 3600, secs // 60 % 60, secs % 60)
+
+# Return a Prometheus label set, such as {host="wikimedia.org"}.
+def prometheus_labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+# Histogram of observed values, counted in buckets by upper bound, the last bucket
+# having no upper bound.
+class Histogram:
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Return the cumulative (upper bound, count) of every bucket, as in Prometheus, with
+    # None as the upper bound of the last.
+    def cumulative(self):
+        buckets = []
+        total = 0
+
+        for bound, count in zip(self.bounds + [None], self.counts):
+            total += count
+            buckets.append((bound, total))
+
+        return buckets
+
+class Metrics:
+
+    def __init__(self):
+        self.started = time.monotonic()
+
+        # Per host: a latency Histogram, the number of responses by status, the number
+        # of retries, bytes received, and the requests in flight now and at most.
+        self.latency = {}
+        self.responses = Counter()
+        self.retries = Counter()
+        self.bytes_received = Counter()
+        self.in_flight = {}
+        self.peak_in_flight = {}
+
+        # Rows written to pop.db, by metric.
+        self.rows_written = Counter()
+
+        # Progress through the run: people (or rows) done, out of total if known.
+        self.done = 0
+        self.total = None
+        self.progress_task = None
+        self.progress_width = 0
+
+    # Record a request to a host, taking secs until its response arrived, with its HTTP
+    # status, or the name of the exception it raised.
+    def request(self, host, secs, status):
+        self.latency.setdefault(host, Histogram()).observe(secs)
+        self.responses[(host, status)] += 1
+
+    # Record a response served from the cache, without a request.
+    def cached(self, host):
+        self.responses[(host, 'cached')] += 1
+
+    def retry(self, host):
+        self.retries[host] += 1
+
+    def received(self, host, num_bytes):
+        self.bytes_received[host] += num_bytes
+
+    # Record the number of requests in flight to a host.
+    def set_in_flight(self, host, num_requests):
+        self.in_flight[host] = num_requests
+        self.peak_in_flight[host] = max(self.peak_in_flight.get(host, 0), num_requests)
+
+    def written(self, metric, num_rows):
+        self.rows_written[metric] += num_rows
+
+    # Record num people (or rows) got through.
+    def advance(self, num=1):
+        self.done += num
+
+    # Return the number of requests made, retries included.
+    def num_requests(self):
+        return sum(histogram.count for histogram in self.latency.values())
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    # Return the line showing progress so far.
+    def progress_line(self):
+        elapsed = self.elapsed()
+        rate = self.done / elapsed if elapsed else 0
+
+        if self.total:
+            parts = ['{}/{} ({:.1f}%)'.format(self.done, self.total, 100 * self.done / self.total)]
+        else:
+            parts = [str(self.done)]
+
+        parts.append('{:.1f}/s'.format(rate))
+        parts.append('elapsed ' + format_secs(elapsed))
+
+        if self.total and rate:
+            parts.append('ETA ' + format_secs(max(0, self.total - self.done) / rate))
+
+        in_flight = ' '.join('{}={}'.format(host, num) for host, num in sorted(self.in_flight.items()))
+        if in_flight:
+            parts.append('in flight: ' + in_flight)
+
+        retries = sum(self.retries.values())
+        if retries:
+            parts.append('retries: {}'.format(retries))
+
+        return ' | '.join(parts)
+
+    # Draw the progress line over the last one, ending it with end.
+    def draw_progress(self, end=''):
+        line = self.progress_line()
+        print('\r' + line.ljust(self.progress_width), end=end, flush=True)
+        self.progress_width = len(line)
+
+    # Redraw the progress line every PROGRESS_SECS until cancelled.
+    async def show_progress(self):
+        while True:
+            self.draw_progress()
+            await asyncio.sleep(PROGRESS_SECS)
+
+    # Start showing a progress line, out of total people (or rows) if known.
+    def start_progress(self, total=None):
+        self.total = total
+        self.progress_task = asyncio.ensure_future(self.show_progress())
+
+    # Stop showing the progress line, leaving it at its final state.
+    def stop_progress(self):
+        if self.progress_task is not None:
+            self.progress_task.cancel()
+            self.progress_task = None
+            self.draw_progress('\n')
+
+    # Return every metric as a dictionary, ready for JSON.
+    def as_dict(self):
+        elapsed = self.elapsed()
+
+        hosts = {}
+        for host in {host for host, status in self.responses} | set(self.peak_in_flight):
+            histogram = self.latency.get(host, Histogram())
+            hosts[host] = {
+                'requests': histogram.count,
+                'latency_sum_secs': histogram.sum,
+                'latency_buckets': [['+Inf' if bound is None else bound, count]
+                                    for bound, count in histogram.cumulative()],
+                'responses': {str(status): count for (response_host, status), count
+                              in self.responses.items() if response_host == host},
+                'retries': self.retries[host],
+                'bytes_received': self.bytes_received[host],
+                'peak_in_flight': self.peak_in_flight.get(host, 0)
+            }
+
+        rows_written = sum(self.rows_written.values())
+
+        return {
+            'elapsed_secs': elapsed,
+            'done': self.done,
+            'total': self.total,
+            'hosts': hosts,
+            'rows_written': dict(self.rows_written),
+            'rows_written_per_sec': rows_written / elapsed if elapsed else 0
+        }
+
+    # Return every metric in the Prometheus text format.
+    def prometheus(self):
+        lines = []
+
+        def metric(name, type, help, samples):
+            lines.append('# HELP {}{} {}'.format(PROMETHEUS_PREFIX, name, help))
+            lines.append('# TYPE {}{} {}'.format(PROMETHEUS_PREFIX, name, type))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{}{} {}'.format(PROMETHEUS_PREFIX, name, suffix, labels, value))
+
+        samples = []
+        for host, histogram in sorted(self.latency.items()):
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound is None else bound
+                samples.append(('_bucket', prometheus_labels(host=host, le=le), count))
+            samples.append(('_sum', prometheus_labels(host=host), histogram.sum))
+            samples.append(('_count', prometheus_labels(host=host), histogram.count))
+        metric('request_duration_seconds', 'histogram',
+               'Seconds until the response to a request arrived.', samples)
+
+        metric('responses_total', 'counter', 'Responses by HTTP status, or exception.',
+               [('', prometheus_labels(host=host, status=status), count)
+                for (host, status), count in sorted(self.responses.items(), key=str)])
+
+        metric('retries_total', 'counter', 'Requests retried.',
+               [('', prometheus_labels(host=host), count)
+                for host, count in sorted(self.retries.items())])
+
+        metric('received_bytes_total', 'counter', 'Bytes of response bodies received.',
+               [('', prometheus_labels(host=host), count)
+                for host, count in sorted(self.bytes_received.items())])
+
+        metric('peak_in_flight', 'gauge', 'Most requests in flight at once.',
+               [('', prometheus_labels(host=host), count)
+                for host, count in sorted(self.peak_in_flight.items())])
+
+        metric('rows_written_total', 'counter', 'Rows written to pop.db.',
+               [('', prometheus_labels(metric=name), count)
+                for name, count in sorted(self.rows_written.items())])
+
+        elapsed = self.elapsed()
+        metric('elapsed_seconds', 'gauge', 'Seconds the run took.', [('', '', elapsed)])
+        metric('rows_written_per_second', 'gauge', 'Rows written to pop.db per second.',
+               [('', '', sum(self.rows_written.values()) / elapsed if elapsed else 0)])
+
+        return '\n'.join(lines) + '\n'
+
+    # Write every metric to a file, in the Prometheus text format if its name ends in
+    # PROMETHEUS_SUFFIX, otherwise as JSON.
+    def dump(self, path):
+        with open(path, 'w') as f:
+            if path.endswith(PROMETHEUS_SUFFIX):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.as_dict(), f, indent=2)
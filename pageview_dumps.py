@@ -0,0 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from writer import MetricWriter, MetricResult, MONTHLY_VIEWS
+from schema import create_schema
+from titles import FETCH_TITLE
+import gzip
+import bz2
+import os
+import re
+
+# Read monthly pageviews from Wikimedia's pageview dumps instead of asking the REST API
+# for every person. The dumps are the "pageview_complete" files, from
+#
+#    https://dumps.wikimedia.org/other/pageview_complete/
+#
+# named like pageviews-202301-user.bz2 (a month) or pageviews-20230101-user.bz2 (a
+# day), with a line per wiki, page and access method:
+#
+#    en.wikipedia Albert_Einstein 736 desktop 123456 A4012B3977...
+#
+# where the fifth field is the total views over the file's period. The -user files count
+# the same views as the REST API's user agent. Only English Wikipedia lines for titles
+# in pop.db are kept, and each file is decompressed and counted by its own process, so
+# refreshing views is a local, CPU-bound job. The totals are stored in the pageviews
+# table like the REST API's, and wp_avgviews derived from every month stored.
+#
+# Every file for a month has to be read in the same run, since the month's views are
+# replaced by the total of the files read. People who aren't in a month's files get no
+# views stored for it, as when the REST API has nothing for a month.
+
+# Start of the lines for English Wikipedia.
+DUMP_WIKI = b'en.wikipedia '
+
+# Month (or day) a dump file covers, from its name.
+DUMP_NAME = re.compile(r'pageviews-(\d{6})(\d{2})?-')
+
+# Titles tracked, as they are written in the dumps, set in each worker process.
+tracked_titles = None
+
+# Set the titles to count views of in a worker process.
+def set_tracked_titles(titles):
+    global tracked_titles
+    tracked_titles = titles
+
+# Return the month a dump file covers, as YYYYMM01 like the pageviews table.
+def dump_month(path):
+    res = DUMP_NAME.search(os.path.basename(path))
+    if not res:
+        raise RuntimeError('Not a pageview dump file name:', path)
+
+    return res.group(1) + '01'
+
+# Open a dump file for reading lines as bytes, decompressing by its extension.
+def open_dump(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+
+    return open(path, 'rb')
+
+# Return the month a dump file covers and a dictionary of tracked title (as in the
+# dump) to its views in the file, summed over access methods. Runs in a worker process.
+def count_views(path):
+    views = {}
+
+    with open_dump(path) as f:
+        for line in f:
+            if not line.startswith(DUMP_WIKI):
+                continue
+
+            fields = line.split(b' ')
+            if len(fields) < 5 or fields[1] not in tracked_titles:
+                continue
+
+            views[fields[1]] = views.get(fields[1], 0) + int(fields[4])
+
+    return dump_month(path), views
+
+# Count the views of everyone in pop.db in pageview dump files and store them as
+# monthly pageviews. Returns the number of people given views.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        paths is a list of dump files.
+#
+#        processes is the number of worker processes, defaulting to one per CPU.
+def ingest_dumps(con, paths, processes=None):
+    create_schema(con)
+
+    # People by their title as the dumps write it, which is FETCH_TITLE. Nobody's views
+    # are under a title that resolved as missing.
+    people = {}
+    for wd_id, wp_article in con.execute('''
+                                         SELECT wd_id, {0} FROM popularity
+                                         WHERE {0} IS NOT NULL
+                                         '''.format(FETCH_TITLE)):
+        people.setdefault(wp_article.replace(' ', '_').encode(), []).append(wd_id)
+
+    # Views of each person, by month, summed over every file for the month.
+    monthly = {}
+
+    with ProcessPoolExecutor(processes, initializer=set_tracked_titles,
+                             initargs=(set(people),)) as pool:
+        futures = {pool.submit(count_views, path): path for path in paths}
+
+        for future in as_completed(futures):
+            month, views = future.result()
+            print('Counted', len(views), 'tracked titles in', futures[future])
+
+            for title, count in views.items():
+                for wd_id in people[title]:
+                    months = monthly.setdefault(wd_id, {})
+                    months[month] = months.get(month, 0) + count
+
+    writer = MetricWriter(con)
+    for wd_id, months in monthly.items():
+        writer.add(MetricResult(MONTHLY_VIEWS, wd_id, sorted(months.items())))
+    writer.flush()
+
+    return len(monthly)
@@ -1,4 +1,3 @@
-from pywikiapi import wikipedia
 from datetime import datetime
 import sqlite3
 import functools
@@ -6,7 +5,21 @@ import re
 from http import HTTPStatus
 import aiohttp
 import asyncio
-import json
+from writer import MetricWriter, MetricResult, JournalEntry, MONTHLY_VIEWS, DONE, FAILED
+from writer import reset_journal
+from requester import Requester, HOST_LIMITS, SPARQL_RETRY_STATUSES, parse_json
+from http_cache import ResponseCache
+from schema import create_schema
+from pageview_dumps import ingest_dumps
+from metrics import Metrics
+from titles import WP_API_ENDP, WP_API_MAX_TITLES, FETCH_TITLE, title_path, resolve_titles
+from changesets import changed_query, latest_changeset
+from history import record_history, written_metrics
+import multiprocessing
+import argparse
+import queue
+import time
+import urllib.parse
 
 # Update our database, pop.db, with all popularity statistics. This code runs
 # with the following assumptions:
@@ -15,10 +28,64 @@ import json
 # with the wd_article column filled with its associated English Wikipedia article
 # name.
 #
-# NOTE: I know it is bad to use .format() for SQL queries because of SQL injection
-#       attacks. However, I figured since each input is something that is already
-#       in the database, and this takes no user input (it only reads from pop.db),
-#       that threat is not as serious. I could be wrong, but hey.
+# Every fetcher returns a MetricResult (or a list of them), or None if nothing could
+# be fetched, and a MetricWriter writes them to pop.db.
+
+# Number of rows read from pop.db at a time by the row producer.
+PAGE_SIZE = 500
+
+# Number of worker coroutines fetching statistics at once. How many requests are
+# actually in flight to each API is adapted by the Requester, up to its limits.
+NUM_WORKERS = 50
+
+# Maximum number of items waiting in each queue between the pipeline stages.
+QUEUE_SIZE = 100
+
+# Number of results written to pop.db per transaction, and the longest time in
+# seconds results are left uncommitted.
+COMMIT_EVERY = 1000
+COMMIT_SECS = 30
+
+# When resuming a refresh, a person whose fetch failed this many times is skipped.
+MAX_ATTEMPTS = 3
+
+# In a sharded refresh, the number of results (and journal entries) a shard process
+# sends to the writer at once, the most of these batches waiting for the writer, and
+# how often in seconds the writer checks the shard processes are still running.
+SHARD_SEND_BATCH = 200
+SHARD_QUEUE_SIZE = 100
+SHARD_POLL_SECS = 1
+
+# SPARQL endpoint for Wikidata.
+SPARQL_ENDP = 'https://query.wikidata.org/sparql'
+
+# Longest GET URL we will send to the SPARQL endpoint. Longer URLs are rejected
+# before the query even runs.
+SPARQL_MAX_URL_LEN = 7500
+
+# Bounds and starting point for the number of people in one batched sitelinks query.
+SITELINKS_MIN_BATCH = 10
+SITELINKS_MAX_BATCH = 500
+SITELINKS_START_BATCH = 100
+
+# The endpoint kills queries after 60 seconds. Batches are grown while queries
+# finish well under SITELINKS_TARGET_SECS and shrunk when they go over it.
+SITELINKS_TIMEOUT_SECS = 60
+SITELINKS_TARGET_SECS = 10
+
+# REST API endpoint for monthly pageview statistics of an article, between a start
+# and end date, and the first day pageview statistics are available.
+PAGEVIEWS_ENDP = 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/en.wikipedia.org/all-access/user/{}/monthly/{}/{}'
+PAGEVIEWS_START = '20150701'
+
+# Request headers for Wikimedia REST API requests. The Requester adds our User-Agent.
+WIKI_HEADERS = {
+    'accept': 'application/json'
+}
+
+# Number of batched sitelinks queries in flight at once. The endpoint only allows
+# a handful of concurrent queries per client.
+SITELINKS_WORKERS = 2
 
 # Return the maximum of two values from a backlinks dictionary.
 #
@@ -40,18 +107,12 @@ def sitelinks_max(acc, el):
     else:
         return acc
 
-# Return a series of lists of size `size`.
-def chunks(rows, size):
-    for i in range(0, len(rows), size):
-        yield rows[i:i+size]
-
-# Return a SQL UPDATE query for the number of Wiki sitelinks.
+# Return a MetricResult for the number of Wiki sitelinks.
 #
 # Input: row is a tuple of the format (wd_id, wp_article).
 #
-#        session is the aiohttp ClientSession associated with this asynchronous
-#        API request.
-async def update_sitelinks(row, session):
+#        requester is the Requester this API request is sent through.
+async def update_sitelinks(row, requester):
 
     # SPARQL query to get the number of Wiki sitelinks for a given person
     sitelinks_query = '''
@@ -61,97 +122,332 @@ async def update_sitelinks(row, session):
     }}
     '''
 
-    # SPARQL endpoint
-    url = 'https://query.wikidata.org/sparql'
-
     wd_id = row[0]
 
     # Define the parameters for upcoming GET request.
     wiki_params = {'format': 'json', 'query': sitelinks_query.format(wd_id)}
 
-    # Query to update the number of Wiki sitelinks for a given person
-    sitelinks_upd_query = 'UPDATE popularity SET wd_sitelinks = {} WHERE wd_id = \'{}\''
-
     # Perform the GET request for the number of sitelinks for this person.
-    async with session.get(url, params=wiki_params) as resp:
+    resp = await requester.get(SPARQL_ENDP, params=wiki_params)
+
+    # If we got a bad status, even after retrying, skip updating it.
+    if resp.status != HTTPStatus.OK:
+        print(wd_id, 'could not be requested on SPARQL endpoint')
+        return None
+
+    ret = parse_json(resp, wd_id, 'the SPARQL endpoint')
+    if ret is None:
+        return None
+
+    # Get the maximum number of sitelinks for this person. Usually this array is only
+    # one element long, but just in case, get the maximum.
+
+    wd_sitelinks = functools.reduce(sitelinks_max, ret['results']['bindings'], 0)
+
+    return MetricResult('wd_sitelinks', wd_id, wd_sitelinks)
+
+# Fetches the number of Wiki sitelinks for many people per SPARQL query, by packing
+# their Wikidata IDs into a VALUES block. The number of people in a query is adjusted
+# as we go: it grows while queries come back quickly, shrinks when they get slow, and
+# a batch that times out or errors is split in half and retried.
+class SitelinksBatcher:
+
+    # SPARQL query to get the number of Wiki sitelinks for a list of people.
+    sitelinks_query = '''
+    SELECT ?person ?sitelinks
+    WHERE {{
+      VALUES ?person {{ {} }}
+      ?person wikibase:sitelinks ?sitelinks .
+    }}
+    '''
+
+    def __init__(self, batch_size=SITELINKS_START_BATCH):
+        self.batch_size = batch_size
 
-        # Try to get a response from the API. The reason this is in a try/except is because
-        # if we overload the API, I want to see it printed out.
+    # Return the GET parameters for a sitelinks query over a list of Wikidata IDs.
+    def query_params(self, wd_ids):
+        values = ' '.join('wd:' + wd_id for wd_id in wd_ids)
+        return {'format': 'json', 'query': self.sitelinks_query.format(values)}
+
+    # Return the length of the full GET URL for a list of Wikidata IDs, assuming every
+    # space is percent-encoded (the longest it could be sent as).
+    def url_len(self, wd_ids):
+        encoded = urllib.parse.urlencode(self.query_params(wd_ids), quote_via=urllib.parse.quote)
+        return len(SPARQL_ENDP) + 1 + len(encoded)
+
+    # Split a list of rows into batches no bigger than the current batch size, and
+    # whose query URL fits in SPARQL_MAX_URL_LEN.
+    def split(self, rows):
+        # Length of the URL with an empty VALUES block. Every person adds their
+        # encoded ID plus a separating space.
+        base_len = self.url_len([])
+
+        batch = []
+        url_len = base_len
+
+        for row in rows:
+            id_len = len(urllib.parse.quote(' wd:' + row[0]))
+
+            if batch and (len(batch) >= self.batch_size or url_len + id_len > SPARQL_MAX_URL_LEN):
+                yield batch
+                batch = []
+                url_len = base_len
+
+            batch.append(row)
+            url_len += id_len
+
+        if batch:
+            yield batch
+
+    # Grow or shrink the batch size depending on how long the last query took.
+    def adapt(self, elapsed):
+        if elapsed > SITELINKS_TARGET_SECS:
+            self.batch_size = max(SITELINKS_MIN_BATCH, self.batch_size // 2)
+        elif elapsed < SITELINKS_TARGET_SECS / 4:
+            self.batch_size = min(SITELINKS_MAX_BATCH, self.batch_size * 2)
+
+    # Return a dictionary of Wikidata ID to number of sitelinks for one batch. A None
+    # return means the query timed out or the endpoint failed on it.
+    async def query(self, batch, requester):
+        wiki_params = self.query_params([row[0] for row in batch])
+        timeout = aiohttp.ClientTimeout(total=SITELINKS_TIMEOUT_SECS)
+
+        # A timed out query is not retried as is, it is split up instead.
+        start = time.monotonic()
         try:
-            ret_text = await resp.text()
-            ret = json.loads(ret_text)
-        except Exception as e:
-            print(ret_text)
-            raise e
+            resp = await requester.get(SPARQL_ENDP, params=wiki_params, timeout=timeout,
+                                       retry_statuses=SPARQL_RETRY_STATUSES, retry_timeouts=False)
+        except asyncio.TimeoutError:
+            self.adapt(SITELINKS_TIMEOUT_SECS)
+            return None
+
+        # Timed out queries come back as a 5xx with a Java stack trace instead of JSON,
+        # as do queries still throttled after retrying.
+        if resp.status >= HTTPStatus.INTERNAL_SERVER_ERROR or resp.status == HTTPStatus.TOO_MANY_REQUESTS:
+            self.adapt(SITELINKS_TIMEOUT_SECS)
+            return None
+
+        # A body that isn't JSON fails the query like a timeout, so the batch is split
+        # and retried.
+        ret = parse_json(resp)
+        if ret is None:
+            self.adapt(SITELINKS_TIMEOUT_SECS)
+            return None
+
+        self.adapt(time.monotonic() - start)
+
+        # Fan the results back out to each person. Usually each person is only bound
+        # once, but just in case, keep the maximum.
+        sitelinks = {}
+        for el in ret['results']['bindings']:
+            res = re.match(r'http://www\.wikidata\.org/entity/(Q.*)', el['person']['value'])
+            if not res:
+                continue
 
-        # Get the maximum number of sitelinks for this person. Usually this array is only
-        # one element long, but just in case, get the maximum.
+            wd_id = res.group(1)
+            sitelinks[wd_id] = sitelinks_max(sitelinks.get(wd_id, 0), el)
 
-        wd_sitelinks = functools.reduce(sitelinks_max, ret['results']['bindings'], 0)
+        return sitelinks
 
-    # Return a query
-    return sitelinks_upd_query.format(wd_sitelinks, wd_id)
+    # Return a list of MetricResults for the number of Wiki sitelinks of every row.
+    #
+    # Input: rows is a list of tuples of the format (wd_id, wp_article).
+    #
+    #        requester is the Requester this API request is sent through.
+    async def fetch(self, rows, requester):
+        results = []
+
+        for batch in self.split(rows):
+            sitelinks = await self.query(batch, requester)
+
+            if sitelinks is None:
+                # A single person that still fails is skipped, otherwise split the batch
+                # in half and try each half again.
+                if len(batch) == 1:
+                    print(batch[0][0], 'could not be requested on SPARQL endpoint')
+                    continue
+
+                half = len(batch) // 2
+                results += await self.fetch(batch[:half], requester)
+                results += await self.fetch(batch[half:], requester)
+                continue
+
+            for wd_id, wd_sitelinks in sitelinks.items():
+                results.append(MetricResult('wd_sitelinks', wd_id, wd_sitelinks))
+
+        return results
 
-# Return a SQL UPDATE query for the number of backlinks.
+# Return a MetricResult for the number of backlinks.
 #
 # Input: row is a tuple of the format (wd_id, wp_article).
 #
-#        session is the aiohttp ClientSession associated with this asynchronous
-#        API request.
-async def update_backlinks(row, session):
+#        requester is the Requester this API request is sent through.
+async def update_backlinks(row, requester):
 
     # API endpoint for number of backlinks for a given Wikipedia page.
-    backlinks_endp = 'http://linkcount.toolforge.org/api/?page={}&project=en.wikipedia.org'
-
-    # Query to update the number of backlinks for a given person
-    bl_query = 'UPDATE popularity SET wp_backlinks = {} WHERE wd_id = \'{}\''
+    backlinks_endp = 'http://linkcount.toolforge.org/api/'
 
     wd_id = row[0]
     wp_article = row[1]
 
     # Request the number of backlinks for this person via a GET request to a backlinks API.
-    async with session.get(backlinks_endp.format(wp_article)) as resp:
+    # The title is passed as a parameter, so it is URL-encoded.
+    backlinks_params = {'page': wp_article.replace(' ', '_'), 'project': 'en.wikipedia.org'}
+    resp = await requester.get(backlinks_endp, params=backlinks_params)
 
-        # Try to get a response from the API. The reason this is in a try/except is because
-        # if we overload the API, I want to see it printed out.
-        try:
-            ret_text = await resp.text()
-            ret = json.loads(ret_text)
-        except Exception as e:
-            print(ret_text)
-            raise e
+    # If we got a bad status, even after retrying, skip updating it.
+    if resp.status != HTTPStatus.OK:
+        print(wp_article, 'could not be requested on backlinks API')
+        return None
+
+    ret = parse_json(resp, wp_article, 'the backlinks API')
+    if ret is None:
+        return None
+
+    num_backlinks = ret['wikilinks']['all']
+
+    return MetricResult('wp_backlinks', wd_id, num_backlinks)
+
+# Return the namespace-0 pages linking to up to WP_API_MAX_TITLES pages, through the
+# MediaWiki action API's prop=linkshere, following continuation until every link has
+# been seen. Returns a tuple (resolved, counts, redirects), or None if the request
+# failed, where:
+#    resolved:  dictionary of each requested title to the title of the page it ended
+#               up on, after normalization (and redirects, if followed).
+#    counts:    dictionary of page title to the number of non-redirect pages linking
+#               to it.
+#    redirects: dictionary of page title to a list of redirects pointing to it.
+#
+# Input: titles is a list of Wikipedia page titles.
+#
+#        requester is the Requester this API request is sent through.
+#
+#        follow_redirects resolves requested titles that are redirects to their target.
+async def query_linkshere(titles, requester, follow_redirects=True):
+
+    wiki_params = {
+        'action': 'query',
+        'format': 'json',
+        'formatversion': '2',
+        'prop': 'linkshere',
+        'titles': '|'.join(titles),
+        'lhnamespace': '0',
+        'lhprop': 'title|redirect',
+        'lhlimit': 'max',
+        'continue': ''
+    }
+    if follow_redirects:
+        wiki_params['redirects'] = '1'
+
+    resolved = {}
+    counts = {}
+    redirects = {}
+
+    while True:
+        resp = await requester.get(WP_API_ENDP, params=wiki_params, headers=WIKI_HEADERS)
 
-        # If we got a bad status, skip updating it.
         if resp.status != HTTPStatus.OK:
-            print(wp_article, 'could not be requested on backlinks API')
-            return ''
+            print(titles, 'could not be requested on the MediaWiki API')
+            return None
+
+        ret = parse_json(resp, titles, 'the MediaWiki API')
+        if ret is None:
+            return None
+
+        if 'error' in ret:
+            print(titles, 'could not be requested on the MediaWiki API')
+            return None
+
+        query = ret.get('query', {})
+
+        # Every continuation repeats the title normalization and redirects, so only
+        # work them out once.
+        if not resolved:
+            normalized = {el['from']: el['to'] for el in query.get('normalized', [])}
+            redirected = {el['from']: el['to'] for el in query.get('redirects', [])}
+
+            for title in titles:
+                target = normalized.get(title, title)
+                resolved[title] = redirected.get(target, target)
+
+        for page in query.get('pages', []):
+            if page.get('missing') or page.get('invalid'):
+                continue
+
+            counts.setdefault(page['title'], 0)
+            redirects.setdefault(page['title'], [])
+
+            for link in page.get('linkshere', []):
+                if link.get('redirect'):
+                    redirects[page['title']].append(link['title'])
+                else:
+                    counts[page['title']] += 1
 
-        num_backlinks = ret['wikilinks']['all']
+        if 'continue' not in ret:
+            break
 
-    return bl_query.format(num_backlinks, wd_id)
+        wiki_params.update(ret['continue'])
 
-# Return a SQL UPDATE query for the average number of pageviews.
+    return resolved, counts, redirects
+
+# Return a list of MetricResults for the number of backlinks of every row, asking
+# the MediaWiki action API about WP_API_MAX_TITLES articles per request. Like the
+# linkcount API, a link counts if it is from an article (namespace 0), either directly
+# or through a redirect to the article.
 #
-# Input: row is a tuple of the format (wd_id, wp_article).
+# Input: rows is a list of tuples of the format (wd_id, wp_article).
 #
-#        session is the aiohttp ClientSession associated with this asynchronous
-#        API request.
-async def update_avgviews(row, session):
+#        requester is the Requester this API request is sent through.
+async def update_backlinks_batch(rows, requester):
 
-    # Today's date in a format for Wikidata REST API.
-    current_date = datetime.today().strftime('%Y%m%d')
+    results = []
 
-    # REST API endpoint for monthly pageview statistics.
-    pageviews_endp = 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/en.wikipedia.org/all-access/user/{}/monthly/20150701/' + current_date
+    for i in range(0, len(rows), WP_API_MAX_TITLES):
+        batch = rows[i:i+WP_API_MAX_TITLES]
 
-    # Request headers for Wikidata REST API request.
-    req_headers_wiki = {
-        'accept': 'application/json',
-        'User-Agent': 'Perdle / owen.young0@protonmail.com'
-    }
+        ret = await query_linkshere([row[1] for row in batch], requester)
+        if ret is None:
+            continue
+
+        resolved, counts, redirects = ret
+
+        # Count the links to each redirect, which count towards the article it points to.
+        redirect_titles = [title for titles in redirects.values() for title in titles]
+        redirect_counts = {}
+
+        for j in range(0, len(redirect_titles), WP_API_MAX_TITLES):
+            ret = await query_linkshere(redirect_titles[j:j+WP_API_MAX_TITLES], requester,
+                                        follow_redirects=False)
+            if ret is None:
+                continue
+
+            redirect_counts.update(ret[1])
 
-    # Query to update the number of backlinks for a given person
-    avg_views_query = 'UPDATE popularity SET wp_avgviews = {} WHERE wd_id = \'{}\''
+        for row in batch:
+            title = resolved.get(row[1])
+
+            if title not in counts:
+                print(row[1], 'could not be found on the MediaWiki API')
+                continue
+
+            num_backlinks = counts[title] + sum(redirect_counts.get(redirect, 0)
+                                                for redirect in redirects[title])
+
+            results.append(MetricResult('wp_backlinks', row[0], num_backlinks))
+
+    return results
+
+# Return a MetricResult for the average number of pageviews.
+#
+# Input: row is a tuple of the format (wd_id, wp_article).
+#
+#        requester is the Requester this API request is sent through.
+async def update_avgviews(row, requester):
+
+    # The first of this month, in a format for Wikidata REST API. Only complete months
+    # come back, and ending the range here rather than today keeps the URL, and its
+    # cached response, the same all month.
+    current_month = datetime.today().strftime('%Y%m') + '01'
 
     wd_id = row[0]
     wp_article = row[1]
@@ -162,37 +458,94 @@ async def update_avgviews(row, session):
     # If a Wikipedia article is too new, such as https://en.wikipedia.org/wiki/Will_Adam
     # (at the time of writing, 8/21/2022, this article was too new for statistics), then a
     # bad status (404) will come back from HTTP.
-    async with session.get(pageviews_endp.format(wp_article), headers=req_headers_wiki) as resp:
+    resp = await requester.get(PAGEVIEWS_ENDP.format(title_path(wp_article), PAGEVIEWS_START, current_month),
+                               headers=WIKI_HEADERS)
 
-        # Try to get a response from the API. The reason this is in a try/except is because
-        # if we overload the API, I want to see it printed out.
-        try:
-            ret_text = await resp.text()
-            ret = json.loads(ret_text)
-        except Exception as e:
-            print(ret_text)
-            raise e
+    if resp.status != HTTPStatus.OK:
+        print(wp_article, 'could not be found, or is too new for statistics for the requested range. Move on')
+        return None
 
-        if resp.status != HTTPStatus.OK:
-            print(wp_article, 'could not be found, or is too new for statistics for the requested range. Move on')
-            return ''
+    ret = parse_json(resp, wp_article, 'the pageviews API')
+    if ret is None:
+        return None
+
+    # Compute a monthly average.
+    avg_pageviews = functools.reduce(lambda acc, el: acc + el['views'],
+                                    ret['items'], 0) / len(ret['items'])
+
+    return MetricResult('wp_avgviews', wd_id, avg_pageviews)
+
+# Return the first day of the month after a YYYYMMDD date, also as YYYYMMDD.
+def next_month(date):
+    year = int(date[:4])
+    month = int(date[4:6])
 
-        # Compute a monthly average.
-        avg_pageviews = functools.reduce(lambda acc, el: acc + el['views'],
-                                        ret['items'], 0) / len(ret['items'])
+    if month == 12:
+        return '{:04d}0101'.format(year + 1)
 
-    return avg_views_query.format(avg_pageviews, wd_id)
+    return '{:04d}{:02d}01'.format(year, month + 1)
 
-# Return a SQL UPDATE query for the number of Google search results.
+# Return a MONTHLY_VIEWS MetricResult with the monthly pageviews we don't have yet for
+# an article, which the writer stores in the pageviews table before deriving
+# wp_avgviews from every month stored. Only months after the last stored one are
+# requested, so after the first run this is a month or two of JSON per person instead
+# of every month since July 2015.
+#
+# Input: row is a tuple of the format (wd_id, wp_article, last_month), where
+#        last_month is the latest month stored in pageviews for this person, or None.
+#
+#        requester is the Requester this API request is sent through.
+#
+# An empty list is returned if there are no new complete months to store.
+async def update_monthly_views(row, requester):
+
+    # Only complete months are stored, so nothing from the first of this month on. The
+    # range ends there rather than today, keeping the URL, and its cached response, the
+    # same all month.
+    current_month = datetime.today().strftime('%Y%m') + '01'
+
+    wd_id = row[0]
+    wp_article = row[1]
+    last_month = row[2]
+
+    start_month = PAGEVIEWS_START if last_month is None else next_month(last_month)
+
+    # Up to date, don't make a request.
+    if start_month >= current_month:
+        return []
+
+    resp = await requester.get(PAGEVIEWS_ENDP.format(title_path(wp_article), start_month, current_month),
+                               headers=WIKI_HEADERS)
+
+    if resp.status != HTTPStatus.OK:
+        print(wp_article, 'could not be found, or is too new for statistics for the requested range. Move on')
+        return None
+
+    ret = parse_json(resp, wp_article, 'the pageviews API')
+    if ret is None:
+        return None
+
+    # Timestamps come back as YYYYMMDDHH.
+    months = []
+    for el in ret['items']:
+        month = el['timestamp'][:8]
+        if month < current_month:
+            months.append((month, el['views']))
+
+    if not months:
+        return []
+
+    return MetricResult(MONTHLY_VIEWS, wd_id, months)
+
+# Return a MetricResult for the number of Google search results.
 #
 # NOTE: This does not work because Google doesn't let me do >10,000
 #       GET requests to their site. Bummer.
 #
 # Input: row is a tuple of the format (wd_id, wp_article).
 #
-#        session is the aiohttp ClientSession associated with this asynchronous
-#        API request.
-async def update_goog_search_num(row, session):
+#        requester is the Requester this API request is sent through.
+async def update_goog_search_num(row, requester):
 
     # Link for Google search
     google_search = 'https://www.google.com/search?q={}'
@@ -202,77 +555,552 @@ async def update_goog_search_num(row, session):
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.149 Safari/537.36'
     }
 
-    # Query to update the number of backlinks for a given person
-    search_num_query = 'UPDATE popularity SET google_search_num = {} WHERE wd_id = \'{}\''
-
     wd_id = row[0]
     wp_article = row[1]
 
     # Get the number of Google results returned by the name in question. This relies on
     # the fact that Google puts how many results there are in the "result-stats" div.
-    async with session.get(google_search.format(wp_article), headers=req_headers_goog) as resp:
+    resp = await requester.get(google_search.format(wp_article), headers=req_headers_goog)
 
-        # Try to get a response from the API. The reason this is in a try/except is because
-        # if we overload the API, I want to see it printed out.
-        try:
-            ret_text = await resp.text()
-            ret = json.loads(ret_text)
-        except Exception as e:
-            print(ret_text)
-            raise e
+    if resp.status != HTTPStatus.OK:
+        print(wp_article, 'couldn\'t complete the request to Google. Ouch')
+        return None
 
-        if resp.status != HTTPStatus.OK:
-            print(wp_article, 'couldn\'t complete the request to Google. Ouch')
-            return ''
+    # Extract the number of results from the HTML string, separated by commas. A page
+    # without it fails the fetch like a bad status.
+    res = re.search(r'About ([0-9,]+) results', resp.text)
+    if not res or not res.group(1):
+        print(wp_article, 'has no results string in the Google HTML')
+        return None
+
+    num_goog_results = int(res.group(1).replace(',', ''))
 
-        # Extract the number of results from the HTML string, separated by commas
-        res = re.search(r'About ([0-9,]+) results', ret)
-        if not res or not res.group(1):
-            print(ret_text)
-            raise RuntimeError('Results string not found in Google HTML!')
+    return MetricResult('google_search_num', wd_id, num_goog_results)
 
-        num_goog_results = int(res.group(1).replace(',', ''))
+# Metric each fetcher writes, recorded against each person in the refresh journal.
+FETCHER_METRICS = {
+    update_sitelinks: 'wd_sitelinks',
+    SitelinksBatcher.fetch: 'wd_sitelinks',
+    update_backlinks: 'wp_backlinks',
+    update_backlinks_batch: 'wp_backlinks',
+    update_avgviews: 'wp_avgviews',
+    update_monthly_views: MONTHLY_VIEWS,
+    update_goog_search_num: 'google_search_num'
+}
 
-    return search_num_query.format(num_goog_results, wd_id)
+# Metrics fetched by wd_id alone, which need no Wikipedia article.
+WIKIDATA_METRICS = ('wd_sitelinks',)
 
-async def driver():
+# Return the metric a fetcher writes. Bound methods, like SitelinksBatcher.fetch, are
+# looked up by the function they wrap.
+def fetcher_metric(fetcher):
+    return FETCHER_METRICS[getattr(fetcher, '__func__', fetcher)]
+
+# Read every row of the popularity table, a page at a time, and put each row on the
+# row queue for the fetch workers. Pages are selected by rowid (keyset pagination)
+# instead of holding one SELECT open over the whole table, so the writer can UPDATE
+# and commit the same table in between pages. Only one page is ever held in memory,
+# and because the row queue is bounded this waits whenever the workers fall behind.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        row_queue is the asyncio.Queue the fetch workers read rows from.
+#
+#        num_workers is the number of fetch workers, each of which is sent a None
+#        once every row has been queued.
+#
+#        batch_size, if given, queues lists of up to batch_size rows instead of
+#        single rows, for fetchers that handle many people per request.
+#
+#        shard, if given, is a tuple (shard, number of shards) to only read the rows
+#        of, by the number of their wd_id modulo the number of shards.
+#
+#        changeset, if given, is the run number of a changeset to only read the people
+#        of whose metrics need fetching again, as in changesets.changed_query.
+async def row_producer(con, row_queue, num_workers, batch_size=None, shard=None, changeset=None):
+    cur = con.cursor()
+
+    filters, filter_params = row_filters(shard, changeset)
+
+    # Query for the next page of rows after a given rowid, along with the last month
+    # of pageviews stored for each person and the metrics the refresh journal says
+    # need no more attempts this refresh. Articles are fetched by FETCH_TITLE.
+    page_query = '''
+                 SELECT rowid, wd_id, {},
+                 (SELECT MAX(month) FROM pageviews WHERE pageviews.wd_id = popularity.wd_id),
+                 (SELECT group_concat(metric) FROM refresh_journal
+                  WHERE refresh_journal.wd_id = popularity.wd_id
+                  AND (status = ? OR attempts >= ?))
+                 FROM popularity
+                 WHERE rowid > ? {} ORDER BY rowid LIMIT ?
+                 '''.format(FETCH_TITLE, filters)
+
+    last_rowid = 0
+
+    while True:
+        page = cur.execute(page_query,
+                           (DONE, MAX_ATTEMPTS, last_rowid) + filter_params + (PAGE_SIZE,)).fetchall()
+        if not page:
+            break
+
+        # Each row is (wd_id, wp_article, last_month, skip_metrics), where wp_article is
+        # None if the title resolved as missing.
+        rows = [row[1:4] + (set(row[4].split(',')) if row[4] else set(),) for row in page]
+
+        if batch_size:
+            for i in range(0, len(rows), batch_size):
+                await row_queue.put(rows[i:i+batch_size])
+        else:
+            for row in rows:
+                await row_queue.put(row)
+
+        last_rowid = page[-1][0]
+
+    # Tell every worker that there are no rows left.
+    for i in range(num_workers):
+        await row_queue.put(None)
+
+# Return the conditions, and their parameters, for the popularity rows a refresh reads:
+# only those of a shard, or of a changeset, if given, as for row_producer.
+def row_filters(shard=None, changeset=None):
+    filters = ''
+    params = ()
+
+    if shard is not None:
+        filters += ' AND CAST(substr(wd_id, 2) AS INTEGER) % ? = ?'
+        params += (shard[1], shard[0])
+
+    if changeset is not None:
+        changed, changed_params = changed_query(changeset, refetch=True)
+        filters += ' AND wd_id IN ({})'.format(changed)
+        params += changed_params
+
+    return filters, params
+
+# Take rows off the row queue, run every fetcher on each one and put the resulting
+# MetricResults on the result queue for the writer. The fetchers for one row run
+# concurrently, so at most num_workers * len(fetchers) requests are ever in flight.
+#
+# Input: requester is the Requester shared by every worker.
+#
+#        fetchers is a list of coroutine functions taking (row, requester), such as
+#        update_backlinks, each returning a MetricResult, a list of them, or None.
+#
+#        row_queue is the asyncio.Queue filled by row_producer.
+#
+#        result_queue is the asyncio.Queue read by result_writer. After the results
+#        of each fetch, a JournalEntry is put on it for every person fetched.
+#
+#        metrics is a Metrics to count the people fetched in, or None.
+async def fetch_worker(requester, fetchers, row_queue, result_queue, metrics=None):
+    while True:
+        row = await row_queue.get()
+        if row is None:
+            break
+
+        # Work out which fetchers still need to run, and on which rows, skipping any
+        # metric the journal says is done. A person without an article to fetch fails
+        # every metric that needs one, without a request.
+        todo = []
+        missing = []
+        for fetcher in fetchers:
+            metric = fetcher_metric(fetcher)
+
+            rows = [r for r in (row if isinstance(row, list) else [row]) if metric not in r[3]]
+            if metric not in WIKIDATA_METRICS:
+                missing += [JournalEntry(metric, r[0], FAILED) for r in rows if r[1] is None]
+                rows = [r for r in rows if r[1] is not None]
+
+            if rows:
+                todo.append((fetcher, metric, rows if isinstance(row, list) else rows[0]))
+
+        for entry in missing:
+            await result_queue.put(entry)
+
+        results = await asyncio.gather(*[fetcher(arg, requester) for fetcher, metric, arg in todo],
+                                       return_exceptions=True)
+
+        for (fetcher, metric, arg), result in zip(todo, results):
+            # A request that still couldn't connect, or timed out, after every retry fails
+            # this fetch like any other, not the whole refresh.
+            if isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError)):
+                wd_ids = [r[0] for r in arg] if isinstance(arg, list) else arg[0]
+                print(wd_ids, 'could not fetch', metric + ':', repr(result))
+                result = None
+            elif isinstance(result, BaseException):
+                raise result
+
+            # Fetchers return None when the API had nothing for this row, which is a
+            # failure. A row in a batch failed if it got no result.
+            if isinstance(arg, list):
+                written = {r.wd_id for r in result or []}
+                entries = [JournalEntry(metric, r[0], DONE if r[0] in written else FAILED)
+                           for r in arg]
+            else:
+                entries = [JournalEntry(metric, arg[0], FAILED if result is None else DONE)]
+
+            if result is None:
+                result = []
+            elif not isinstance(result, list):
+                result = [result]
+
+            for r in result + entries:
+                await result_queue.put(r)
+
+        if metrics is not None:
+            metrics.advance(len(row) if isinstance(row, list) else 1)
+
+    # Tell the writer this worker is done.
+    await result_queue.put(None)
+
+# Write the MetricResults and JournalEntries put on the result queue, COMMIT_EVERY
+# results per transaction, until every fetch worker has finished. Whatever is queued
+# is still written if the refresh is stopped by an error or cancelled.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        result_queue is the asyncio.Queue filled by the fetch workers.
+#
+#        num_workers is the number of fetch workers writing to result_queue.
+#
+#        metrics is a Metrics to record the rows written in, or None.
+async def result_writer(con, result_queue, num_workers, metrics=None):
+    writer = MetricWriter(con, COMMIT_EVERY, COMMIT_SECS, metrics)
+
+    finished_workers = 0
+
+    try:
+        while finished_workers < num_workers:
+            result = await result_queue.get()
+
+            if result is None:
+                finished_workers += 1
+            elif isinstance(result, JournalEntry):
+                writer.mark(result)
+            else:
+                writer.add(result)
+    finally:
+        writer.flush()
+
+# Return the HOST_LIMITS for one of num_shards shard processes, each getting an even
+# share of every host's limits, so all of them together stay within the limits.
+def shard_limits(num_shards):
+    return {host: (rate / num_shards, max(1, max_concurrency // num_shards))
+            for host, (rate, max_concurrency) in HOST_LIMITS.items()}
+
+# Send the MetricResults and JournalEntries put on the result queue on to the writer
+# process, SHARD_SEND_BATCH at a time, until every fetch worker has finished, then send
+# None.
+#
+# Input: result_queue is the asyncio.Queue filled by the fetch workers.
+#
+#        out_queue is the multiprocessing.Queue read by the writer process.
+#
+#        num_workers is the number of fetch workers writing to result_queue.
+async def result_forwarder(result_queue, out_queue, num_workers):
+    loop = asyncio.get_running_loop()
+
+    batch = []
+    finished_workers = 0
+
+    while finished_workers < num_workers:
+        result = await result_queue.get()
+
+        if result is None:
+            finished_workers += 1
+            continue
+
+        batch.append(result)
+
+        # Putting on a full queue blocks, so wait for room off the event loop.
+        if len(batch) >= SHARD_SEND_BATCH:
+            await loop.run_in_executor(None, out_queue.put, batch)
+            batch = []
+
+    if batch:
+        await loop.run_in_executor(None, out_queue.put, batch)
+
+    await loop.run_in_executor(None, out_queue.put, None)
+
+# Fetch statistics for one shard of pop.db, with its own event loop, Requester and
+# share of the rate limits, sending the results to the writer process. pop.db is only
+# read here. Runs in a shard process.
+#
+# Input: shard is the index of this shard, out of num_shards.
+#
+#        fetchers, num_workers and batch_size are as for driver.
+#
+#        out_queue is the multiprocessing.Queue read by the writer process.
+#
+#        requester_class is the Requester class to fetch through, and host_limits the
+#        shard's limits.
+#
+#        changeset is as for row_producer.
+async def refresh_shard(shard, num_shards, fetchers, num_workers, batch_size, out_queue,
+                        requester_class, host_limits, changeset=None):
+    con = sqlite3.connect('file:pop.db?mode=ro', uri=True)
+
+    row_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    result_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async with requester_class(host_limits=host_limits) as requester:
+        workers = [fetch_worker(requester, fetchers, row_queue, result_queue)
+                   for i in range(num_workers)]
+
+        await asyncio.gather(row_producer(con, row_queue, num_workers, batch_size, (shard, num_shards),
+                                          changeset),
+                             result_forwarder(result_queue, out_queue, num_workers),
+                             *workers)
+
+    con.close()
+
+# Entry point of a shard process, see refresh_shard.
+def shard_process(*args):
+    asyncio.run(refresh_shard(*args))
+
+# Refresh statistics across num_shards processes, each fetching for its own part of the
+# wd_ids, while this process is the only one writing to pop.db. Every shard process
+# decodes its own responses on its own core, so throughput grows with the number of
+# cores until the APIs' limits are reached.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        fetchers, num_workers and batch_size are as for driver. The fetch workers are
+#        shared out between the shards.
+#
+#        num_shards is the number of shard processes.
+#
+#        metrics is a Metrics to record the rows written and people done in, or None.
+#        Requests are made in the shard processes, so aren't recorded.
+#
+#        changeset is as for row_producer.
+async def sharded_refresh(con, fetchers, num_workers, batch_size, num_shards, metrics=None,
+                          changeset=None):
+    writer = MetricWriter(con, COMMIT_EVERY, COMMIT_SECS, metrics)
+
+    # Shard processes are started fresh rather than forked from inside the event loop.
+    context = multiprocessing.get_context('spawn')
+    out_queue = context.Queue(SHARD_QUEUE_SIZE)
+
+    processes = [context.Process(target=shard_process,
+                                 args=(shard, num_shards, fetchers,
+                                       max(1, num_workers // num_shards), batch_size, out_queue,
+                                       Requester, shard_limits(num_shards), changeset))
+                 for shard in range(num_shards)]
+
+    for process in processes:
+        process.start()
+
+    # A person is done once their first fetcher's journal entry is written.
+    progress_metric = fetcher_metric(fetchers[0])
+
+    loop = asyncio.get_running_loop()
+    finished_shards = 0
+
+    try:
+        while finished_shards < num_shards:
+            try:
+                results = await loop.run_in_executor(None, out_queue.get, True, SHARD_POLL_SECS)
+            except queue.Empty:
+                exit_codes = [process.exitcode for process in processes]
+                if any(code not in (None, 0) for code in exit_codes):
+                    raise RuntimeError('A shard process failed, exit codes:', exit_codes)
+                continue
+
+            if results is None:
+                finished_shards += 1
+                continue
+
+            for result in results:
+                if isinstance(result, JournalEntry):
+                    writer.mark(result)
+
+                    if metrics is not None and result.metric == progress_metric:
+                        metrics.advance()
+                else:
+                    writer.add(result)
+    finally:
+        writer.flush()
+
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+# Refresh statistics for every person in pop.db.
+#
+# Input: fetchers is a list of coroutine functions run on every row (or batch of rows),
+#        defaulting to the backlinks and average pageviews fetchers.
+#
+#        num_workers is the number of fetch workers to run.
+#
+#        batch_size, if given, hands the fetchers lists of rows of this size.
+#
+#        resume continues the last refresh, skipping every metric the refresh journal
+#        says is done (or failed MAX_ATTEMPTS times) instead of starting over.
+#
+#        cache is a ResponseCache for the Requester, or None to always fetch.
+#
+#        metrics is a Metrics to record the refresh in, showing its progress, or None.
+#
+#        shards, if given, is the number of processes to fetch in, as in
+#        sharded_refresh. The cache is only used to resolve titles.
+#
+#        changeset, if given, only refreshes the people a changeset inserted or whose
+#        article it changed, as for row_producer.
+async def driver(fetchers=None, num_workers=NUM_WORKERS, batch_size=None, resume=False,
+                 cache=None, metrics=None, shards=None, changeset=None):
 
     # Connect to our local popularity database.
     con = sqlite3.connect("pop.db")
-    cur = con.cursor()
 
-    # Get all rows and pass them to each thread.
-    res = cur.execute('SELECT wd_id, wp_article FROM popularity')
-    all_db_rows = res.fetchall()
+    # Create the table of monthly pageviews, and the rest of the schema, if it does not
+    # already exist.
+    create_schema(con)
 
-    # Asynchronously perform each API request and UPDATE the popularity database.
-    my_conn = aiohttp.TCPConnector(limit=5)
-    async with aiohttp.ClientSession(connector=my_conn) as session:
-        tasks = []
+    # Statistics to fetch for every person in the database.
+    if fetchers is None:
+        fetchers = [update_backlinks, update_avgviews]
 
-        # Split the list of rows into chunks.
-        row_lists = list(chunks(all_db_rows, 2000))
+    # Unless resuming, start every metric being fetched over in the journal.
+    if not resume:
+        reset_journal(con, [fetcher_metric(fetcher) for fetcher in fetchers])
 
-        # Loop through each chunk, start asynchronous I/O, because I'm getting timeouts :(
-        for chunk in row_lists:
-            # Ensure 4 futures for each person in the database, where each return is
-            # a string query to be executed.
-            for row in chunk:
-                # tasks.append(asyncio.ensure_future(update_sitelinks(row, session)))
-                tasks.append(asyncio.ensure_future(update_backlinks(row, session)))
-                tasks.append(asyncio.ensure_future(update_avgviews(row, session)))
-                # tasks.append(asyncio.ensure_future(update_goog_search_num(row, session)))
+    # Query for the number of people a metric is done for this refresh. The journal
+    # never fetches anyone twice in one refresh, so if this hasn't grown by the end,
+    # nothing was fetched.
+    done_query = 'SELECT COUNT(*) FROM refresh_journal WHERE metric = ? AND status = ?'
 
-            # Get the queries from each function and execute them.
-            queries = await asyncio.gather(*tasks)
+    metric_names = [fetcher_metric(fetcher) for fetcher in fetchers]
+    done_before = {metric: con.execute(done_query, (metric, DONE)).fetchone()[0] for metric in metric_names}
 
-            for query in queries:
-                cur.execute(query)
+    # Rows flow from the producer, through a fixed pool of workers, to the writer.
+    # Both queues are bounded, so memory stays the same however big the table is.
+    row_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    result_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
 
-    # We're done, commit the transaction, close the database, and return.
-    con.commit()
+    # Asynchronously perform each API request and UPDATE the popularity database. How
+    # many requests are in flight to each API is up to the Requester.
+    async with Requester(cache=cache, metrics=metrics) as requester:
+        # Fetch every article by its canonical title, resolving any titles not yet
+        # resolved first.
+        await resolve_titles(con, requester)
+
+        if metrics is not None:
+            filters, filter_params = row_filters(changeset=changeset)
+            metrics.start_progress(con.execute('SELECT COUNT(*) FROM popularity WHERE 1 {}'.format(filters),
+                                               filter_params).fetchone()[0])
+
+        try:
+            if shards:
+                await sharded_refresh(con, fetchers, num_workers, batch_size, shards, metrics,
+                                      changeset)
+            else:
+                workers = [fetch_worker(requester, fetchers, row_queue, result_queue, metrics)
+                           for i in range(num_workers)]
+
+                await asyncio.gather(row_producer(con, row_queue, num_workers, batch_size,
+                                                  changeset=changeset),
+                                     result_writer(con, result_queue, num_workers, metrics),
+                                     *workers)
+        finally:
+            if metrics is not None:
+                metrics.stop_progress()
+
+    # Keep the values just fetched in the metric history before the next refresh
+    # overwrites them. Only a complete refresh of everyone is a run of history: a
+    # refresh of a changeset leaves everyone else's values as old as they were, and
+    # one that failed or was cancelled never gets here. A metric nothing was fetched for,
+    # such as on resuming a refresh that had already finished, is no new run.
+    fetched = [metric for metric in metric_names
+               if con.execute(done_query, (metric, DONE)).fetchone()[0] > done_before[metric]]
+    recorded = written_metrics(fetched)
+    if changeset is None and recorded:
+        run, num_values = record_history(con, recorded)
+        print('Recorded history run', run, 'of', ', '.join(recorded), 'with', num_values, 'changed values')
+
+    # We're done, close the database and return.
     con.close()
 
     return
 
-asyncio.run(driver())
\ No newline at end of file
+# Refresh only the number of Wiki sitelinks for every person, hundreds of people per
+# SPARQL query.
+async def refresh_sitelinks(resume=False, cache=None, metrics=None, shards=None, changeset=None):
+    batcher = SitelinksBatcher()
+    await driver([batcher.fetch], SITELINKS_WORKERS, SITELINKS_MAX_BATCH, resume, cache, metrics,
+                 shards, changeset)
+
+# Refresh only the number of backlinks for every person, WP_API_MAX_TITLES people per
+# MediaWiki API request.
+async def refresh_backlinks(resume=False, cache=None, metrics=None, shards=None, changeset=None):
+    await driver([update_backlinks_batch], NUM_WORKERS, WP_API_MAX_TITLES, resume, cache, metrics,
+                 shards, changeset)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update pop.db with popularity statistics.')
+    parser.add_argument('--sitelinks', action='store_true',
+                        help='refresh Wiki sitelinks with batched SPARQL queries instead')
+    parser.add_argument('--backlinks', action='store_true',
+                        help='refresh backlinks with batched MediaWiki API requests instead')
+    parser.add_argument('--incremental-views', action='store_true',
+                        help='only fetch months of pageviews not yet stored in pop.db, '
+                             'and derive wp_avgviews from the stored months')
+    parser.add_argument('--pageview-dumps', nargs='+', metavar='FILE',
+                        help='store monthly pageviews counted from pageview dump files '
+                             'instead of the REST API, and derive wp_avgviews from them')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes reading pageview dumps (default: one per CPU)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last refresh, skipping work already written')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve and store API responses in the on-disk response cache')
+    parser.add_argument('--offline', action='store_true',
+                        help='serve only cached API responses, never making a request')
+    parser.add_argument('--shards', type=int,
+                        help='fetch in this many processes, sharing out the rate limits, '
+                             'with this process writing every result')
+    parser.add_argument('--changed', action='store_true',
+                        help='only refresh the people the last init_db.py --sync inserted '
+                             'or changed the article of')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write request and write metrics to FILE once done, in the '
+                             'Prometheus text format if it ends in .prom, otherwise JSON')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache or args.offline:
+        cache = ResponseCache(offline=args.offline)
+
+    metrics = Metrics()
+
+    changeset = None
+    if args.changed:
+        con = sqlite3.connect("pop.db")
+        create_schema(con)
+        changeset = latest_changeset(con)
+        con.close()
+
+        if changeset is None:
+            raise RuntimeError('No changeset to refresh, run init_db.py --sync first')
+
+    if args.pageview_dumps:
+        con = sqlite3.connect("pop.db")
+        print('Stored views for', ingest_dumps(con, args.pageview_dumps, args.processes), 'people')
+        con.close()
+    elif args.sitelinks:
+        asyncio.run(refresh_sitelinks(args.resume, cache, metrics, args.shards, changeset))
+    elif args.backlinks:
+        asyncio.run(refresh_backlinks(args.resume, cache, metrics, args.shards, changeset))
+    elif args.incremental_views:
+        asyncio.run(driver([update_backlinks, update_monthly_views], resume=args.resume,
+                           cache=cache, metrics=metrics, shards=args.shards, changeset=changeset))
+    else:
+        asyncio.run(driver(resume=args.resume, cache=cache, metrics=metrics, shards=args.shards,
+                           changeset=changeset))
+
+    if cache is not None:
+        cache.close()
+
+    if args.metrics:
+        metrics.dump(args.metrics)
@@ -0,0 +1,255 @@
+from popularity import update_backlinks, update_monthly_views, fetcher_metric
+from popularity import fetch_worker, result_writer, NUM_WORKERS, QUEUE_SIZE, WIKIDATA_METRICS
+from datetime import datetime, timedelta
+from writer import FAILED
+from titles import resolve_titles, FETCH_TITLE
+from schema import create_schema
+from score import update_scores
+from requester import Requester
+from http_cache import ResponseCache
+from metrics import Metrics
+import argparse
+import asyncio
+import sqlite3
+import heapq
+import time
+
+# Keep pop.db fresh continuously instead of refreshing everyone at once. Famous people
+# matter most for Perdle, so a refresh of one metric for one person is worth more the
+# higher their score and the longer since it was last fetched:
+#
+#    priority = (score + SCORE_FLOOR) * days since last fetched
+#
+# where the time each metric was last fetched comes from the refresh journal, and a
+# metric never fetched counts as NEVER_FETCHED_DAYS old. Every cycle, the daemon spends
+# what is left of its hourly request budget on the refreshes with the highest priority,
+# then recomputes the scores. Nothing fetched in the last MIN_REFRESH_DAYS is fetched
+# again, and a metric whose fetch failed is left alone for FAILED_BACKOFF_SECS.
+
+# Default number of requests to spend per hour.
+DEFAULT_BUDGET = 3600
+
+# Seconds between cycles.
+CYCLE_SECS = 60
+
+# Added to every score, so people without one are still refreshed eventually.
+SCORE_FLOOR = 0.01
+
+# Age in days given to a metric that has never been fetched.
+NEVER_FETCHED_DAYS = 365
+
+# Youngest a metric can be, in days, to be fetched again.
+MIN_REFRESH_DAYS = 1
+
+# Seconds before a metric that failed to fetch is tried again.
+FAILED_BACKOFF_SECS = 24 * 60 * 60
+
+# Seconds to wait after a cycle that failed, doubled for every failure in a row, and
+# the most to wait.
+ERROR_BACKOFF_SECS = 60
+MAX_ERROR_BACKOFF_SECS = 60 * 60
+
+# Return up to limit (priority, wd_id, wp_article, metric) tuples of the metrics most
+# worth refreshing, highest priority first.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        metrics is a list of the metrics to refresh.
+#
+#        limit is the number of refreshes to return.
+#
+#        backoff is a set of (wd_id, metric) to leave out.
+def most_stale(con, metrics, limit, backoff):
+
+    # Query for the people with the highest priority for a metric. The journal's times
+    # are local, like julianday's with 'localtime'. People whose title resolved as
+    # missing are left out of metrics that need an article.
+    stale_query = '''
+                  SELECT (COALESCE(score, 0) + ?) *
+                         COALESCE(julianday('now', 'localtime') - julianday(fetched_at), ?) AS priority,
+                         popularity.wd_id, {0}
+                  FROM popularity LEFT JOIN refresh_journal
+                  ON refresh_journal.wd_id = popularity.wd_id AND refresh_journal.metric = ?
+                  WHERE wp_article IS NOT NULL AND (? OR {0} IS NOT NULL)
+                  AND (fetched_at IS NULL OR fetched_at < ?)
+                  ORDER BY priority DESC LIMIT ?
+                  '''.format(FETCH_TITLE)
+
+    cutoff = (datetime.now() - timedelta(days=MIN_REFRESH_DAYS)).isoformat(timespec='seconds')
+
+    candidates = []
+    for metric in metrics:
+        # Ask for enough to make up for the ones backing off.
+        rows = con.execute(stale_query, (SCORE_FLOOR, NEVER_FETCHED_DAYS, metric,
+                                         metric in WIKIDATA_METRICS, cutoff,
+                                         limit + len(backoff))).fetchall()
+
+        candidates += [(priority, wd_id, wp_article, metric) for priority, wd_id, wp_article in rows
+                       if (wd_id, metric) not in backoff]
+
+    return heapq.nlargest(limit, candidates)
+
+# Put rows on the row queue for the fetch workers, then a None for each worker.
+async def queue_rows(rows, row_queue, num_workers):
+    for row in rows:
+        await row_queue.put(row)
+
+    for i in range(num_workers):
+        await row_queue.put(None)
+
+# Fetch a list of refreshes and write them, through the same workers and writer as a
+# full refresh. Each person is fetched once, skipping the metrics not chosen for them.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        requester is the Requester to fetch through.
+#
+#        fetchers is the list of fetchers, one per metric.
+#
+#        refreshes is a list of (priority, wd_id, wp_article, metric) tuples.
+#
+#        metrics is a Metrics to record the rows written in, or None.
+async def refresh(con, requester, fetchers, refreshes, metrics=None):
+    all_metrics = {fetcher_metric(fetcher) for fetcher in fetchers}
+
+    chosen = {}
+    articles = {}
+    for priority, wd_id, wp_article, metric in refreshes:
+        chosen.setdefault(wd_id, set()).add(metric)
+        articles[wd_id] = wp_article
+
+    # Monthly pageviews are only fetched after the last month stored.
+    rows = []
+    for wd_id, metric_set in chosen.items():
+        last_month = con.execute('SELECT MAX(month) FROM pageviews WHERE wd_id = ?',
+                                 (wd_id,)).fetchone()[0]
+        rows.append((wd_id, articles[wd_id], last_month, all_metrics - metric_set))
+
+    num_workers = min(NUM_WORKERS, len(rows))
+
+    row_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    result_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    workers = [fetch_worker(requester, fetchers, row_queue, result_queue)
+               for i in range(num_workers)]
+
+    await asyncio.gather(queue_rows(rows, row_queue, num_workers),
+                         result_writer(con, result_queue, num_workers, metrics),
+                         *workers)
+
+# Run one cycle: resolve titles, spend what is left of the budget on the refreshes with
+# the highest priority and recompute the scores. Returns the number of refreshes.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        requester is the Requester to fetch through.
+#
+#        fetchers is the list of fetchers, one per metric.
+#
+#        allowance is the number of refreshes the budget has left.
+#
+#        metrics is the Metrics counting every request made.
+#
+#        backoff is a dictionary of the time each (wd_id, metric) that failed is left
+#        alone until, which failed refreshes are added to.
+async def run_cycle(con, requester, fetchers, allowance, metrics, backoff):
+    await resolve_titles(con, requester)
+
+    metric_names = [fetcher_metric(fetcher) for fetcher in fetchers]
+
+    refreshes = most_stale(con, metric_names, allowance, set(backoff)) if allowance > 0 else []
+
+    if refreshes:
+        await refresh(con, requester, fetchers, refreshes, metrics)
+
+        # Back off the refreshes that failed.
+        for priority, wd_id, wp_article, metric in refreshes:
+            status = con.execute('SELECT status FROM refresh_journal WHERE wd_id = ? AND metric = ?',
+                                 (wd_id, metric)).fetchone()
+            if status is None or status[0] == FAILED:
+                backoff[(wd_id, metric)] = time.monotonic() + FAILED_BACKOFF_SECS
+
+        update_scores(con)
+
+    return len(refreshes)
+
+# Refresh pop.db forever, a cycle at a time, spending at most budget requests an hour.
+# A cycle that fails, such as on a request that ran out of retries or on pop.db being
+# locked, is printed and the next one waits ERROR_BACKOFF_SECS longer, doubling with
+# every failure in a row, up to MAX_ERROR_BACKOFF_SECS.
+#
+# Input: budget is the number of requests to spend per hour.
+#
+#        fetchers is the list of fetchers to run, one per metric, defaulting to
+#        backlinks and monthly pageviews.
+#
+#        cycle_secs is the number of seconds between cycles.
+#
+#        cache is a ResponseCache for the Requester, or None to always fetch.
+async def refresh_daemon(budget=DEFAULT_BUDGET, fetchers=None, cycle_secs=CYCLE_SECS, cache=None):
+
+    con = sqlite3.connect("pop.db")
+    create_schema(con)
+
+    if fetchers is None:
+        fetchers = [update_backlinks, update_monthly_views]
+
+    # Counts every request made, to keep to the budget.
+    metrics = Metrics()
+
+    # Time each (wd_id, metric) that failed is left alone until.
+    backoff = {}
+
+    # Number of cycles in a row that failed.
+    failures = 0
+
+    async with Requester(cache=cache, metrics=metrics) as requester:
+        while True:
+            cycle_start = time.monotonic()
+
+            # The budget accrues over time, with one cycle's worth up front, less every
+            # request already made. Each refresh is taken to be about one request.
+            allowance = int(budget * (metrics.elapsed() + cycle_secs) / 3600) - metrics.num_requests()
+
+            now = time.monotonic()
+            for key in [key for key, until in backoff.items() if until <= now]:
+                del backoff[key]
+
+            delay = 0
+            try:
+                num_refreshes = await run_cycle(con, requester, fetchers, allowance, metrics, backoff)
+            except Exception as e:
+                # Leave no transaction of the failed cycle open, holding pop.db's lock.
+                con.rollback()
+
+                delay = min(ERROR_BACKOFF_SECS * 2 ** failures, MAX_ERROR_BACKOFF_SECS)
+                failures += 1
+                print('Cycle failed:', repr(e) + ', trying again in', delay, 'seconds')
+            else:
+                failures = 0
+                print('Refreshed', num_refreshes, 'metrics,', metrics.num_requests(), 'requests in',
+                      '{:.1f} hours,'.format(metrics.elapsed() / 3600), len(backoff), 'backing off')
+
+            await asyncio.sleep(max(delay, cycle_secs - (time.monotonic() - cycle_start)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep pop.db fresh, most popular and stalest first.')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET,
+                        help='requests to spend per hour (default: %(default)s)')
+    parser.add_argument('--cycle-secs', type=float, default=CYCLE_SECS,
+                        help='seconds between cycles (default: %(default)s)')
+    parser.add_argument('--cache', action='store_true',
+                        help='serve and store API responses in the on-disk response cache')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        cache = ResponseCache()
+
+    try:
+        asyncio.run(refresh_daemon(args.budget, cycle_secs=args.cycle_secs, cache=cache))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache is not None:
+            cache.close()
@@ -0,0 +1,452 @@
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from http import HTTPStatus
+from urllib.parse import urlsplit
+import aiohttp
+import functools
+import asyncio
+import json
+import random
+import time
+
+# Shared request layer for every API we fetch from. Each host gets its own limiter: a
+# token bucket capping requests per second, plus an AIMD (additive increase,
+# multiplicative decrease) limit on requests in flight. The in-flight limit creeps up
+# while requests succeed, and halves whenever the host throttles us or times out.
+# Throttled and failed requests are retried with jittered exponential backoff, and a
+# Retry-After header pauses every request to that host for as long as it asks.
+#
+# A Requester can also be given a ResponseCache (see http_cache.py), in which case
+# fresh cached responses are served without touching the network or the limiters, and
+# a Metrics (see metrics.py) to record every request in.
+
+# User-Agent sent on every request, as asked for by the Wikimedia User-Agent policy.
+USER_AGENT = 'Perdle / owen.young0@protonmail.com'
+
+# Per-host (requests per second, most requests in flight) limits.
+HOST_LIMITS = {
+    'query.wikidata.org': (5, 5),
+    'wikimedia.org': (100, 50),
+    'linkcount.toolforge.org': (10, 10),
+    'en.wikipedia.org': (20, 10)
+}
+
+# Limits for any other host.
+DEFAULT_LIMITS = (5, 5)
+
+# Statuses that mean the host wants us to slow down.
+THROTTLE_STATUSES = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+
+# Statuses retried by default.
+RETRY_STATUSES = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.INTERNAL_SERVER_ERROR,
+                  HTTPStatus.BAD_GATEWAY, HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT)
+
+# Statuses retried for SPARQL queries. A plain 500 is not retried, because that is how
+# the SPARQL endpoint reports a query that timed out, which would just time out again.
+SPARQL_RETRY_STATUSES = tuple(status for status in RETRY_STATUSES
+                              if status != HTTPStatus.INTERNAL_SERVER_ERROR)
+
+# Number of times a request is retried, whether it failed before or while reading its
+# body, and the bounds of the backoff in seconds.
+MAX_RETRIES = 5
+BACKOFF_BASE_SECS = 1
+BACKOFF_MAX_SECS = 60
+
+# A response that has been read in full:
+#    status:  HTTP status code.
+#    headers: response headers.
+#    text:    response body, decoded.
+Response = namedtuple('Response', ['status', 'headers', 'text'])
+
+# A response whose body is read as it arrives:
+#    status:  HTTP status code.
+#    headers: response headers.
+#    lines:   asynchronous iterator over the lines of the body, decoded, each ending
+#             in a newline unless the body was cut off.
+StreamedResponse = namedtuple('StreamedResponse', ['status', 'headers', 'lines'])
+
+# Return the JSON body of a Response, or None if the body isn't JSON, such as an HTML
+# error page or a truncated response. Callers fail the fetch on None, like a bad
+# status, so the journal records it as FAILED.
+#
+# Input: resp is the Response.
+#
+#        what, if given, is printed along with the api as what got no JSON back, such
+#        as a wd_id or a title.
+def parse_json(resp, what=None, api=None):
+    try:
+        return json.loads(resp.text)
+    except ValueError:
+        if what is not None:
+            print(what, 'did not get JSON back from', api)
+        return None
+
+# Return the number of seconds a Retry-After header asks us to wait, or None if there
+# is no (valid) Retry-After. It is either a number of seconds or an HTTP date.
+def retry_after_secs(headers):
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+
+# Return how long to wait before retry number attempt, with "full jitter": a random
+# time up to an exponentially growing cap, so retries from many workers spread out.
+def backoff_secs(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2 ** attempt))
+
+# Yield the lines of a body that has already been read in full.
+async def text_lines(text):
+    for line in text.splitlines(keepends=True):
+        yield line
+
+# Yield the lines of an aiohttp response body, decoded, as they arrive, calling
+# received, if given, with the number of bytes in each.
+async def response_lines(resp, received=None):
+    async for line in resp.content:
+        if received is not None:
+            received(len(line))
+        yield line.decode()
+
+# Rate and concurrency limits for a single host.
+class HostLimiter:
+
+    # Input: rate is the most requests per second to send to this host.
+    #
+    #        max_concurrency is the most requests to this host in flight at once.
+    #
+    #        on_in_flight, if given, is called with the number of requests in flight
+    #        whenever it changes.
+    def __init__(self, rate, max_concurrency, on_in_flight=None):
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+
+        # Token bucket, allowing bursts of up to one second's worth of requests.
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+        # Adaptive limit on requests in flight, starting halfway up.
+        self.concurrency = max(1, max_concurrency / 2)
+        self.in_flight = 0
+        self.slot_freed = asyncio.Condition()
+        self.on_in_flight = on_in_flight
+
+        # Time before which no request may be sent, set by Retry-After.
+        self.blocked_until = 0
+
+    # Wait for a free in-flight slot, for any Retry-After to pass and for a token.
+    async def acquire(self):
+        async with self.slot_freed:
+            while self.in_flight >= int(self.concurrency):
+                await self.slot_freed.wait()
+            self.in_flight += 1
+
+        if self.on_in_flight is not None:
+            self.on_in_flight(self.in_flight)
+
+        while True:
+            now = time.monotonic()
+
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Give back an in-flight slot, adjusting the in-flight limit: up by 1/limit on
+    # success (about one more per limit's worth of requests), halved when throttled.
+    async def release(self, throttled):
+        if throttled:
+            self.concurrency = max(1, self.concurrency / 2)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+        async with self.slot_freed:
+            self.in_flight -= 1
+            self.slot_freed.notify_all()
+
+        if self.on_in_flight is not None:
+            self.on_in_flight(self.in_flight)
+
+    # Hold every request to this host for a number of seconds.
+    def block(self, secs):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + secs)
+
+# Wraps an aiohttp ClientSession, sending every GET through its host's HostLimiter.
+# Use as an asynchronous context manager:
+#
+#    async with Requester() as requester:
+#        resp = await requester.get(url, params=params)
+class Requester:
+
+    # Input: host_limits is a dictionary of host to (requests per second, most requests
+    #        in flight).
+    #
+    #        cache is a ResponseCache to serve and store responses with, or None.
+    #
+    #        metrics is a Metrics to record requests in, or None.
+    def __init__(self, host_limits=HOST_LIMITS, cache=None, metrics=None):
+        self.host_limits = host_limits
+        self.cache = cache
+        self.metrics = metrics
+        self.limiters = {}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(headers={'User-Agent': USER_AGENT})
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    # Return the host a URL is limited and recorded under.
+    def host(self, url):
+        return urlsplit(url).hostname
+
+    # Return the HostLimiter for a URL's host, creating it on first use.
+    def limiter(self, url):
+        host = self.host(url)
+
+        if host not in self.limiters:
+            rate, max_concurrency = self.host_limits.get(host, DEFAULT_LIMITS)
+
+            on_in_flight = None
+            if self.metrics is not None:
+                on_in_flight = functools.partial(self.metrics.set_in_flight, host)
+
+            self.limiters[host] = HostLimiter(rate, max_concurrency, on_in_flight)
+
+        return self.limiters[host]
+
+    # Record a request to a URL's host, sent at start (by time.monotonic), in metrics.
+    # status is the response's HTTP status, or the name of the exception raised.
+    def record(self, url, start, status):
+        if self.metrics is not None:
+            self.metrics.request(self.host(url), time.monotonic() - start, status)
+
+    # Record a retried request to a URL's host in metrics.
+    def record_retry(self, url):
+        if self.metrics is not None:
+            self.metrics.retry(self.host(url))
+
+    # Record a response served from the cache in metrics.
+    def record_cached(self, url):
+        if self.metrics is not None:
+            self.metrics.cached(self.host(url))
+
+    # Return a function recording bytes received from a URL's host in metrics, or None.
+    def receiver(self, url):
+        if self.metrics is None:
+            return None
+
+        return functools.partial(self.metrics.received, self.host(url))
+
+    # Perform a GET request, retrying throttled requests, connection errors and
+    # timeouts, and return the Response. Once out of retries, the last Response is
+    # returned, or the last connection error or timeout is raised. With a cache, fresh
+    # responses are served from it, stale ones are revalidated and new 200 responses
+    # are stored.
+    #
+    # Input: url, params, headers and timeout are passed to aiohttp.
+    #
+    #        retry_statuses is a tuple of the HTTP statuses to retry.
+    #
+    #        retry_timeouts retries requests that time out. Turn this off when the
+    #        caller would rather handle a timeout by asking for less.
+    async def get(self, url, params=None, headers=None, timeout=None,
+                  retry_statuses=RETRY_STATUSES, retry_timeouts=True):
+        if self.cache is None:
+            return await self.fetch(url, params, headers, timeout, retry_statuses, retry_timeouts)
+
+        key = self.cache.key('GET', url, params, headers)
+        cached = self.cache.get(key, url)
+
+        if cached is not None and (cached.fresh or self.cache.offline):
+            self.record_cached(url)
+            return cached.response
+
+        # Offline, a request that isn't cached fails like an only-if-cached request.
+        if self.cache.offline:
+            return Response(HTTPStatus.GATEWAY_TIMEOUT, {}, '')
+
+        # Ask the API whether a stale response has changed.
+        if cached is not None:
+            headers = dict(headers or {}, **self.cache.conditional_headers(cached))
+
+        response = await self.fetch(url, params, headers, timeout, retry_statuses, retry_timeouts)
+
+        if response.status == HTTPStatus.NOT_MODIFIED and cached is not None:
+            self.cache.revalidated(key)
+            self.record_cached(url)
+            return cached.response
+
+        if response.status == HTTPStatus.OK:
+            self.cache.put(key, url, response)
+
+        return response
+
+    # Perform a GET request like get, but yield a StreamedResponse whose body is read a
+    # line at a time as it arrives, so it never has to be held in memory at once. The
+    # request is retried like get until there is a response to stream; once lines are
+    # being read, a timeout or dropped connection is raised to the caller. Cached
+    # responses are streamed from the cache. When caching, the lines of a new response
+    # are also collected to be stored once it has been read in full.
+    #
+    # Use as an asynchronous context manager:
+    #
+    #    async with requester.stream(url, params=params) as resp:
+    #        async for line in resp.lines:
+    @asynccontextmanager
+    async def stream(self, url, params=None, headers=None, timeout=None,
+                     retry_statuses=RETRY_STATUSES, retry_timeouts=True):
+        key = None
+        cached = None
+
+        if self.cache is not None:
+            key = self.cache.key('GET', url, params, headers)
+            cached = self.cache.get(key, url)
+
+            if cached is not None and (cached.fresh or self.cache.offline):
+                self.record_cached(url)
+                yield StreamedResponse(cached.response.status, cached.response.headers,
+                                       text_lines(cached.response.text))
+                return
+
+            # Offline, a request that isn't cached fails like an only-if-cached request.
+            if self.cache.offline:
+                yield StreamedResponse(HTTPStatus.GATEWAY_TIMEOUT, {}, text_lines(''))
+                return
+
+            # Ask the API whether a stale response has changed.
+            if cached is not None:
+                headers = dict(headers or {}, **self.cache.conditional_headers(cached))
+
+        resp, limiter, _ = await self.open(url, params, headers, timeout, retry_statuses, retry_timeouts)
+
+        try:
+            if resp.status == HTTPStatus.NOT_MODIFIED and cached is not None:
+                self.cache.revalidated(key)
+                self.record_cached(url)
+                yield StreamedResponse(cached.response.status, cached.response.headers,
+                                       text_lines(cached.response.text))
+            elif resp.status == HTTPStatus.OK and self.cache is not None:
+                yield StreamedResponse(resp.status, resp.headers, self.caching_lines(resp, key, url))
+            else:
+                yield StreamedResponse(resp.status, resp.headers,
+                                       response_lines(resp, self.receiver(url)))
+        finally:
+            resp.release()
+            await limiter.release(throttled=resp.status in THROTTLE_STATUSES)
+
+    # Yield the lines of a response as they arrive, storing the whole response in the
+    # cache once the last line has been read.
+    async def caching_lines(self, resp, key, url):
+        lines = []
+
+        async for line in response_lines(resp, self.receiver(url)):
+            lines.append(line)
+            yield line
+
+        self.cache.put(key, url, Response(resp.status, resp.headers, ''.join(lines)))
+
+    # Perform a GET request as described in get, without the cache. Retries of the
+    # request and of reading its body share MAX_RETRIES.
+    async def fetch(self, url, params, headers, timeout, retry_statuses, retry_timeouts):
+        attempt = 0
+
+        while True:
+            resp, limiter, attempt = await self.open(url, params, headers, timeout, retry_statuses,
+                                                     retry_timeouts, attempt)
+
+            try:
+                body = await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                resp.release()
+                await limiter.release(throttled=True)
+
+                if attempt >= MAX_RETRIES or (isinstance(e, asyncio.TimeoutError) and not retry_timeouts):
+                    raise e
+
+                self.record_retry(url)
+
+                await asyncio.sleep(backoff_secs(attempt))
+                attempt += 1
+                continue
+
+            if self.metrics is not None:
+                self.metrics.received(self.host(url), len(body))
+
+            text = body.decode(resp.get_encoding())
+
+            resp.release()
+            await limiter.release(throttled=resp.status in THROTTLE_STATUSES)
+
+            return Response(resp.status, resp.headers, text)
+
+    # Send a GET request through its host's HostLimiter, retrying as described in get
+    # until there is a response whose status isn't retried. Returns the aiohttp
+    # ClientResponse, with its body not yet read, the HostLimiter and the number of the
+    # attempt that got the response, counting from attempt. The caller must release
+    # the response and the limiter once done with the response.
+    async def open(self, url, params, headers, timeout, retry_statuses, retry_timeouts, attempt=0):
+        limiter = self.limiter(url)
+
+        while True:
+            await limiter.acquire()
+
+            start = time.monotonic()
+            try:
+                resp = await self.session.get(url, params=params, headers=headers, timeout=timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.record(url, start, type(e).__name__)
+                await limiter.release(throttled=True)
+
+                if attempt >= MAX_RETRIES or (isinstance(e, asyncio.TimeoutError) and not retry_timeouts):
+                    raise e
+
+                self.record_retry(url)
+
+                await asyncio.sleep(backoff_secs(attempt))
+                attempt += 1
+                continue
+
+            self.record(url, start, resp.status)
+
+            if resp.status not in retry_statuses or attempt >= MAX_RETRIES:
+                return resp, limiter, attempt
+
+            resp.release()
+            await limiter.release(throttled=resp.status in THROTTLE_STATUSES)
+
+            # Wait at least as long as the host asked, holding back every other request
+            # to it too.
+            delay = backoff_secs(attempt)
+            retry_after = retry_after_secs(resp.headers)
+            if retry_after is not None:
+                limiter.block(retry_after)
+                delay = max(delay, retry_after)
+
+            self.record_retry(url)
+
+            await asyncio.sleep(delay)
+            attempt += 1
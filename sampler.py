@@ -0,0 +1,191 @@
+from datetime import date
+from schema import create_schema, ERAS
+import numpy as np
+import argparse
+import hashlib
+import sqlite3
+import random
+
+# Draw the day's Perdle person. People are drawn with probability proportional to their
+# score, from an era and tier or from everyone, and a draw seeded by the date always
+# gives the same person for as long as pop.db doesn't change.
+#
+# Draws don't touch pop.db. A SamplerIndex is built from the popularity table once:
+# every wd_id packed into one byte string with an array of offsets into it, and for each
+# era and tier a table for Walker's alias method, so a draw is two random numbers and
+# two array lookups however many people there are. Picking which era and tier to draw
+# from, when either isn't given, is another alias table over the tables. A Sampler
+# keeps an index, rebuilding it only when pop.db has changed.
+
+# Era of people whose year of birth we don't know.
+UNKNOWN_ERA = -1
+
+# Return the era, as an index into ERAS, of each year of birth in a NumPy array, and
+# UNKNOWN_ERA for NaN. Eras follow on from each other, so the era is found from where
+# each one starts.
+def birth_eras(birth_years):
+    starts = np.array([start for start, end, limit in ERAS[1:]])
+
+    eras = np.searchsorted(starts, np.nan_to_num(birth_years), 'right')
+    eras[np.isnan(birth_years)] = UNKNOWN_ERA
+
+    return eras
+
+# Alias table for drawing an index with probability proportional to its weight:
+#    prob:  NumPy array of the chance of keeping each index once it has been picked.
+#    alias: NumPy array of the index drawn instead when it isn't kept.
+class AliasTable:
+
+    # Input: weights is a NumPy array of non-negative weights, at least one positive.
+    def __init__(self, weights):
+        n = len(weights)
+
+        # Scale the weights so they average 1, then pair off each index below 1 with
+        # one above, which makes up the rest of its column (Vose's method).
+        scaled = weights * (n / weights.sum())
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+
+        while small and large:
+            less = small.pop()
+            more = large[-1]
+
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(large.pop())
+
+        # Whatever is left is 1, give or take rounding, so is always kept.
+
+    # Draw an index, using the random.Random rng.
+    def draw(self, rng):
+        i = int(rng.random() * len(self.prob))
+
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+class SamplerIndex:
+
+    # Build the index from everyone with a score in pop.db.
+    #
+    # Input: con is the sqlite3 Connection to pop.db.
+    def __init__(self, con):
+        rows = con.execute('''
+                           SELECT wd_id, score, tier, birth_year FROM popularity
+                           WHERE score > 0 AND tier IS NOT NULL
+                           ORDER BY rowid
+                           ''').fetchall()
+
+        # Every wd_id in one byte string, the ith running from offsets[i] to
+        # offsets[i + 1].
+        ids = [row[0].encode() for row in rows]
+        self.id_heap = b''.join(ids)
+        self.offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(wd_id) for wd_id in ids], out=self.offsets[1:])
+
+        self.weights = np.array([row[1] for row in rows], dtype=np.float64)
+        tiers = np.array([row[2] for row in rows], dtype=np.int64)
+        eras = birth_eras(np.array([row[3] for row in rows], dtype=np.float64))
+
+        # An alias table over the people of each (era, tier), and the people in it.
+        self.members = {}
+        self.tables = {}
+
+        for era, tier in set(zip(eras.tolist(), tiers.tolist())):
+            members = np.flatnonzero((eras == era) & (tiers == tier))
+            self.members[(era, tier)] = members
+            self.tables[(era, tier)] = AliasTable(self.weights[members])
+
+        # For every era and tier, either of which may be None for any, an alias table
+        # over the (era, tier) tables that match, weighted by their total score.
+        self.choosers = {}
+
+        wildcards = set()
+        for era, tier in self.tables:
+            wildcards |= {(era, None), (None, tier), (None, None)}
+
+        for era, tier in wildcards:
+            keys = [key for key in self.tables
+                    if era in (None, key[0]) and tier in (None, key[1])]
+            weights = np.array([self.weights[self.members[key]].sum() for key in keys])
+            self.choosers[(era, tier)] = (keys, AliasTable(weights))
+
+    # Return the wd_id of the ith person in the index.
+    def wd_id(self, i):
+        return self.id_heap[self.offsets[i]:self.offsets[i + 1]].decode()
+
+    # Draw a person's wd_id, or None if nobody matches.
+    #
+    # Input: rng is a random.Random.
+    #
+    #        era is an index into ERAS (or UNKNOWN_ERA), or None for any era.
+    #
+    #        tier is a tier, or None for any tier.
+    def draw(self, rng, era=None, tier=None):
+        key = (era, tier)
+
+        if key not in self.tables:
+            if key not in self.choosers:
+                return None
+
+            keys, chooser = self.choosers[key]
+            key = keys[chooser.draw(rng)]
+
+        return self.wd_id(self.members[key][self.tables[key].draw(rng)])
+
+# Return a random.Random seeded by a date, the same in every process.
+def date_rng(day):
+    seed = hashlib.sha256(day.isoformat().encode()).digest()
+
+    return random.Random(int.from_bytes(seed[:8], 'big'))
+
+class Sampler:
+
+    # Input: path is the SQLite database to draw people from.
+    def __init__(self, path='pop.db'):
+        self.con = sqlite3.connect(path)
+        create_schema(self.con)
+        self.index = None
+        self.data_version = None
+
+    # Return the SamplerIndex, rebuilding it first if pop.db changed since it was built.
+    # data_version changes whenever another connection commits to pop.db.
+    def current_index(self):
+        data_version = self.con.execute('PRAGMA data_version').fetchone()[0]
+
+        if self.index is None or data_version != self.data_version:
+            self.index = SamplerIndex(self.con)
+            self.data_version = data_version
+
+        return self.index
+
+    # Draw a person's wd_id, or None if nobody matches, as in SamplerIndex.draw.
+    def draw(self, rng, era=None, tier=None):
+        return self.current_index().draw(rng, era, tier)
+
+    # Return the wd_id of the person for a day, or None if nobody matches.
+    #
+    # Input: day is a datetime.date.
+    #
+    #        era and tier are as in SamplerIndex.draw.
+    def daily(self, day, era=None, tier=None):
+        return self.draw(date_rng(day), era, tier)
+
+    def close(self):
+        self.con.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the Perdle person for a day.')
+    parser.add_argument('--date', type=date.fromisoformat, default=date.today(),
+                        help='day to draw for, as YYYY-MM-DD (default: today)')
+    parser.add_argument('--era', type=int, help='index of the era in ERAS to draw from')
+    parser.add_argument('--tier', type=int, help='tier to draw from')
+    args = parser.parse_args()
+
+    sampler = Sampler()
+    print(sampler.daily(args.date, args.era, args.tier))
+    sampler.close()
@@ -0,0 +1,334 @@
+import sqlite3
+import argparse
+import time
+
+# Schema of pop.db. Every table is STRICT, so each column only ever holds its declared
+# type (or NULL) instead of whatever SQLite's type affinity made of the value, and each
+# metric has an index so "top N by metric" and tier lookups don't scan the table.
+#
+# The schema version is kept in pop.db's user_version. Databases from before there was
+# a version (user_version 0) have untyped columns and no indexes. To change the schema,
+# change TABLES or INDEXES and bump SCHEMA_VERSION: the next script to open pop.db
+# through create_schema then upgrades it in place, rebuilding each table into its new
+# definition and copying the columns it already had, so nothing has to be fetched
+# again. Running this script does the same ahead of time.
+#
+# The upgrade is online, whether this script or create_schema runs it. pop.db is put in
+# WAL mode, so it can be read throughout, and rows are copied a batch per transaction,
+# so a refresh writing to pop.db only ever waits for one batch, as the upgrade waits up
+# to LOCK_TIMEOUT_SECS for the refresh's. Triggers on the old table mirror anything
+# written to it meanwhile into the new one, which replaces the old table in one final
+# transaction.
+
+# Current version of the schema.
+SCHEMA_VERSION = 6
+
+# Tables, as lists of (column, type) followed by their table constraints.
+#
+# popularity:
+#    wd_id (primary key): name on Wikidata, such as Q747.
+#    wp_article:          artice name on English Wikipedia.
+#    wd_sitelinks         number of sitelinks for a person's Wikidata page.
+#    wp_backlinks:        the number of backlinks on English Wikipedia for this person.
+#                         A backlink is a link to this Wikipedia page on another page.
+#    wp_avgviews:         Average monthly views starting July 2015 for this
+#                         English Wikipedia article.
+#    google_search_num:   Number of Google Search results for this English Wikipedia
+#                         article name.
+#    score:               composite popularity score, combining the metrics.
+#    tier:                popularity tier, derived from score.
+#    birth_year:          year of birth, negative for years BCE.
+#    wp_title:            canonical title of the English Wikipedia article, after
+#                         normalization and redirects, or NULL if not resolved or
+#                         there is no such article.
+#    wp_title_resolved_at: when wp_title was last resolved, in ISO 8601.
+#
+# pageviews:
+#    wd_id:  name on Wikidata, such as Q747.
+#    month:  first day of the month, as YYYYMMDD.
+#    views:  number of user views of the English Wikipedia article that month.
+#
+# changesets:
+#    run:       number of the init_db sync that made the change, counting up from 1.
+#    wd_id:     name on Wikidata, such as Q747.
+#    change:    'insert', 'update' or 'delete'.
+#    columns:   for an update, the columns changed, separated by commas.
+#    synced_at: when the sync ran, in ISO 8601.
+#
+# refresh_journal:
+#    wd_id:      name on Wikidata, such as Q747.
+#    metric:     metric fetched, such as wp_backlinks.
+#    status:     'pending', 'done' or 'failed' for the current refresh, as in writer.py.
+#    attempts:   number of times the metric was fetched in the current refresh.
+#    fetched_at: when the metric was last fetched successfully, in ISO 8601.
+#
+# history_runs:
+#    run:         number of the run of metric history, counting up from 1.
+#    recorded_at: when the run was recorded, in ISO 8601.
+#    metrics:     the metrics the run recorded, separated by commas.
+#
+# metric_history:
+#    metric: popularity column, such as wp_backlinks.
+#    wd_id:  name on Wikidata, such as Q747.
+#    run:    run the value was recorded in. Only values that changed since the
+#            person's last run are stored.
+#    value:  the metric's value, rounded to a whole number.
+TABLES = {
+    'popularity': ([('wd_id', 'TEXT NOT NULL'),
+                    ('wp_article', 'TEXT'),
+                    ('wd_sitelinks', 'INTEGER'),
+                    ('wp_backlinks', 'INTEGER'),
+                    ('wp_avgviews', 'REAL'),
+                    ('google_search_num', 'INTEGER'),
+                    ('score', 'REAL'),
+                    ('tier', 'INTEGER'),
+                    ('birth_year', 'INTEGER'),
+                    ('wp_title', 'TEXT'),
+                    ('wp_title_resolved_at', 'TEXT')],
+                   ['PRIMARY KEY (wd_id)']),
+    'pageviews': ([('wd_id', 'TEXT NOT NULL'),
+                   ('month', 'TEXT NOT NULL'),
+                   ('views', 'INTEGER NOT NULL')],
+                  ['PRIMARY KEY (wd_id, month)']),
+    'changesets': ([('run', 'INTEGER NOT NULL'),
+                    ('wd_id', 'TEXT NOT NULL'),
+                    ('change', 'TEXT NOT NULL'),
+                    ('columns', 'TEXT'),
+                    ('synced_at', 'TEXT NOT NULL')],
+                   ['PRIMARY KEY (run, wd_id)']),
+    'refresh_journal': ([('wd_id', 'TEXT NOT NULL'),
+                         ('metric', 'TEXT NOT NULL'),
+                         ('status', 'TEXT NOT NULL'),
+                         ('attempts', 'INTEGER NOT NULL'),
+                         ('fetched_at', 'TEXT')],
+                        ['PRIMARY KEY (wd_id, metric)',
+                         "CHECK (status IN ('pending', 'done', 'failed'))"]),
+    'history_runs': ([('run', 'INTEGER NOT NULL'),
+                      ('recorded_at', 'TEXT NOT NULL'),
+                      ('metrics', 'TEXT NOT NULL')],
+                     ['PRIMARY KEY (run)']),
+    'metric_history': ([('metric', 'TEXT NOT NULL'),
+                        ('wd_id', 'TEXT NOT NULL'),
+                        ('run', 'INTEGER NOT NULL'),
+                        ('value', 'REAL NOT NULL')],
+                       ['PRIMARY KEY (metric, wd_id, run)'])
+}
+
+# Indexes, as (name, table, columns). Each ends in wd_id, so queries for the top people
+# by a metric are answered from the index alone.
+INDEXES = [
+    ('popularity_wd_sitelinks', 'popularity', ['wd_sitelinks', 'wd_id']),
+    ('popularity_wp_backlinks', 'popularity', ['wp_backlinks', 'wd_id']),
+    ('popularity_wp_avgviews', 'popularity', ['wp_avgviews', 'wd_id']),
+    ('popularity_google_search_num', 'popularity', ['google_search_num', 'wd_id']),
+    ('popularity_score', 'popularity', ['score', 'wd_id']),
+    ('popularity_tier', 'popularity', ['tier', 'score', 'wd_id'])
+]
+
+# Eras of birth years init_db takes people from, and the sampler draws from, as
+# (first year, year after the era, LIMIT), where None means the era is open-ended:
+#    before 1500: in my view, there are far fewer than 1000 people on this list
+#                 considered "common knowledge," but I will get 1000 just in case.
+#    1500 - 1900: 6000 people.
+#    1900 - 2000: 5000 people, because many many people reside on Wikidata here.
+#    2000 - now:  only 250 people. In my opinion, this era is too new to have a lot
+#                 of entries.
+ERAS = [
+    (None, 1500, 1000),
+    (1500, 1900, 6000),
+    (1900, 2000, 5000),
+    (2000, None, 250)
+]
+
+# Default number of rows copied per transaction when migrating.
+MIGRATE_BATCH = 5000
+
+# Time to wait between batches when migrating, so other writers get the lock.
+MIGRATE_PAUSE_SECS = 0.01
+
+# Longest time to wait for another writer's lock when migrating.
+LOCK_TIMEOUT_SECS = 60
+
+# Return the CREATE TABLE statement for a table in TABLES, created under a given name.
+def create_table_query(table, name):
+    columns, constraints = TABLES[table]
+
+    return 'CREATE TABLE IF NOT EXISTS {} ({}) STRICT'.format(
+        name, ', '.join(['{} {}'.format(column, type) for column, type in columns] + constraints))
+
+# Return whether a table exists.
+def table_exists(con, name):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (name,)).fetchone() is not None
+
+# Return the names of a table's columns.
+def table_columns(con, name):
+    return [row[1] for row in con.execute('PRAGMA table_info({})'.format(name))]
+
+# Create any table or index of the schema that does not already exist, migrating a
+# pop.db from an older version of the schema first.
+#
+# Input: con is the sqlite3 Connection to pop.db, not in a transaction.
+def create_schema(con):
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+
+    if version < SCHEMA_VERSION and any(table_exists(con, table) for table in TABLES):
+        migrate_tables(con)
+    else:
+        create_tables(con)
+
+# Create every missing table and index, and record the database as at SCHEMA_VERSION.
+def create_tables(con):
+    with con:
+        for table in TABLES:
+            con.execute(create_table_query(table, table))
+
+        for name, table, columns in INDEXES:
+            con.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(name, table, ', '.join(columns)))
+
+        con.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+# Rebuild a table into its definition in TABLES, copying every column the two have in
+# common, batch_size rows per transaction. Rowids are kept, so row order, and anything
+# paging through the table by rowid, is unaffected.
+#
+# Input: con is a sqlite3 Connection to pop.db in autocommit mode.
+#
+#        table is the name of the table in TABLES.
+#
+#        batch_size is the number of rows copied per transaction.
+def rebuild_table(con, table, batch_size):
+    new = table + '_migrating'
+
+    columns = [column for column, type in TABLES[table][0] if column in table_columns(con, table)]
+    column_list = ', '.join(columns)
+    new_values = ', '.join(['NEW.' + column for column in columns])
+
+    # Start over if a previous migration was interrupted.
+    con.execute('BEGIN IMMEDIATE')
+    for trigger in ('insert', 'update', 'delete'):
+        con.execute('DROP TRIGGER IF EXISTS {}_migrate_{}'.format(table, trigger))
+    con.execute('DROP TABLE IF EXISTS {}'.format(new))
+
+    con.execute(create_table_query(table, new))
+
+    # Mirror every change to the old table into the new one while copying. Rows not
+    # copied yet are copied again by their batch, which reads the old table in the same
+    # transaction, so both ways give the same row.
+    con.execute('''
+                CREATE TRIGGER {0}_migrate_insert AFTER INSERT ON {0} BEGIN
+                INSERT OR REPLACE INTO {1} (rowid, {2}) VALUES (NEW.rowid, {3});
+                END
+                '''.format(table, new, column_list, new_values))
+    con.execute('''
+                CREATE TRIGGER {0}_migrate_update AFTER UPDATE ON {0} BEGIN
+                DELETE FROM {1} WHERE rowid = OLD.rowid;
+                INSERT OR REPLACE INTO {1} (rowid, {2}) VALUES (NEW.rowid, {3});
+                END
+                '''.format(table, new, column_list, new_values))
+    con.execute('''
+                CREATE TRIGGER {0}_migrate_delete AFTER DELETE ON {0} BEGIN
+                DELETE FROM {1} WHERE rowid = OLD.rowid;
+                END
+                '''.format(table, new))
+    con.execute('COMMIT')
+
+    # Query for the last rowid of the next batch after a given rowid.
+    batch_end_query = 'SELECT MAX(rowid) FROM (SELECT rowid FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?)'.format(table)
+
+    # Query to copy the rows of a batch. STRICT columns convert values that can be
+    # stored as their type without loss, such as '12' in an INTEGER column, and reject
+    # anything else.
+    copy_query = '''
+                 INSERT OR REPLACE INTO {1} (rowid, {2})
+                 SELECT rowid, {2} FROM {0} WHERE rowid > ? AND rowid <= ?
+                 '''.format(table, new, column_list)
+
+    last_rowid = 0
+    copied = 0
+
+    while True:
+        con.execute('BEGIN IMMEDIATE')
+
+        batch_end = con.execute(batch_end_query, (last_rowid, batch_size)).fetchone()[0]
+        if batch_end is None:
+            con.execute('COMMIT')
+            break
+
+        try:
+            copied += con.execute(copy_query, (last_rowid, batch_end)).rowcount
+        except sqlite3.IntegrityError as e:
+            con.execute('ROLLBACK')
+            raise RuntimeError('Rows of', table, 'after rowid', last_rowid,
+                               'don\'t fit the new schema:', str(e))
+
+        con.execute('COMMIT')
+
+        last_rowid = batch_end
+        print('Copied', copied, 'rows of', table)
+
+        time.sleep(MIGRATE_PAUSE_SECS)
+
+    # Replace the old table with the new one.
+    con.execute('BEGIN IMMEDIATE')
+    for trigger in ('insert', 'update', 'delete'):
+        con.execute('DROP TRIGGER {}_migrate_{}'.format(table, trigger))
+    con.execute('DROP TABLE {}'.format(table))
+    con.execute('ALTER TABLE {} RENAME TO {}'.format(new, table))
+    con.execute('COMMIT')
+
+# Upgrade a database from an older version of the schema to SCHEMA_VERSION in place.
+#
+# Input: con is the sqlite3 Connection to the database, not in a transaction.
+#
+#        batch_size is the number of rows copied per transaction.
+def migrate_tables(con, batch_size=MIGRATE_BATCH):
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+
+    # WAL lets pop.db be read while it is upgraded. The connection's own busy timeout
+    # is put back afterwards.
+    con.execute('PRAGMA journal_mode=WAL')
+    busy_timeout = con.execute('PRAGMA busy_timeout').fetchone()[0]
+    con.execute('PRAGMA busy_timeout = {}'.format(LOCK_TIMEOUT_SECS * 1000))
+
+    # Transactions are managed here, a batch at a time.
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+
+    try:
+        for table in TABLES:
+            if table_exists(con, table):
+                rebuild_table(con, table, batch_size)
+    finally:
+        con.isolation_level = isolation_level
+        con.execute('PRAGMA busy_timeout = {}'.format(busy_timeout))
+
+    # Create the tables that didn't exist and every index, and record the new version.
+    create_tables(con)
+
+    print('Migrated the schema from version', version, 'to', SCHEMA_VERSION)
+
+# Upgrade a database to SCHEMA_VERSION in place, as in migrate_tables.
+#
+# Input: path is the SQLite database to migrate.
+#
+#        batch_size is the number of rows copied per transaction.
+def migrate(path='pop.db', batch_size=MIGRATE_BATCH):
+    con = sqlite3.connect(path, timeout=LOCK_TIMEOUT_SECS)
+
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        print(path, 'is already at schema version', version)
+    else:
+        migrate_tables(con, batch_size)
+
+    con.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upgrade pop.db to the current schema in place.')
+    parser.add_argument('--db', default='pop.db', help='database to migrate')
+    parser.add_argument('--batch-size', type=int, default=MIGRATE_BATCH,
+                        help='rows copied per transaction')
+    args = parser.parse_args()
+
+    migrate(args.db, args.batch_size)
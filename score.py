@@ -0,0 +1,163 @@
+from changesets import changed_query, latest_changeset
+from schema import create_schema
+import numpy as np
+import sqlite3
+import argparse
+import time
+
+# Combine each person's popularity statistics into a single score for how famous they
+# are, and a tier from it. Every metric is loaded into a NumPy array and the whole table
+# is scored in one vectorized pass:
+#
+#    1. Each metric is log scaled, since fame is heavy tailed: the most viewed article
+#       has millions of times the views of the least.
+#    2. The log scaled metrics are standardized, so they can be weighed against each
+#       other, and combined by SCORE_WEIGHTS. A person missing a metric is scored on
+#       the others.
+#    3. The score is the percentile rank of the combination among everyone scored,
+#       from 0 to 1, and the tier is taken from TIER_FLOORS.
+#
+# Scores are relative to everyone in pop.db, so they are always computed over the whole
+# table, but only rows whose score or tier changed are written back. After a refresh
+# that only touched some people, recomputing just those people skips everyone else.
+
+# Weight of each metric in the score.
+SCORE_WEIGHTS = {
+    'wd_sitelinks': 0.3,
+    'wp_backlinks': 0.3,
+    'wp_avgviews': 0.4
+}
+
+# Lowest score of each tier, from tier 1 (the most famous) down. Anyone below the last
+# floor is in the tier after it.
+TIER_FLOORS = [0.9, 0.7, 0.4]
+
+# Return the percentile rank of each value in a NumPy array, from 0 to 1, with ties
+# sharing the mean of their ranks. Takes a single sort.
+def percentile_ranks(values):
+    order = np.argsort(values)
+    ordered = values[order]
+
+    # Where each run of equal values starts and ends in sorted order.
+    starts = np.empty(len(values), dtype=bool)
+    starts[:1] = True
+    np.not_equal(ordered[1:], ordered[:-1], out=starts[1:])
+    group = np.cumsum(starts) - 1
+    bounds = np.append(np.flatnonzero(starts), len(values))
+
+    ranks = np.empty(len(values))
+    ranks[order] = ((bounds[:-1] + bounds[1:]) / (2 * len(values)))[group]
+
+    return ranks
+
+# Return each row's score and tier, as NumPy arrays, with NaN for anyone with no
+# metrics at all.
+#
+# Input: metrics is a 2D NumPy array with a column for each metric in SCORE_WEIGHTS,
+#        in order, and NaN for a missing value.
+def compute_scores(metrics):
+    weighted = np.zeros(len(metrics))
+    total_weight = np.zeros(len(metrics))
+
+    for i, weight in enumerate(SCORE_WEIGHTS.values()):
+        column = metrics[:, i]
+        present = ~np.isnan(column)
+        if not present.any():
+            continue
+
+        # Log scale, then standardize over the people who have the metric.
+        logs = np.log1p(np.maximum(column[present], 0))
+        logs -= logs.mean()
+        std = logs.std()
+        if std > 0:
+            logs /= std
+
+        weighted[present] += weight * logs
+        total_weight[present] += weight
+
+    # Weighted mean of the metrics each person has, ranked.
+    scored = total_weight > 0
+    score = np.full(len(metrics), np.nan)
+    score[scored] = percentile_ranks(weighted[scored] / total_weight[scored])
+
+    floors = np.array(sorted(TIER_FLOORS))
+    tier = np.full(len(metrics), np.nan)
+    tier[scored] = len(floors) + 1 - np.searchsorted(floors, score[scored], 'right')
+
+    return score, tier
+
+# Recompute score and tier for everyone in pop.db and write the ones that changed.
+# Returns the number of rows written.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        wd_ids, if given, only writes these people, such as the ones a refresh just
+#        fetched. Everyone else keeps their stored score until the next full recompute.
+def update_scores(con, wd_ids=None):
+    start = time.perf_counter()
+
+    # metric names are SCORE_WEIGHTS keys, so they are safe to put in the query.
+    rows = con.execute('SELECT rowid, wd_id, score, tier, {} FROM popularity'.format(
+        ', '.join(SCORE_WEIGHTS))).fetchall()
+    if not rows:
+        return 0
+
+    # NULLs become NaN. Each column is kept contiguous, since they are scored a column at
+    # a time.
+    values = np.array([row[:1] + row[2:] for row in rows], dtype=float, order='F')
+    rowids = values[:, 0].astype(np.int64)
+    old_score = values[:, 1]
+    old_tier = values[:, 2]
+
+    loaded = time.perf_counter()
+
+    score, tier = compute_scores(values[:, 3:])
+
+    computed = time.perf_counter()
+
+    # Rows to write are the ones whose score or tier changed (NaN is NULL on both sides).
+    changed = ~((score == old_score) | (np.isnan(score) & np.isnan(old_score)))
+    changed |= ~((tier == old_tier) | (np.isnan(tier) & np.isnan(old_tier)))
+
+    if wd_ids is not None:
+        wd_ids = set(wd_ids)
+        changed &= np.array([row[1] in wd_ids for row in rows], dtype=bool)
+
+    which = np.flatnonzero(changed)
+
+    # Back to Python values, with NULL for NaN.
+    new_scores = [None if np.isnan(s) else s for s in score[which].tolist()]
+    new_tiers = [None if np.isnan(t) else int(t) for t in tier[which].tolist()]
+
+    with con:
+        con.executemany('UPDATE popularity SET score = ?, tier = ? WHERE rowid = ?',
+                        zip(new_scores, new_tiers, rowids[which].tolist()))
+
+    print('Scored', len(rows), 'people in {:.3f}s (loading {:.3f}s), wrote {} in {:.3f}s'.format(
+        computed - loaded, loaded - start, len(which), time.perf_counter() - computed))
+
+    return len(which)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute the score and tier of everyone in pop.db.')
+    parser.add_argument('--only', nargs='+', metavar='WD_ID',
+                        help='only write the scores of these people')
+    parser.add_argument('--changed', action='store_true',
+                        help='only write the scores of the people the last init_db.py --sync '
+                             'inserted or updated')
+    args = parser.parse_args()
+
+    con = sqlite3.connect("pop.db")
+    create_schema(con)
+
+    wd_ids = args.only
+    if args.changed:
+        run = latest_changeset(con)
+        if run is None:
+            raise RuntimeError('No changeset to score, run init_db.py --sync first')
+
+        query, params = changed_query(run)
+        wd_ids = (wd_ids or []) + [row[0] for row in con.execute(query, params)]
+
+    update_scores(con, wd_ids)
+    con.close()
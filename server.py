@@ -0,0 +1,304 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+from sampler import SamplerIndex, date_rng, birth_eras, UNKNOWN_ERA
+from schema import create_schema
+from datetime import date
+from http import HTTPStatus
+from aiohttp import web
+import numpy as np
+import argparse
+import hashlib
+import asyncio
+import sqlite3
+import json
+
+# Read-only HTTP service over pop.db, so the game doesn't have to open pop.db itself:
+#
+#    GET /person/{wd_id}                    a person's statistics
+#    GET /daily?date=&era=&tier=            the person for a day, as drawn by sampler.py
+#    GET /compare?guess=&date=&era=&tier=   how the day's person compares to a guess
+#
+# date defaults to today, era and tier to any. Responses are JSON.
+#
+# Queries run on a small pool of read-only connections in threads, off the event loop.
+# Their responses are kept in an LRU cache, so the hot path, the same few people and
+# days asked for over and over, never touches SQLite. The cache is emptied whenever
+# pop.db's data_version changes, which it does whenever a refresh commits. Every
+# response has an ETag of its body, and a request whose If-None-Match has it gets a
+# 304 Not Modified with no body.
+
+# Default port to listen on.
+PORT = 8080
+
+# Default number of read-only connections, and threads running queries on them.
+POOL_SIZE = 4
+
+# Default number of responses kept in the cache.
+CACHE_SIZE = 100000
+
+# Columns of popularity returned for a person.
+PERSON_COLUMNS = ('wd_id', 'wp_article', 'wp_title', 'birth_year', 'wd_sitelinks', 'wp_backlinks',
+                  'wp_avgviews', 'google_search_num', 'score', 'tier')
+
+# Columns compared between a guess and the day's person.
+HINT_COLUMNS = ('birth_year', 'wd_sitelinks', 'wp_backlinks', 'wp_avgviews', 'score', 'tier')
+
+# A cached response: its HTTP status, JSON body and ETag.
+CachedResponse = namedtuple('CachedResponse', ['status', 'body', 'etag'])
+
+# Pool of read-only connections to pop.db. Queries are run on a connection of their
+# own in one of the pool's threads, so slow queries don't hold up the event loop.
+class ReadOnlyPool:
+
+    # Input: path is the SQLite database to read.
+    #
+    #        size is the number of connections, and threads.
+    def __init__(self, path='pop.db', size=POOL_SIZE):
+        uri = 'file:{}?mode=ro'.format(path)
+
+        self.connections = asyncio.Queue()
+        for i in range(size):
+            self.connections.put_nowait(sqlite3.connect(uri, uri=True, check_same_thread=False))
+
+        self.executor = ThreadPoolExecutor(size)
+
+        # Only used on the event loop, to see whether pop.db has changed.
+        self.watcher = sqlite3.connect(uri, uri=True)
+
+    # Return pop.db's data_version, which changes whenever another connection commits.
+    def data_version(self):
+        return self.watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    # Return the result of a function taking (con, *args), run in a pool thread on a
+    # free connection.
+    async def run(self, function, *args):
+        con = await self.connections.get()
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, con, *args)
+        finally:
+            self.connections.put_nowait(con)
+
+    def close(self):
+        self.executor.shutdown()
+        self.watcher.close()
+
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+
+# Least recently used cache of at most max_entries values.
+class LRUCache:
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Return the value for a key, or None if it isn't cached.
+    def get(self, key):
+        value = self.entries.get(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+# Return a person's statistics as a dictionary, or None if they aren't in pop.db.
+def person_query(con, wd_id):
+    row = con.execute('SELECT {} FROM popularity WHERE wd_id = ?'.format(', '.join(PERSON_COLUMNS)),
+                      (wd_id,)).fetchone()
+
+    return None if row is None else dict(zip(PERSON_COLUMNS, row))
+
+# Return how the answer's value compares to the guess's: 'higher', 'lower', 'same', or
+# None if either is unknown.
+def compare_values(answer, guess):
+    if answer is None or guess is None:
+        return None
+    if answer > guess:
+        return 'higher'
+    if answer < guess:
+        return 'lower'
+    return 'same'
+
+class QueryService:
+
+    # Input: pool is the ReadOnlyPool to query.
+    #
+    #        cache_size is the number of responses to cache.
+    def __init__(self, pool, cache_size=CACHE_SIZE):
+        self.pool = pool
+        self.cache = LRUCache(cache_size)
+        self.data_version = pool.data_version()
+
+        # The SamplerIndex for daily picks, built when first needed after pop.db changes,
+        # and the task building it.
+        self.sampler_index = None
+        self.sampler_task = None
+
+        self.app = web.Application()
+        self.app.add_routes([web.get('/person/{wd_id}', self.person),
+                             web.get('/daily', self.daily),
+                             web.get('/compare', self.compare)])
+
+    # Forget everything cached if pop.db has changed since it was cached.
+    def check_data_version(self):
+        data_version = self.pool.data_version()
+
+        if data_version != self.data_version:
+            self.cache.clear()
+            self.sampler_index = None
+            self.sampler_task = None
+            self.data_version = data_version
+
+    # Return the response for a key from the cache, or else from the coroutine function
+    # compute, which returns a dictionary, or None for 404 Not Found, and cache it. Answers
+    # 304 Not Modified if the request already has the response.
+    async def respond(self, request, key, compute):
+        self.check_data_version()
+
+        cached = self.cache.get(key)
+        if cached is None:
+            data_version = self.data_version
+            data = await compute()
+
+            if data is None:
+                status = HTTPStatus.NOT_FOUND
+                data = {'error': 'not found'}
+            else:
+                status = HTTPStatus.OK
+
+            body = json.dumps(data, separators=(',', ':')).encode()
+            etag = '"{}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest())
+            cached = CachedResponse(status, body, etag)
+
+            # Unless pop.db changed while it was being computed.
+            if self.data_version == data_version:
+                self.cache.put(key, cached)
+
+        headers = {'ETag': cached.etag, 'Cache-Control': 'no-cache'}
+
+        if cached.status == HTTPStatus.OK and cached.etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+        return web.Response(status=cached.status, body=cached.body, headers=headers,
+                            content_type='application/json')
+
+    # Return the SamplerIndex of pop.db as it is now, building it once for every request
+    # waiting on it.
+    async def current_sampler_index(self):
+        if self.sampler_index is None:
+            if self.sampler_task is None:
+                self.sampler_task = asyncio.ensure_future(self.pool.run(SamplerIndex))
+
+            task = self.sampler_task
+            index = await task
+
+            # Unless pop.db changed again while it was being built.
+            if task is self.sampler_task:
+                self.sampler_index = index
+
+            return index
+
+        return self.sampler_index
+
+    # Return the wd_id of the person for a day, or None if nobody matches.
+    async def daily_pick(self, day, era, tier):
+        index = await self.current_sampler_index()
+
+        return index.draw(date_rng(day), era, tier)
+
+    # Return the (date, era, tier) of a daily pick from a request's query string.
+    def daily_params(self, request):
+        try:
+            day = date.fromisoformat(request.query['date']) if 'date' in request.query else date.today()
+            era = int(request.query['era']) if 'era' in request.query else None
+            tier = int(request.query['tier']) if 'tier' in request.query else None
+        except ValueError:
+            raise web.HTTPBadRequest(text='date must be YYYY-MM-DD, era and tier integers')
+
+        return day, era, tier
+
+    async def person(self, request):
+        wd_id = request.match_info['wd_id']
+
+        return await self.respond(request, ('person', wd_id),
+                                  lambda: self.pool.run(person_query, wd_id))
+
+    async def daily(self, request):
+        day, era, tier = self.daily_params(request)
+
+        async def compute():
+            wd_id = await self.daily_pick(day, era, tier)
+            if wd_id is None:
+                return None
+
+            return {'date': day.isoformat(), 'wd_id': wd_id}
+
+        return await self.respond(request, ('daily', day, era, tier), compute)
+
+    async def compare(self, request):
+        day, era, tier = self.daily_params(request)
+
+        guess_id = request.query.get('guess')
+        if not guess_id:
+            raise web.HTTPBadRequest(text='guess is required')
+
+        async def compute():
+            answer_id = await self.daily_pick(day, era, tier)
+            if answer_id is None:
+                return None
+
+            guess = await self.pool.run(person_query, guess_id)
+            if guess is None:
+                return None
+
+            answer = await self.pool.run(person_query, answer_id)
+
+            hints = {column: compare_values(answer[column], guess[column]) for column in HINT_COLUMNS}
+
+            # How their eras of birth, as in schema.ERAS, compare.
+            eras = birth_eras(np.array([answer['birth_year'], guess['birth_year']], dtype=float))
+            hints['era'] = compare_values(*[None if era == UNKNOWN_ERA else era for era in eras.tolist()])
+
+            return {'date': day.isoformat(), 'guess': guess_id, 'correct': guess_id == answer_id,
+                    'hints': hints}
+
+        return await self.respond(request, ('compare', day, era, tier, guess_id), compute)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve people, daily picks and hints from pop.db.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='read-only connections to pop.db (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help='responses to cache (default: %(default)s)')
+    args = parser.parse_args()
+
+    # The pool can't write, so bring pop.db up to the current schema first.
+    con = sqlite3.connect("pop.db")
+    create_schema(con)
+    con.close()
+
+    pool = ReadOnlyPool(size=args.pool_size)
+    service = QueryService(pool, args.cache_size)
+
+    try:
+        web.run_app(service.app, host=args.host, port=args.port, access_log=None)
+    finally:
+        pool.close()
@@ -0,0 +1,241 @@
+from schema import TABLES, create_schema
+import numpy as np
+import argparse
+import sqlite3
+import json
+import mmap
+import time
+import os
+
+# Columnar snapshot of the popularity table, for processes that only read it. Opening
+# SQLite and fetching every row as Python tuples is slow to start and gives every
+# process its own copy. A snapshot is a single file that is memory-mapped instead:
+# numeric columns are fixed-width arrays read in place by NumPy, and text columns are
+# one heap of UTF-8 with an array of offsets into it. Nothing is copied, so every
+# process reading a snapshot shares the one copy in the page cache.
+#
+# Layout, with every section starting on a multiple of ALIGN bytes:
+#
+#    MAGIC
+#    length of the header, as a little-endian uint64
+#    header, as JSON: the snapshot version, number of rows, schema version and time of
+#                     export, and for each column its name, type and the offset and
+#                     length in bytes of each of its sections
+#    the sections
+#
+# INTEGER columns are int64, with NULL_INT for NULL, and REAL columns are float64, with
+# NaN for NULL. TEXT columns have an int64 offsets section, one longer than the number
+# of rows, and a heap section; NULL is stored as ''.
+
+# Where the snapshot is kept.
+SNAPSHOT_PATH = 'pop.snap'
+
+# Start of every snapshot file.
+MAGIC = b'PERDLESNAP\0\0\0\0\0\0'
+
+# Version of the snapshot layout, bumped whenever it changes.
+SNAPSHOT_VERSION = 1
+
+# Sections are aligned for any NumPy type.
+ALIGN = 64
+
+# Stored for NULL in INTEGER columns.
+NULL_INT = np.iinfo(np.int64).min
+
+# NumPy type of each numeric SQLite type.
+NUMERIC_TYPES = {'INTEGER': '<i8', 'REAL': '<f8'}
+
+# Number of rows read from pop.db at a time when exporting.
+PAGE_SIZE = 10000
+
+# Return the number of bytes to pad an offset with to the next multiple of ALIGN.
+def padding(offset):
+    return -offset % ALIGN
+
+# Return the SQLite type of each column of the popularity table.
+def column_types():
+    return [(column, type.split(' ')[0]) for column, type in TABLES['popularity'][0]]
+
+# Write a snapshot of the popularity table, in rowid order. It is written next to path
+# and moved over it once complete, so processes that already have the old snapshot
+# mapped keep reading it undisturbed.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        path is the file to write.
+def export_snapshot(con, path=SNAPSHOT_PATH):
+    columns = column_types()
+
+    # Read the table a page at a time by rowid, into a list of values per column.
+    values = [[] for column in columns]
+
+    query = 'SELECT rowid, {} FROM popularity WHERE rowid > ? ORDER BY rowid LIMIT ?'.format(
+        ', '.join(column for column, type in columns))
+
+    # Read every page in one transaction, so the snapshot is of a single moment.
+    con.execute('SAVEPOINT snapshot')
+
+    try:
+        last_rowid = 0
+        while True:
+            page = con.execute(query, (last_rowid, PAGE_SIZE)).fetchall()
+            if not page:
+                break
+
+            for i, column_values in enumerate(zip(*page)):
+                if i:
+                    values[i - 1].extend(column_values)
+
+            last_rowid = page[-1][0]
+
+        schema_version = con.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        con.execute('RELEASE snapshot')
+
+    num_rows = len(values[0])
+
+    # Each section as bytes, under the column it belongs to.
+    sections = []
+    for (column, type), column_values in zip(columns, values):
+        if type in NUMERIC_TYPES:
+            null = NULL_INT if type == 'INTEGER' else np.nan
+            array = np.array([null if value is None else value for value in column_values],
+                             dtype=NUMERIC_TYPES[type])
+            sections.append((column, type, {'data': array.tobytes()}))
+        else:
+            encoded = [(value or '').encode() for value in column_values]
+            offsets = np.zeros(num_rows + 1, dtype='<i8')
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            sections.append((column, type, {'offsets': offsets.tobytes(),
+                                            'heap': b''.join(encoded)}))
+
+    # Lay out the sections after the header, whose own length depends on their offsets.
+    # Offsets are from the start of the data, which follows the header.
+    layout = []
+    offset = 0
+    for column, type, parts in sections:
+        placed = {}
+        for name, data in parts.items():
+            placed[name] = [offset, len(data)]
+            offset += len(data) + padding(len(data))
+        layout.append({'name': column, 'type': type, 'sections': placed})
+
+    header = json.dumps({'version': SNAPSHOT_VERSION,
+                         'rows': num_rows,
+                         'schema_version': schema_version,
+                         'exported_at': time.time(),
+                         'columns': layout}).encode()
+
+    data_start = len(MAGIC) + 8 + len(header)
+    data_start += padding(data_start)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(b'\0' * (data_start - f.tell()))
+
+        for column, type, parts in sections:
+            for data in parts.values():
+                f.write(data)
+                f.write(b'\0' * padding(len(data)))
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+    return num_rows
+
+# A TEXT column of a snapshot. Indexing it decodes one value from the heap.
+class TextColumn:
+
+    def __init__(self, offsets, heap):
+        self.offsets = offsets
+        self.heap = heap
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.heap[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+# A memory-mapped snapshot. Columns are NumPy arrays (or TextColumns) backed directly by
+# the file.
+class Snapshot:
+
+    # Input: path is the snapshot file.
+    def __init__(self, path=SNAPSHOT_PATH):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise RuntimeError(path, 'is not a snapshot')
+
+        header_len = int.from_bytes(self.map[len(MAGIC):len(MAGIC) + 8], 'little')
+        header_start = len(MAGIC) + 8
+        header = json.loads(self.map[header_start:header_start + header_len])
+
+        if header['version'] != SNAPSHOT_VERSION:
+            raise RuntimeError('Snapshot is version', header['version'],
+                               'but this code reads version', SNAPSHOT_VERSION)
+
+        self.rows = header['rows']
+        self.schema_version = header['schema_version']
+        self.exported_at = header['exported_at']
+
+        data_start = header_start + header_len
+        data_start += padding(data_start)
+
+        buffer = memoryview(self.map)
+
+        self.columns = {}
+        for column in header['columns']:
+            sections = {name: buffer[data_start + offset:data_start + offset + length]
+                        for name, (offset, length) in column['sections'].items()}
+
+            if column['type'] in NUMERIC_TYPES:
+                self.columns[column['name']] = np.frombuffer(sections['data'],
+                                                             dtype=NUMERIC_TYPES[column['type']])
+            else:
+                self.columns[column['name']] = TextColumn(np.frombuffer(sections['offsets'], dtype='<i8'),
+                                                          sections['heap'])
+
+    # Return a column by name.
+    def column(self, name):
+        return self.columns[name]
+
+    # Release the columns and unmap the file. If arrays from the snapshot are still
+    # referenced elsewhere, the file stays mapped until they are gone.
+    def close(self):
+        self.columns = {}
+
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or inspect a columnar snapshot of pop.db.')
+    parser.add_argument('--export', action='store_true',
+                        help='export pop.db to the snapshot')
+    parser.add_argument('--path', default=SNAPSHOT_PATH, help='snapshot file')
+    args = parser.parse_args()
+
+    if args.export:
+        con = sqlite3.connect("pop.db")
+        create_schema(con)
+        start = time.perf_counter()
+        num_rows = export_snapshot(con, args.path)
+        print('Exported', num_rows, 'rows in {:.3f}s'.format(time.perf_counter() - start))
+        con.close()
+
+    start = time.perf_counter()
+    snapshot = Snapshot(args.path)
+    print('Opened', snapshot.rows, 'rows in {:.3f}ms'.format((time.perf_counter() - start) * 1000))
+
+    for name, column in snapshot.columns.items():
+        print(name, column[0] if snapshot.rows else None)
+
+    snapshot.close()
@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from requester import parse_json
+import urllib.parse
+import unicodedata
+import asyncio
+
+# Resolve each person's wp_article to the title of the English Wikipedia page it is
+# really on. Titles from Wikidata can differ from the page the APIs know them by: the
+# page may have been moved, leaving the old title as a redirect, or the title may not
+# be written the way MediaWiki normalizes it. Fetching by such a title is a wasted
+# request that comes back a 404, or the views of a redirect instead of the article.
+#
+# Titles are resolved WP_API_MAX_TITLES at a time through the MediaWiki action API,
+# which normalizes them and follows redirects, and the canonical title is stored in
+# pop.db's wp_title with the time it was resolved. Later runs only resolve titles that
+# haven't been, or not for TITLE_REFRESH_DAYS, since pages keep being moved.
+
+# MediaWiki action API for English Wikipedia, and the most titles it takes in one
+# request.
+WP_API_ENDP = 'https://en.wikipedia.org/w/api.php'
+WP_API_MAX_TITLES = 50
+
+# Request headers for MediaWiki API requests. The Requester adds our User-Agent.
+WP_API_HEADERS = {
+    'accept': 'application/json'
+}
+
+# Number of days before a resolved title is resolved again.
+TITLE_REFRESH_DAYS = 90
+
+# Number of rows read from pop.db at a time, whose titles are resolved concurrently.
+RESOLVE_PAGE_SIZE = 500
+
+# SQL expression for the title to fetch a person's article by: the canonical title
+# once it has been resolved, else wp_article. It is NULL if the title resolved as
+# missing, since fetching by the stale wp_article would only come back a 404.
+FETCH_TITLE = 'CASE WHEN wp_title_resolved_at IS NULL THEN wp_article ELSE wp_title END'
+
+# Return a title the way MediaWiki normalizes it: underscores as spaces, runs of
+# whitespace collapsed, and the first letter capitalized, as English Wikipedia does.
+def normalize_title(title):
+    title = ' '.join(unicodedata.normalize('NFC', title).replace('_', ' ').split())
+
+    # Letters like ß become more than one letter in upper case, MediaWiki leaves them.
+    first = title[:1].upper()
+    if len(first) != 1:
+        return title
+
+    return first + title[1:]
+
+# Return a title as a URL path segment: normalized, with underscores for spaces, and
+# everything else that isn't safe in a path, slashes included, percent-encoded.
+def title_path(title):
+    return urllib.parse.quote(normalize_title(title).replace(' ', '_'), safe='')
+
+# Return a dictionary of each of up to WP_API_MAX_TITLES titles to the canonical title
+# of the page it is on, after normalization and redirects, or None if there is no such
+# page. Returns None if the request failed.
+#
+# Input: titles is a list of Wikipedia page titles.
+#
+#        requester is the Requester this API request is sent through.
+async def query_titles(titles, requester):
+
+    wiki_params = {
+        'action': 'query',
+        'format': 'json',
+        'formatversion': '2',
+        'titles': '|'.join(titles),
+        'redirects': '1'
+    }
+
+    resp = await requester.get(WP_API_ENDP, params=wiki_params, headers=WP_API_HEADERS)
+
+    if resp.status != HTTPStatus.OK:
+        print(titles, 'could not be resolved on the MediaWiki API')
+        return None
+
+    ret = parse_json(resp, titles, 'the MediaWiki API')
+    if ret is None:
+        return None
+
+    if 'error' in ret:
+        print(titles, 'could not be resolved on the MediaWiki API')
+        return None
+
+    query = ret.get('query', {})
+
+    normalized = {el['from']: el['to'] for el in query.get('normalized', [])}
+    redirected = {el['from']: el['to'] for el in query.get('redirects', [])}
+    pages = {page['title'] for page in query.get('pages', [])
+             if not page.get('missing') and not page.get('invalid')}
+
+    resolved = {}
+    for title in titles:
+        target = normalized.get(title, title)
+
+        # Follow a chain of redirects, but not around a loop.
+        seen = set()
+        while target in redirected and target not in seen:
+            seen.add(target)
+            target = redirected[target]
+
+        resolved[title] = target if target in pages else None
+
+    return resolved
+
+# Resolve the title of everyone in pop.db whose title hasn't been resolved in the last
+# TITLE_REFRESH_DAYS, storing the canonical title in wp_title. Titles whose request
+# fails are left to the next run. Returns the number of titles resolved.
+#
+# Input: con is the sqlite3 Connection to pop.db.
+#
+#        requester is the Requester the API requests are sent through.
+async def resolve_titles(con, requester):
+
+    # Query for the next page of rows to resolve after a given rowid.
+    page_query = '''
+                 SELECT rowid, wd_id, wp_article FROM popularity
+                 WHERE rowid > ? AND wp_article IS NOT NULL
+                 AND (wp_title_resolved_at IS NULL OR wp_title_resolved_at < ?)
+                 ORDER BY rowid LIMIT ?
+                 '''
+
+    update_query = 'UPDATE popularity SET wp_title = ?, wp_title_resolved_at = ? WHERE wd_id = ?'
+
+    cutoff = (datetime.now() - timedelta(days=TITLE_REFRESH_DAYS)).isoformat(timespec='seconds')
+
+    last_rowid = 0
+    num_resolved = 0
+    num_moved = 0
+    num_missing = 0
+
+    while True:
+        page = con.execute(page_query, (last_rowid, cutoff, RESOLVE_PAGE_SIZE)).fetchall()
+        if not page:
+            break
+
+        last_rowid = page[-1][0]
+
+        titles = sorted({normalize_title(row[2]) for row in page})
+        batches = [titles[i:i+WP_API_MAX_TITLES] for i in range(0, len(titles), WP_API_MAX_TITLES)]
+
+        resolved = {}
+        for ret in await asyncio.gather(*[query_titles(batch, requester) for batch in batches]):
+            if ret is not None:
+                resolved.update(ret)
+
+        resolved_at = datetime.now().isoformat(timespec='seconds')
+
+        updates = []
+        for rowid, wd_id, wp_article in page:
+            title = normalize_title(wp_article)
+            if title not in resolved:
+                continue
+
+            updates.append((resolved[title], resolved_at, wd_id))
+
+            if resolved[title] is None:
+                num_missing += 1
+            elif resolved[title] != wp_article:
+                num_moved += 1
+
+        with con:
+            con.executemany(update_query, updates)
+
+        num_resolved += len(updates)
+
+    print('Resolved', num_resolved, 'titles:', num_moved, 'renamed or redirected,',
+          num_missing, 'missing')
+
+    return num_resolved
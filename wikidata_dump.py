@@ -0,0 +1,191 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import subprocess
+import shutil
+import json
+import gzip
+import bz2
+import os
+
+# Read people from a Wikidata entity dump instead of querying the SPARQL endpoint, so
+# every human with an English Wikipedia article is a candidate, not just the top of each
+# query. The dump is latest-all.json(.gz/.bz2), from
+#
+#    https://dumps.wikimedia.org/wikidatawiki/entities/
+#
+# which is a JSON array with one entity per line. Only humans (P31 Q5) with an enwiki
+# sitelink and a date of birth (P569) are kept, as (wd_id, wp_article, wd_sitelinks,
+# birth_year) tuples, like the SPARQL harvest.
+#
+# Parsing the entities is spread over a pool of worker processes. An uncompressed dump
+# is split into byte ranges that each worker reads itself. A compressed dump can only be
+# read from the start, so it is piped through a decompressor process, a parallel one
+# such as lbzip2 or pigz where installed, and its output is handed to the workers in
+# chunks of whole lines, which they filter and parse. This process only moves bytes
+# between the two. Either way only a few chunks are in flight at once, so memory stays
+# the same however big the dump is.
+
+# Size of the byte ranges of an uncompressed dump, and of the chunks of a compressed
+# one, handed to a worker at a time.
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Commands that decompress a file to stdout, by the dump's extension. The first one
+# installed is used, and without any the dump is decompressed in this process.
+DECOMPRESSORS = {
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+    '.gz': [['pigz', '-dc'], ['gzip', '-dc']]
+}
+
+# Number of chunks in flight per worker.
+CHUNKS_PER_WORKER = 2
+
+# Every line that can be a person kept has these.
+HUMAN = b'"Q5"'
+ENWIKI = b'"enwiki"'
+
+# Return the year of a Wikidata time value, such as +1879-03-14T00:00:00Z, or
+# -0500-00-00T00:00:00Z for 501 BCE.
+def time_year(value):
+    return int(value[:value.index('-', 1)])
+
+# Return the values of the statements of a property that aren't deprecated.
+def statement_values(claims, prop):
+    values = []
+
+    for claim in claims.get(prop, []):
+        snak = claim.get('mainsnak', {})
+        if claim.get('rank') != 'deprecated' and snak.get('snaktype') == 'value':
+            values.append(snak['datavalue']['value'])
+
+    return values
+
+# Return a (wd_id, wp_article, wd_sitelinks, birth_year) tuple for a line of the dump,
+# or None if it isn't a human with an English Wikipedia article and a date of birth.
+def parse_person(line):
+    line = line.rstrip().rstrip(b',')
+    if not line.startswith(b'{'):
+        return None
+
+    entity = json.loads(line)
+    claims = entity.get('claims', {})
+
+    if not any(value.get('id') == 'Q5' for value in statement_values(claims, 'P31')):
+        return None
+
+    sitelinks = entity.get('sitelinks', {})
+    if 'enwiki' not in sitelinks:
+        return None
+
+    # Some people have more than one date of birth, use the earliest.
+    years = [time_year(value['time']) for value in statement_values(claims, 'P569')
+             if 'time' in value]
+    if not years:
+        return None
+
+    return (entity['id'], sitelinks['enwiki']['title'], len(sitelinks), min(years))
+
+# Return the people on a chunk of whole lines of the dump. Runs in a worker process.
+def parse_chunk(chunk):
+    people = []
+
+    for line in chunk.split(b'\n'):
+        if HUMAN in line and ENWIKI in line:
+            person = parse_person(line)
+            if person is not None:
+                people.append(person)
+
+    return people
+
+# Return the people on the lines starting in a byte range of an uncompressed dump. A
+# line belongs to the range it starts in. Runs in a worker process.
+def parse_range(path, start, end):
+    people = []
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+
+        # Skip the end of a line belonging to the range before.
+        if start:
+            f.seek(start - 1)
+            f.readline()
+
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+
+            if HUMAN in line and ENWIKI in line:
+                person = parse_person(line)
+                if person is not None:
+                    people.append(person)
+
+    return people
+
+# Yield chunks of a compressed dump, decompressed, of about CHUNK_BYTES and ending on
+# a whole line.
+def decompressed_chunks(path):
+    extension = os.path.splitext(path)[1]
+
+    command = None
+    for candidate in DECOMPRESSORS[extension]:
+        if shutil.which(candidate[0]):
+            command = candidate + [path]
+            break
+
+    if command is None:
+        opener = bz2.open if extension == '.bz2' else gzip.open
+        with opener(path, 'rb') as f:
+            yield from file_chunks(f)
+        return
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    try:
+        yield from file_chunks(proc.stdout)
+    except GeneratorExit:
+        # Stopped early, there is no need to decompress the rest.
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    if proc.returncode:
+        raise RuntimeError(command[0], 'could not decompress', path)
+
+# Yield chunks of a binary file of about CHUNK_BYTES, each ending on a whole line.
+def file_chunks(f):
+    while True:
+        chunk = f.read(CHUNK_BYTES)
+        if not chunk:
+            break
+
+        yield chunk + f.readline()
+
+# Yield lists of the people in a dump as the workers parse them.
+#
+# Input: path is the dump file.
+#
+#        processes is the number of worker processes, defaulting to one per CPU.
+def read_dump(path, processes=None):
+    processes = processes or os.cpu_count()
+
+    if path.endswith('.bz2') or path.endswith('.gz'):
+        tasks = ((parse_chunk, chunk) for chunk in decompressed_chunks(path))
+    else:
+        size = os.path.getsize(path)
+        tasks = ((parse_range, path, start, min(start + CHUNK_BYTES, size))
+                 for start in range(0, size, CHUNK_BYTES))
+
+    with ProcessPoolExecutor(processes) as pool:
+        in_flight = deque()
+
+        for task in tasks:
+            in_flight.append(pool.submit(*task))
+
+            # Wait for the oldest chunk before reading any more.
+            if len(in_flight) >= processes * CHUNKS_PER_WORKER:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
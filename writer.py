@@ -0,0 +1,159 @@
+from collections import namedtuple
+from datetime import datetime
+import time
+
+# Write fetched popularity statistics to pop.db. Fetchers return MetricResults instead
+# of SQL strings, and a MetricWriter groups them by metric and applies each group with
+# a single parameterized executemany, committing every transaction_size results.
+#
+# Alongside the results, the writer keeps a refresh journal: for each (wd_id, metric),
+# whether it was fetched this run, how many attempts it took and when it was last
+# fetched. Journal entries are committed in the same transactions as the results, so
+# a refresh that is killed can be resumed, skipping everything already written.
+
+# One statistic fetched for one person:
+#    metric: the popularity column the value belongs in, such as wp_backlinks, or
+#            MONTHLY_VIEWS.
+#    wd_id:  name on Wikidata, such as Q747.
+#    value:  the value of the statistic.
+MetricResult = namedtuple('MetricResult', ['metric', 'wd_id', 'value'])
+
+# Columns of the popularity table fetchers are allowed to write.
+METRIC_COLUMNS = ('wd_sitelinks', 'wp_backlinks', 'wp_avgviews', 'google_search_num')
+
+# Metric for monthly pageviews. Its value is a list of (month, views) tuples, which
+# are stored in the pageviews table, and wp_avgviews is then derived from every month
+# stored for that person.
+MONTHLY_VIEWS = 'monthly_views'
+
+# Statuses of a (wd_id, metric) in the refresh journal.
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Outcome of fetching one metric for one person, recorded in the refresh journal.
+JournalEntry = namedtuple('JournalEntry', ['metric', 'wd_id', 'status'])
+
+# Default number of results written per transaction.
+TRANSACTION_SIZE = 1000
+
+# Default longest time, in seconds, results are left uncommitted.
+COMMIT_SECS = 30
+
+# Start a new refresh of a list of metrics, setting every journal entry for them back to
+# PENDING. The time each was last fetched is kept.
+def reset_journal(con, metrics):
+    with con:
+        con.executemany('''
+                        UPDATE refresh_journal SET status = ?, attempts = 0
+                        WHERE metric = ?
+                        ''', [(PENDING, metric) for metric in metrics])
+
+class MetricWriter:
+
+    # Query to store (or replace) a person's pageviews for a month.
+    month_views_query = 'INSERT OR REPLACE INTO pageviews (wd_id, month, views) VALUES (?, ?, ?)'
+
+    # Query to derive the average number of pageviews from the stored months.
+    avg_views_query = '''
+                      UPDATE popularity SET wp_avgviews =
+                      (SELECT AVG(views) FROM pageviews WHERE pageviews.wd_id = popularity.wd_id)
+                      WHERE wd_id = ?
+                      '''
+
+    # Query to record the outcome of fetching a metric for a person.
+    journal_query = '''
+                    INSERT INTO refresh_journal (wd_id, metric, status, attempts, fetched_at)
+                    VALUES (?, ?, ?, 1, ?)
+                    ON CONFLICT (wd_id, metric) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = attempts + 1,
+                    fetched_at = COALESCE(excluded.fetched_at, fetched_at)
+                    '''
+
+    # Input: con is the sqlite3 Connection to pop.db, with the schema created. It is
+    #        switched to WAL mode, so pop.db can still be read while results are being
+    #        written.
+    #
+    #        transaction_size is the number of results written between commits.
+    #
+    #        commit_secs is the longest time results are queued before being committed.
+    #
+    #        metrics is a Metrics to record the rows written in, or None.
+    def __init__(self, con, transaction_size=TRANSACTION_SIZE, commit_secs=COMMIT_SECS,
+                 metrics=None):
+        self.con = con
+        self.transaction_size = transaction_size
+        self.commit_secs = commit_secs
+        self.metrics = metrics
+
+        self.con.execute('PRAGMA journal_mode=WAL')
+
+        # Results waiting to be written, by metric, and journal entries waiting to be
+        # written.
+        self.pending = {}
+        self.num_pending = 0
+        self.entries = []
+
+        self.last_flush = time.monotonic()
+
+    # Queue a MetricResult, writing everything queued once there are transaction_size
+    # results waiting.
+    def add(self, result):
+        if result.metric not in METRIC_COLUMNS and result.metric != MONTHLY_VIEWS:
+            raise RuntimeError('Unknown metric:', result.metric)
+
+        self.pending.setdefault(result.metric, []).append(result)
+        self.num_pending += 1
+
+        self.flush_if_due()
+
+    # Queue a JournalEntry, to be written in the same transaction as the results queued
+    # before it.
+    def mark(self, entry):
+        self.entries.append(entry)
+
+        self.flush_if_due()
+
+    # Write everything queued if there are transaction_size results waiting, or the
+    # last transaction was more than commit_secs ago.
+    def flush_if_due(self):
+        if (self.num_pending >= self.transaction_size
+                or time.monotonic() - self.last_flush >= self.commit_secs):
+            self.flush()
+
+    # Write every queued result and journal entry in one transaction.
+    def flush(self):
+        self.last_flush = time.monotonic()
+
+        if not self.num_pending and not self.entries:
+            return
+
+        fetched_at = datetime.now().isoformat(timespec='seconds')
+
+        with self.con:
+            for metric, results in self.pending.items():
+                if metric == MONTHLY_VIEWS:
+                    self.con.executemany(self.month_views_query,
+                                         [(result.wd_id, month, views)
+                                          for result in results
+                                          for month, views in result.value])
+                    self.con.executemany(self.avg_views_query,
+                                         [(result.wd_id,) for result in results])
+                else:
+                    # metric is one of METRIC_COLUMNS, so it is safe to put in the query.
+                    self.con.executemany('UPDATE popularity SET {} = ? WHERE wd_id = ?'.format(metric),
+                                         [(result.value, result.wd_id) for result in results])
+
+            self.con.executemany(self.journal_query,
+                                 [(entry.wd_id, entry.metric, entry.status,
+                                   fetched_at if entry.status == DONE else None)
+                                  for entry in self.entries])
+
+        if self.metrics is not None:
+            for metric, results in self.pending.items():
+                self.metrics.written(metric, len(results))
+
+        self.pending = {}
+        self.num_pending = 0
+        self.entries = []